@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
+from importlib.util import find_spec
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -37,6 +39,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
      'rest_framework',
     'shop',
     'corsheaders',
@@ -45,12 +48,69 @@ INSTALLED_APPS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
-    )
+        # JWTAuthentication that reads the user from the token claims instead of the database
+        'shop.authentication.ClaimsJWTAuthentication',
+    ),
+    'DEFAULT_RENDERER_CLASSES': (
+        # JSONRenderer that reports its rendering time to shop.metrics
+        'shop.metrics.TimedJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
 }
 
+# Slow request log: this fraction of requests keep the SQL of their queries, and
+# those slower than METRICS_SLOW_REQUEST_MS are logged to 'shop.metrics'. 0 = off.
+METRICS_SLOW_SAMPLE_RATE = 0
+METRICS_SLOW_REQUEST_MS = 500
+
 APPEND_SLASH = True
 
+# Default page size for the product listing (clients may pass ?page_size=, capped at 100)
+PRODUCT_PAGE_SIZE = 20
+
+# Default page size of the admin order list (?page_size= may ask for up to 500)
+ADMIN_ORDER_PAGE_SIZE = 50
+
+# Product image variants (name: longest edge in px), WebP quality, and the threads rendering
+# them after an upload: None = min(4, CPU count), 0 = render inline in the request
+PRODUCT_IMAGE_VARIANTS = {'thumb': 160, 'small': 320, 'medium': 640, 'large': 1280}
+PRODUCT_IMAGE_QUALITY = 80
+PRODUCT_IMAGE_WORKERS = None
+
+# Chunked image uploads (shop/uploads.py): largest chunk and file accepted, where the parts are
+# assembled (None = <system temp>/shop-uploads) and how long an idle upload may be resumed
+UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024
+UPLOAD_MAX_SIZE = 50 * 1024 * 1024
+UPLOAD_TEMP_DIR = None
+UPLOAD_SESSION_TTL = 24 * 3600
+
+# How long the response to a request with an Idempotency-Key is replayed (shop/idempotency.py)
+IDEMPOTENCY_KEY_TTL = 24 * 3600
+
+# Background jobs (shop/jobs.py, run by `manage.py run_jobs`): worker threads per process,
+# runs per job, the exponential retry backoff in seconds, and when a running job counts as abandoned
+JOB_WORKERS = 4
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_DELAY = 30
+JOB_RETRY_MAX_DELAY = 3600
+JOB_LOCK_TIMEOUT = 600
+
+# Emails go through Django's mail settings (EMAIL_BACKEND, EMAIL_HOST, ...)
+DEFAULT_FROM_EMAIL = 'shop@localhost'
+# Admins are alerted when a checkout takes a product's stock to this or below (None = never),
+# at these addresses (None = every admin user with an email)
+LOW_STOCK_THRESHOLD = 5
+LOW_STOCK_ALERT_EMAILS = None
+
+# Online payments (shop/payments.py): the gateway class, the secret its webhooks are signed with
+# (the SECRET_KEY when empty) and how old a webhook signature may be in seconds
+PAYMENT_GATEWAY = 'shop.payments.SimulatorGateway'
+PAYMENT_WEBHOOK_SECRET = ''
+PAYMENT_WEBHOOK_TOLERANCE = 300
+
+# Boundaries of the price facet buckets on the product listing, the last bucket is open ended
+PRODUCT_PRICE_BUCKETS = [0, 50, 100, 500, 1000]
+
 from datetime import timedelta
 
 SIMPLE_JWT = {
@@ -62,6 +122,8 @@ SIMPLE_JWT = {
 }
 
 MIDDLEWARE = [
+    # First, so its timings cover the whole stack
+    'shop.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -110,9 +172,66 @@ DATABASES = {
     }
 }
 
+# SHOP_DB=sqlite switches to a local SQLite file, e.g. to run the benchmarks without PostgreSQL
+if os.environ.get('SHOP_DB') == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+        }
+    }
+
+# Cache
+# Catalog payloads are cached here, point CATALOG_CACHE_ALIAS at redis/memcached in production
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'ecommerce-cache',
+    }
+}
+
+CATALOG_CACHE_ALIAS = 'default'
+CATALOG_CACHE_TIMEOUT = 300  # seconds a payload is served as fresh
+CATALOG_CACHE_GRACE = 60  # seconds a stale payload may still be served while one worker rebuilds it
+
+# Where carts live: 'shop.carts.DatabaseCartStore' writes every change to Order/OrderItem,
+# 'shop.carts.CacheCartStore' keeps them in the cache and writes behind every CART_FLUSH_INTERVAL seconds
+CART_STORE = 'shop.carts.DatabaseCartStore'
+CART_FLUSH_INTERVAL = 30
+CART_CACHE_TIMEOUT = 7 * 24 * 3600
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
+# Password hashing policy: the first hasher hashes new passwords, the others only verify old
+# hashes. Hashes made with another hasher or cost are upgraded on the user's next login.
+PASSWORD_HASHERS = [
+    'shop.hashers.ConfigurablePBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+if find_spec('argon2'):
+    PASSWORD_HASHERS.insert(0, 'shop.hashers.ConfigurableArgon2PasswordHasher')
+PBKDF2_ITERATIONS = 1_000_000
+ARGON2_TIME_COST = 2
+ARGON2_MEMORY_COST = 102400  # KiB
+ARGON2_PARALLELISM = 8
+
+# Login rate limits as (attempts, seconds): every attempt counts per client IP,
+# failed ones per username. Checked before the password is hashed.
+LOGIN_RATE_LIMITS = {
+    'ip': (20, 60),
+    'username': (5, 300),
+}
+LOGIN_HASH_WORKERS = None  # concurrent password hashes per process, None = min(4, CPU count)
+LOGIN_HASH_QUEUE = 64  # logins allowed to wait for a hashing slot before answering 503
+LOGIN_HASH_WAIT = 10  # seconds a sync login waits for a slot
+
+# Route names served by the ASGI-native views in shop/async_views.py when running under ASGI:
+# 'login', 'products', 'product-detail', 'categories', 'cart-api', 'orders'
+ASYNC_VIEWS = []
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
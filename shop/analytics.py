@@ -0,0 +1,263 @@
+"""
+Sales analytics for the admin dashboard.
+
+Everything is aggregated in the database. The live source groups the
+checked-out orders and their items with TruncDate/TruncMonth, which reads
+every order in the range. The rollup source reads DailySales and
+DailyProductSales instead, one row per day and status pair or per day and
+product, so a year of history is a few thousand rows whatever the order
+volume.
+
+The rollups are kept current incrementally: the Order signals in
+shop/signals.py call record_change() with the order's state before and
+after every save or delete, and the difference is applied with F()
+increments in the same transaction. Checked-out orders are assumed to keep
+their items (prices are snapshotted at checkout). Anything written around
+the model (bulk_create, queryset.update, raw SQL) is repaired by the
+rebuild_sales_rollup command, which recomputes the rollups from the orders.
+"""
+import datetime
+from collections import namedtuple
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, Count, DateField, DecimalField, F, IntegerField, Sum, Value, When
+from django.db.models.functions import Coalesce, TruncDate, TruncMonth
+from django.utils import timezone
+
+from .filters import day_bounds
+from .models import DailyProductSales, DailySales, Order, OrderItem
+
+CANCELLED = 'cancelled'
+CENT = Decimal('0.01')
+MAX_TOP = 100
+
+# What an order contributes to DailySales, None while it is a cart
+SalesState = namedtuple('SalesState', 'day status payment_status revenue items')
+
+
+class InvalidRange(ValueError):
+    pass
+
+
+def _parse_date(params, name):
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise InvalidRange(f'{name} must be a date as YYYY-MM-DD')
+
+
+def parse_sales_params(params):
+    """Read date_from/date_to/top/source from query params, raises InvalidRange"""
+    date_from, date_to = _parse_date(params, 'date_from'), _parse_date(params, 'date_to')
+    if date_from and date_to and date_from > date_to:
+        raise InvalidRange('date_from must not be after date_to')
+    try:
+        top = int(params.get('top') or 10)
+    except ValueError:
+        raise InvalidRange('top must be a number')
+    if not 1 <= top <= MAX_TOP:
+        raise InvalidRange(f'top must be between 1 and {MAX_TOP}')
+    source = params.get('source') or 'rollup'
+    if source not in ('rollup', 'live'):
+        raise InvalidRange('source must be rollup or live')
+    return {'date_from': date_from, 'date_to': date_to, 'top': top, 'source': source}
+
+
+def _day_range(date_from, date_to):
+    bounds = {}
+    if date_from:
+        bounds['day__gte'] = date_from
+    if date_to:
+        bounds['day__lte'] = date_to
+    return bounds
+
+
+def _money(value):
+    return str(Decimal(value or 0).quantize(CENT))
+
+
+def sales_summary(date_from=None, date_to=None, top=10, source='rollup'):
+    """Revenue per day and month, order counts per status, best sellers and average order value"""
+    if source == 'rollup':
+        # Rows emptied by cancellations and deletes stay behind at zero
+        orders = DailySales.objects.filter(orders__gt=0, **_day_range(date_from, date_to))
+        lines = DailyProductSales.objects.filter(quantity__gt=0, **_day_range(date_from, date_to))
+        day, month = F('day'), TruncMonth('day')
+        measures = {'order_count': Sum('orders'), 'revenue_sum': Sum('revenue'), 'item_count': Sum('items')}
+    else:
+        orders = Order.objects.filter(is_checked_out=True, **day_bounds(date_from, date_to, 'created_at'))
+        lines = OrderItem.objects.filter(
+            order__is_checked_out=True, **day_bounds(date_from, date_to, 'order__created_at'),
+        ).exclude(order__status=CANCELLED)
+        day, month = TruncDate('created_at'), TruncMonth('created_at', output_field=DateField())
+        measures = {'order_count': Count('id'), 'revenue_sum': Sum('total_price'), 'item_count': Sum('total_items')}
+
+    orders = orders.order_by()
+    # Cancelled orders are counted per status but earn nothing
+    sales = orders.exclude(status=CANCELLED)
+    totals = sales.aggregate(**measures)
+    count, revenue = totals['order_count'] or 0, totals['revenue_sum'] or Decimal('0')
+
+    by_status = {choice: 0 for choice, _ in Order.STATUS_CHOICES}
+    by_status.update(orders.values('status').annotate(n=measures['order_count']).values_list('status', 'n'))
+    by_payment = {choice: 0 for choice, _ in Order.PAYMENT_STATUS}
+    by_payment.update(sales.values('payment_status').annotate(n=measures['order_count']).values_list('payment_status', 'n'))
+
+    def series(bucket):
+        return sales.annotate(bucket=bucket).values('bucket').annotate(
+            order_count=measures['order_count'], revenue_sum=measures['revenue_sum'],
+        ).order_by('bucket')
+
+    best_sellers = lines.values('product_id', 'product__title').annotate(
+        units=Sum('quantity'), sales=Sum('line_total' if source == 'live' else 'revenue'),
+    ).order_by('-units', '-sales', 'product_id')[:top]
+
+    return {
+        'date_from': date_from,
+        'date_to': date_to,
+        'source': source,
+        'totals': {
+            'orders': count,
+            'items': totals['item_count'] or 0,
+            'revenue': _money(revenue),
+            'average_order_value': _money(revenue / count if count else 0),
+        },
+        'orders_by_status': by_status,
+        'orders_by_payment_status': by_payment,
+        'daily': [
+            {'date': row['bucket'], 'orders': row['order_count'], 'revenue': _money(row['revenue_sum'])}
+            for row in series(day)
+        ],
+        'monthly': [
+            {'month': row['bucket'].strftime('%Y-%m'), 'orders': row['order_count'], 'revenue': _money(row['revenue_sum'])}
+            for row in series(month)
+        ],
+        'best_sellers': [
+            {'product_id': row['product_id'], 'title': row['product__title'],
+             'quantity': row['units'], 'revenue': _money(row['sales'])}
+            for row in best_sellers
+        ],
+    }
+
+
+# Incremental maintenance
+
+def order_state(order):
+    if not order.is_checked_out:
+        return None
+    return SalesState(timezone.localdate(order.created_at), order.status, order.payment_status,
+                      Decimal(order.total_price), order.total_items)
+
+
+def stored_state(order):
+    """State of the order as currently stored, one query (none for new orders and carts)"""
+    if order.pk is None or order._state.adding or not order.is_checked_out:
+        return None
+    row = Order.objects.filter(pk=order.pk, is_checked_out=True).values_list(
+        'created_at', 'status', 'payment_status', 'total_price', 'total_items').first()
+    if row is None:
+        return None
+    created_at, status, payment_status, total_price, total_items = row
+    return SalesState(timezone.localdate(created_at), status, payment_status, Decimal(total_price), total_items)
+
+
+def _shift_sales(state, sign):
+    key = {'day': state.day, 'status': state.status, 'payment_status': state.payment_status}
+    if sign > 0:
+        # Make sure the row exists, concurrent writers then only ever UPDATE it
+        DailySales.objects.bulk_create([DailySales(**key)], ignore_conflicts=True)
+    DailySales.objects.filter(**key).update(
+        orders=F('orders') + sign,
+        items=F('items') + sign * state.items,
+        revenue=F('revenue') + sign * state.revenue,
+    )
+
+
+def _order_lines(order):
+    """[(product_id, quantity, revenue)] of the order, one query"""
+    return list(order.items.order_by().values('product_id').annotate(
+        units=Sum('quantity'), sales=Coalesce(Sum('line_total'), Value(Decimal('0')), output_field=DecimalField()),
+    ).values_list('product_id', 'units', 'sales'))
+
+
+def _shift_products(day, lines, sign):
+    if not lines:
+        return
+    if sign > 0:
+        DailyProductSales.objects.bulk_create(
+            [DailyProductSales(day=day, product_id=product_id) for product_id, _, _ in lines], ignore_conflicts=True)
+    # One UPDATE for all the products of the order
+    quantity = Case(*[When(product_id=product_id, then=Value(sign * units)) for product_id, units, _ in lines],
+                    default=Value(0), output_field=IntegerField())
+    revenue = Case(*[When(product_id=product_id, then=Value(sign * sales)) for product_id, _, sales in lines],
+                   default=Value(Decimal('0')), output_field=DecimalField(max_digits=14, decimal_places=2))
+    DailyProductSales.objects.filter(day=day, product_id__in=[line[0] for line in lines]).update(
+        quantity=F('quantity') + quantity, revenue=F('revenue') + revenue)
+
+
+def _recount_products(order, day):
+    """Recompute the day's cells for the order's products, for the rare edit of a counted order"""
+    product_ids = list(order.items.values_list('product_id', flat=True).distinct())
+    rows = OrderItem.objects.filter(
+        product_id__in=product_ids, order__is_checked_out=True, **day_bounds(day, day, 'order__created_at'),
+    ).exclude(order__status=CANCELLED).order_by().values('product_id').annotate(
+        units=Sum('quantity'), sales=Coalesce(Sum('line_total'), Value(Decimal('0')), output_field=DecimalField()),
+    ).values_list('product_id', 'units', 'sales')
+    counted = {product_id: (units, sales) for product_id, units, sales in rows}
+    DailyProductSales.objects.filter(day=day, product_id__in=product_ids).delete()
+    DailyProductSales.objects.bulk_create([
+        DailyProductSales(day=day, product_id=product_id, quantity=units, revenue=sales)
+        for product_id, (units, sales) in counted.items()
+    ])
+
+
+def _counted(state):
+    return state is not None and state.status != CANCELLED
+
+
+def record_change(order, before, after):
+    """Apply the move of an order from state `before` to `after` to the rollups"""
+    if before == after:
+        return
+    with transaction.atomic():
+        if before is not None:
+            _shift_sales(before, -1)
+        if after is not None:
+            _shift_sales(after, +1)
+
+        if _counted(before) and _counted(after):
+            if (before.day, before.revenue, before.items) != (after.day, after.revenue, after.items):
+                for day in {before.day, after.day}:
+                    _recount_products(order, day)
+        elif _counted(before) or _counted(after):
+            state = before if _counted(before) else after
+            _shift_products(state.day, _order_lines(order), 1 if _counted(after) else -1)
+
+
+def rebuild_rollups(date_from=None, date_to=None):
+    """Recompute the rollups of the given days (all of them by default) from the orders"""
+    orders = Order.objects.filter(is_checked_out=True, **day_bounds(date_from, date_to, 'created_at')).order_by()
+    lines = OrderItem.objects.filter(
+        order__is_checked_out=True, **day_bounds(date_from, date_to, 'order__created_at'),
+    ).exclude(order__status=CANCELLED).order_by()
+
+    with transaction.atomic():
+        DailySales.objects.filter(**_day_range(date_from, date_to)).delete()
+        DailyProductSales.objects.filter(**_day_range(date_from, date_to)).delete()
+        sales = DailySales.objects.bulk_create([
+            DailySales(day=row['bucket'], status=row['status'], payment_status=row['payment_status'],
+                       orders=row['order_count'], items=row['item_count'] or 0, revenue=row['revenue_sum'] or 0)
+            for row in orders.annotate(bucket=TruncDate('created_at')).values('bucket', 'status', 'payment_status').annotate(
+                order_count=Count('id'), item_count=Sum('total_items'), revenue_sum=Sum('total_price'))
+        ], batch_size=1000)
+        products = DailyProductSales.objects.bulk_create([
+            DailyProductSales(day=row['bucket'], product_id=row['product_id'],
+                              quantity=row['units'], revenue=row['sales'] or 0)
+            for row in lines.annotate(bucket=TruncDate('order__created_at')).values('bucket', 'product_id').annotate(
+                units=Sum('quantity'), sales=Sum('line_total'))
+        ], batch_size=1000)
+    return len(sales), len(products)
@@ -4,3 +4,14 @@ from django.apps import AppConfig
 class ShopConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'shop'
+
+    def ready(self):
+        from django.db import connections
+        from django.db.backends.signals import connection_created
+
+        from . import signals  # noqa: F401
+        from .metrics import install_query_recorder
+
+        connection_created.connect(install_query_recorder, dispatch_uid='shop.metrics')
+        for connection in connections.all(initialized_only=True):
+            install_query_recorder(connection=connection)
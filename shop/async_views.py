@@ -0,0 +1,225 @@
+"""
+ASGI-native views.
+
+DRF's APIView is sync only, under ASGI every such request runs on a thread
+handed out by asgiref. The views here are plain async Django views with the
+same URLs and payloads, reading through the async ORM (aget, afirst,
+async for). Serializers only run on rows that are fully loaded, so they
+never touch the database from the event loop.
+
+shop/urls.py picks them per route through the ASYNC_VIEWS setting. A view
+only implements the reads, every other method of the route is handed to
+the sync view it replaces.
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from django.http import JsonResponse
+from django.utils.decorators import classonlymethod
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import APIException, AuthenticationFailed, NotAuthenticated, NotFound
+from rest_framework.request import Request
+from rest_framework.throttling import BaseThrottle
+from rest_framework.utils.encoders import JSONEncoder
+
+from . import conditional, login, metrics
+from .authentication import ClaimsJWTAuthentication
+from .cache import CATALOG, PRODUCT_LISTS, acached
+from .carts import get_cart_store
+from .filters import InvalidFilter, aproduct_facets, filter_products, parse_product_filters
+from .models import Category, Order, Product
+from .pagination import KeysetPagination
+from .projection import InvalidProjection, OrderProjection, ProductProjection
+from .serializers import CategorySerializer, LoginSerializer, ProductSerializer
+from .views import CartAPI, CategoryCreateOrListView, OrderListAPIView, ProductDetailOrDeleteView, ProductListCreateAPIView
+
+
+def json_response(data, status=200):
+    # DRF's encoder, so numbers and dates come out exactly as from the sync views
+    with metrics.serialization():
+        return JsonResponse(data, status=status, encoder=JSONEncoder, safe=False)
+
+
+class AsyncAPIView(View):
+    """
+    Authenticates the bearer token like the DRF views do and answers API
+    errors in DRF's {"detail": ...} shape. Methods without an async handler
+    go to `sync_view`.
+    """
+    sync_view = None
+    sync_handler = None
+    require_authentication = False
+    authentication = ClaimsJWTAuthentication()
+
+    @classonlymethod
+    def as_view(cls, **initkwargs):
+        if cls.sync_view is not None:
+            initkwargs.setdefault('sync_handler', sync_to_async(cls.sync_view.as_view()))
+        # Token authenticated API, same as DRF's APIView
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        if self.sync_handler is not None and not hasattr(self, request.method.lower()):
+            return await self.sync_handler(request, *args, **kwargs)
+        try:
+            result = await self.authentication.aauthenticate(request)
+            request.user, request.auth = result or (AnonymousUser(), None)
+            if self.require_authentication and not request.user.is_authenticated:
+                raise NotAuthenticated()
+            return await super().dispatch(request, *args, **kwargs)
+        except APIException as exc:
+            return self.error(exc)
+
+    def error(self, exc):
+        data = exc.detail if isinstance(exc.detail, dict) else {'detail': exc.detail}
+        response = json_response(data, status=exc.status_code)
+        if isinstance(exc, (AuthenticationFailed, NotAuthenticated)):
+            response['WWW-Authenticate'] = self.authentication.authenticate_header(request=None)
+        return response
+
+    @staticmethod
+    def request_data(request):
+        if request.content_type == 'application/json':
+            try:
+                return json.loads(request.body or b'{}')
+            except ValueError:
+                return None
+        return request.POST
+
+
+class AsyncLoginView(AsyncAPIView):
+    """Same contract as LoginView, the password check runs on the login hashing pool"""
+
+    async def post(self, request):
+        data = self.request_data(request)
+        if not isinstance(data, dict) and not hasattr(data, 'getlist'):
+            return json_response({"error": "Invalid JSON body"}, status=400)
+
+        username = str(data.get('username', ''))
+        try:
+            login.check_rate(BaseThrottle().get_ident(request), username)
+        except login.LoginThrottled as exc:
+            response = json_response({"error": "Too many login attempts, try again later"}, status=429)
+            response['Retry-After'] = str(exc.retry_after)
+            return response
+
+        serializer = LoginSerializer(data=data)
+        try:
+            valid = await login.run_in_pool(serializer.is_valid)
+        except login.LoginBusy:
+            response = json_response({"error": "Login is busy, try again shortly"}, status=503)
+            response['Retry-After'] = '1'
+            return response
+
+        if valid:
+            login.record_success(username)
+            return json_response(serializer.validated_data)
+
+        if 'non_field_errors' in serializer.errors:
+            login.record_failure(username)
+        return json_response(serializer.errors, status=401)
+
+
+class AsyncProductListView(AsyncAPIView):
+    sync_view = ProductListCreateAPIView
+    pagination_class = KeysetPagination
+
+    async def get(self, request):
+        if request.GET.get('export') == 'ndjson':
+            # Streaming export stays on the sync view
+            return await self.sync_handler(request)
+        fingerprint = await conditional.aproduct_list_fingerprint(request)
+        return await conditional.respond(request, fingerprint, lambda: self.product_list(request))
+
+    async def product_list(self, request):
+        try:
+            filters = parse_product_filters(request.GET)
+        except InvalidFilter as exc:
+            return json_response({'error': str(exc)}, status=400)
+        try:
+            projection = ProductProjection.from_params(request.GET)
+        except InvalidProjection as exc:
+            return json_response({'error': str(exc)}, status=400)
+        products = filter_products(Product.objects.select_related('category'), **filters)
+        payload = await acached(PRODUCT_LISTS, f'products:{request.build_absolute_uri()}',
+                                lambda: self.build_page(request, products, projection, filters))
+        return json_response(payload)
+
+    async def build_page(self, request, products, projection, filters=None):
+        filters = filters or {}
+        filtered = any(value is not None for value in filters.values())
+        paginator = self.pagination_class()
+        page = await paginator.apaginate_queryset(projection.values(products), Request(request), view=self)
+        if page or paginator.has_cursor or filtered:
+            data = paginator.get_paginated_data(await projection.arender(page))
+            return {
+                "message": f"{len(page)} products on this page",
+                "product_list": data.pop('results'),
+                **data,
+                "facets": await aproduct_facets(Product.objects.all(), **filters),
+            }
+        return {"message": "There is no prodcts please Add some"}
+
+
+class AsyncProductDetailView(AsyncAPIView):
+    sync_view = ProductDetailOrDeleteView
+
+    async def get(self, request, pk):
+        fingerprint = await conditional.aproduct_detail_fingerprint(request, pk)
+        return await conditional.respond(request, fingerprint, lambda: self.product(pk))
+
+    async def product(self, pk):
+        async def build():
+            product = await Product.objects.select_related('category').aget(pk=pk)
+            return ProductSerializer(product).data
+        try:
+            return json_response(await acached(CATALOG, f'product:{pk}', build))
+        except Product.DoesNotExist:
+            raise NotFound("No Product matches the given query.")
+
+
+class AsyncCategoryListView(AsyncAPIView):
+    sync_view = CategoryCreateOrListView
+    require_authentication = True
+
+    async def get(self, request):
+        fingerprint = await conditional.acategory_list_fingerprint(request)
+        return await conditional.respond(request, fingerprint, self.category_list)
+
+    async def category_list(self):
+        return json_response(await acached(CATALOG, 'categories', self.build_payload))
+
+    async def build_payload(self):
+        categories = [category async for category in Category.objects.all()]
+        return {
+            "message": "Here is the List of Categories",
+            'categories': CategorySerializer(categories, many=True).data,
+            'total': len(categories)
+        }
+
+
+class AsyncCartView(AsyncAPIView):
+    sync_view = CartAPI
+    require_authentication = True
+
+    async def get(self, request):
+        fingerprint = await conditional.acart_fingerprint(request)
+        return await conditional.respond(request, fingerprint, lambda: self.cart(request))
+
+    async def cart(self, request):
+        return json_response(await get_cart_store().get_cart(request.user).adata())
+
+
+class AsyncOrderListView(AsyncAPIView):
+    sync_view = OrderListAPIView
+    require_authentication = True
+
+    async def get(self, request):
+        try:
+            projection = OrderProjection.from_params(request.GET, checked_out=True)
+        except InvalidProjection as exc:
+            return json_response({'error': str(exc)}, status=400)
+        orders = Order.objects.filter(customer_id=request.user.pk, is_checked_out=True).order_by('-created_at')
+        return json_response(await projection.aproject(orders))
@@ -0,0 +1,149 @@
+"""
+JWT authentication that trusts the claims put in the token at login.
+
+Most endpoints only look at request.user.id, .role or .is_authenticated, so
+loading the CustomUser row on every request is wasted work. ClaimsUser
+answers those from the token and only fetches the row the first time a view
+needs anything else (an ORM filter on the user, a serializer, ...).
+
+Tokens are revoked by bumping CustomUser.token_version, which is checked
+against a cached copy on every request. Saving a user whose role, staff or
+active flag or password changed bumps it (shop/signals.py). The copy is
+dropped on the process that saved the user and lives for at most
+TOKEN_VERSION_TIMEOUT seconds elsewhere, which bounds how long a revoked
+token keeps working when the cache is local to each process.
+"""
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.db.models import F
+from django.utils.functional import LazyObject, empty
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .cache import get_cache
+
+CLAIMS = ('username', 'role', 'is_staff', 'ver')
+TOKEN_VERSION_TIMEOUT = 30
+
+
+def _version_key(user_id):
+    return f'shop:token_version:{user_id}'
+
+
+def tokens_for(user):
+    """Refresh token carrying the claims ClaimsJWTAuthentication relies on"""
+    refresh = RefreshToken.for_user(user)
+    refresh['username'] = user.username
+    refresh['role'] = user.role
+    refresh['is_staff'] = user.is_staff
+    refresh['ver'] = user.token_version
+    return refresh
+
+
+def current_token_version(user_id):
+    """Token version of an active user, None when the user is gone or inactive"""
+    cache = get_cache()
+    version = cache.get(_version_key(user_id))
+    if version is None:
+        row = get_user_model().objects.filter(pk=user_id, is_active=True).values_list('token_version', flat=True).first()
+        version = -1 if row is None else row
+        cache.set(_version_key(user_id), version, timeout=TOKEN_VERSION_TIMEOUT)
+    return None if version == -1 else version
+
+
+async def acurrent_token_version(user_id):
+    """current_token_version() for async views"""
+    cache = get_cache()
+    version = cache.get(_version_key(user_id))
+    if version is None:
+        row = await get_user_model().objects.filter(pk=user_id, is_active=True).values_list('token_version', flat=True).afirst()
+        version = -1 if row is None else row
+        cache.set(_version_key(user_id), version, timeout=TOKEN_VERSION_TIMEOUT)
+    return None if version == -1 else version
+
+
+def revoke_tokens(user):
+    """Invalidate every token issued to the user so far"""
+    get_user_model().objects.filter(pk=user.pk).update(token_version=F('token_version') + 1)
+    forget_token_version(user.pk)
+
+
+def forget_token_version(user_id):
+    get_cache().delete(_version_key(user_id))
+
+
+class ClaimsUser(LazyObject):
+    """The authenticated user as described by the token, the row is loaded on demand"""
+
+    def __init__(self, token):
+        self.__dict__['_token'] = token
+        super().__init__()
+
+    def _setup(self):
+        self._wrapped = get_user_model().objects.get(pk=self.id)
+
+    @property
+    def loaded(self):
+        return self._wrapped is not empty
+
+    @property
+    def id(self):
+        # The claim may hold the id as a string, give it the primary key's type
+        return get_user_model()._meta.pk.to_python(self._token[api_settings.USER_ID_CLAIM])
+
+    pk = id
+
+    @property
+    def username(self):
+        return self._token['username']
+
+    @property
+    def role(self):
+        return self._token['role']
+
+    @property
+    def is_staff(self):
+        return self._token['is_staff']
+
+    is_authenticated = True
+    is_anonymous = False
+    is_active = True
+
+    def __bool__(self):
+        return True
+
+    def __str__(self):
+        return self.username
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        if any(claim not in validated_token for claim in CLAIMS):
+            # Issued before the claims existed, fall back to the database
+            return super().get_user(validated_token)
+        return self.claims_user(validated_token, current_token_version(validated_token[api_settings.USER_ID_CLAIM]))
+
+    def claims_user(self, validated_token, version):
+        if version is None:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+        if version != validated_token['ver']:
+            raise AuthenticationFailed(_("Token has been revoked"), code="token_revoked")
+        return ClaimsUser(validated_token)
+
+    async def aauthenticate(self, request):
+        """authenticate() for async views, (user, token) or None without credentials"""
+        header = self.get_header(request)
+        if header is None:
+            return None
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+        validated_token = self.get_validated_token(raw_token)
+
+        if any(claim not in validated_token for claim in CLAIMS):
+            return await sync_to_async(super().get_user)(validated_token), validated_token
+        version = await acurrent_token_version(validated_token[api_settings.USER_ID_CLAIM])
+        return self.claims_user(validated_token, version), validated_token
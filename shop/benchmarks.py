@@ -0,0 +1,175 @@
+"""
+Synthetic data and measurement helpers for the API benchmarks.
+
+seed_dataset() bulk-inserts users, categories, products and checked-out
+orders with items (price snapshot included) and shipping addresses, then
+rebuilds the sales rollups. The benchmark commands run it inside a
+transaction they roll back, so nothing is left behind on SQLite or
+PostgreSQL.
+"""
+import math
+import random
+import time
+import tracemalloc
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.db import connection
+
+from .analytics import rebuild_rollups
+from .models import Category, CustomUser, Order, OrderItem, Product, ShippingAddress
+
+PREFIX = 'bench'
+PASSWORD = 'bench-pass-12345'
+
+SCALES = {
+    'small': {'users': 20, 'categories': 5, 'products': 200, 'orders': 200, 'items': 3},
+    'medium': {'users': 200, 'categories': 20, 'products': 5000, 'orders': 5000, 'items': 4},
+    'large': {'users': 2000, 'categories': 50, 'products': 50000, 'orders': 100000, 'items': 4},
+}
+
+
+def seed_dataset(users, categories, products, orders, items, seed=0, batch_size=2000):
+    """
+    Create the dataset and return {'admin', 'customers', 'products'}.
+    Orders are spread round robin over the customers, so the first one
+    has the most. Every tenth product is out of stock.
+    """
+    rng = random.Random(seed)
+    password = make_password(PASSWORD)
+
+    admin = CustomUser.objects.create(username=f'{PREFIX}-admin', email=f'{PREFIX}-admin@example.com',
+                                      password=password, role='admin')
+    customers = CustomUser.objects.bulk_create([
+        CustomUser(username=f'{PREFIX}-user-{i}', email=f'{PREFIX}-user-{i}@example.com', password=password)
+        for i in range(users)
+    ], batch_size=batch_size)
+
+    category_rows = Category.objects.bulk_create([
+        Category(name=f'Bench category {i}', slug=f'{PREFIX}-category-{i}') for i in range(categories)
+    ])
+    product_rows = Product.objects.bulk_create([
+        Product(category=category_rows[i % categories], title=f'Bench product {i}', slug=f'{PREFIX}-product-{i}',
+                description=f'Synthetic product number {i}', price=Decimal(rng.randint(100, 200000)) / 100,
+                stock=0 if i % 10 == 9 else 1_000_000)
+        for i in range(products)
+    ], batch_size=batch_size)
+
+    statuses = [choice for choice, _ in Order.STATUS_CHOICES]
+    payment_statuses = [choice for choice, _ in Order.PAYMENT_STATUS]
+    for start in range(0, orders, batch_size):
+        chunk = range(start, min(start + batch_size, orders))
+        lines = {i: rng.sample(product_rows, min(items, len(product_rows))) for i in chunk}
+        quantities = {i: [rng.randint(1, 3) for _ in lines[i]] for i in chunk}
+        order_rows = Order.objects.bulk_create([
+            Order(
+                customer=customers[i % users],
+                is_checked_out=True,
+                status=rng.choice(statuses),
+                payment_status=rng.choice(payment_statuses),
+                total_items=sum(quantities[i]),
+                total_price=sum((p.price * q for p, q in zip(lines[i], quantities[i])), Decimal('0.00')),
+            )
+            for i in chunk
+        ])
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=quantity, product_title=product.title,
+                      unit_price=product.price, line_total=product.price * quantity)
+            for order, i in zip(order_rows, chunk)
+            for product, quantity in zip(lines[i], quantities[i])
+        ])
+        ShippingAddress.objects.bulk_create([
+            ShippingAddress(user_id=order.customer_id, order=order, address=f'Road {i}', city='Dhaka', zip_code='1200')
+            for order, i in zip(order_rows, chunk)
+        ])
+    # bulk_create skips the signals that keep the sales rollups current
+    rebuild_rollups()
+
+    return {'admin': admin, 'customers': customers, 'products': product_rows}
+
+
+class QueryCounter:
+    """Execute wrapper counting the queries run on the connection"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def measure(request, iterations, warmup=0, setup=None):
+    """
+    Call request() `iterations` times and return the latencies in ms and
+    the queries of each call. setup(), when given, runs untimed before
+    every call.
+    """
+    for _ in range(warmup):
+        if setup:
+            setup()
+        request()
+    latencies, queries = [], []
+    for _ in range(iterations):
+        if setup:
+            setup()
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            start = time.perf_counter()
+            request()
+            latencies.append((time.perf_counter() - start) * 1000)
+        queries.append(counter.count)
+    return latencies, queries
+
+
+def peak_memory(request, samples, setup=None):
+    """Largest peak of memory allocated during one call, in KiB (tracemalloc slows calls down, so it is a separate pass)"""
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(samples):
+            if setup:
+                setup()
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            request()
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+    return max(peaks) / 1024 if peaks else 0.0
+
+
+def summarize(latencies, queries, memory_kib):
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'queries_per_request': round(sum(queries) / len(queries), 2),
+        'peak_memory_kib': round(memory_kib, 1),
+    }
+
+
+def regressions(baseline, current, tolerance):
+    """
+    Human readable regressions of current results against a baseline.
+    Latency and memory may grow by `tolerance` (0.25 = 25%), queries per
+    request may not grow at all.
+    """
+    found = []
+    for name, result in current.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'peak_memory_kib'):
+            if result[metric] > before[metric] * (1 + tolerance):
+                found.append(f'{name}: {metric} {before[metric]} -> {result[metric]}')
+        if result['queries_per_request'] > before['queries_per_request']:
+            found.append(f"{name}: queries_per_request {before['queries_per_request']} -> {result['queries_per_request']}")
+    return found
@@ -0,0 +1,149 @@
+"""
+Bulk product import and export in CSV or NDJSON.
+
+Rows are read and validated one at a time, valid ones are upserted by slug
+in batches with a single INSERT ... ON CONFLICT per batch, and invalid ones
+are reported with their row number without stopping the import.
+"""
+import csv
+import io
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .cache import CATALOG, invalidate
+from .models import Category, Product
+from .serializers import ProductImportSerializer
+
+FORMATS = ('csv', 'ndjson')
+FIELDS = ['title', 'slug', 'description', 'price', 'stock', 'category']
+UPDATE_FIELDS = ['title', 'description', 'price', 'stock', 'category', 'updated_at']
+MAX_REPORTED_ERRORS = 1000
+
+
+def guess_format(filename):
+    name = (filename or '').lower()
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    return None
+
+
+def read_rows(stream, fmt):
+    """Yield (row number, row dict or None, parse error or None) from a text stream"""
+    if fmt == 'csv':
+        for number, row in enumerate(csv.DictReader(stream), start=1):
+            yield number, row, None
+        return
+    for number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as exc:
+            yield number, None, f'Invalid JSON: {exc}'
+            continue
+        if not isinstance(row, dict):
+            yield number, None, 'Each line must be a JSON object'
+            continue
+        yield number, row, None
+
+
+def text_stream(binary):
+    """Decode an uploaded/opened binary file lazily, without reading it all into memory"""
+    return io.TextIOWrapper(binary, encoding='utf-8-sig', newline='')
+
+
+class ImportReport:
+    def __init__(self):
+        self.rows = 0
+        self.imported = 0
+        self.error_count = 0
+        self.errors = []
+
+    def add_error(self, row, errors):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': row, 'errors': errors})
+
+    def as_dict(self):
+        return {
+            'rows': self.rows,
+            'imported': self.imported,
+            'failed': self.error_count,
+            'errors': self.errors,
+        }
+
+
+def _flush(batch):
+    # A slug repeated within a batch would hit the same row twice in one statement, last one wins
+    products = list({product.slug: product for product in batch}.values())
+    Product.objects.bulk_create(
+        products,
+        update_conflicts=True,
+        unique_fields=['slug'],
+        update_fields=UPDATE_FIELDS,
+    )
+    return len(products)
+
+
+def import_products(stream, fmt, batch_size=1000):
+    """Validate and upsert products from a text stream, returns an ImportReport"""
+    if fmt not in FORMATS:
+        raise ValueError(f'Unsupported format {fmt!r}, use one of {", ".join(FORMATS)}')
+
+    categories = {category.slug: category for category in Category.objects.all()}
+    report = ImportReport()
+    batch = []
+    for number, row, error in read_rows(stream, fmt):
+        report.rows += 1
+        if error:
+            report.add_error(number, {'non_field_errors': [error]})
+            continue
+        serializer = ProductImportSerializer(data=row, context={'categories': categories})
+        if not serializer.is_valid():
+            report.add_error(number, serializer.errors)
+            continue
+        batch.append(Product(**serializer.validated_data))
+        if len(batch) >= batch_size:
+            report.imported += _flush(batch)
+            batch = []
+    if batch:
+        report.imported += _flush(batch)
+
+    if report.imported:
+        # bulk_create sends no signals
+        invalidate(CATALOG)
+    return report
+
+
+def export_products(fmt, queryset=None, chunk_size=2000):
+    """Yield the catalog as CSV or NDJSON text chunks, in the import layout"""
+    if fmt not in FORMATS:
+        raise ValueError(f'Unsupported format {fmt!r}, use one of {", ".join(FORMATS)}')
+    if queryset is None:
+        queryset = Product.objects.all()
+    rows = queryset.order_by('id').values_list(
+        'title', 'slug', 'description', 'price', 'stock', 'category__slug',
+    ).iterator(chunk_size=chunk_size)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(FIELDS)
+
+    pending = 0
+    for row in rows:
+        if writer:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(FIELDS, row)), cls=DjangoJSONEncoder) + '\n')
+        pending += 1
+        if pending >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,153 @@
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+CATALOG = 'catalog'
+# Product list pages, also dropped whenever CATALOG is invalidated
+PRODUCT_LISTS = 'product_lists'
+PARENTS = {PRODUCT_LISTS: CATALOG}
+
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'rebuilds': 0}
+
+
+def get_cache():
+    return caches[getattr(settings, 'CATALOG_CACHE_ALIAS', 'default')]
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def cache_stats():
+    """Hit/miss counters of this process"""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_cache_stats():
+    with _stats_lock:
+        for name in _stats:
+            _stats[name] = 0
+
+
+def _version_key(namespace):
+    return f'shop:{namespace}:version'
+
+
+def namespace_version(namespace):
+    """Current version of a namespace, every cached key embeds it"""
+    cache = get_cache()
+    version = cache.get(_version_key(namespace))
+    if version is None:
+        # Start from the clock so a version lost to eviction never reuses old keys
+        cache.add(_version_key(namespace), time.time_ns(), timeout=None)
+        version = cache.get(_version_key(namespace), time.time_ns())
+    return version
+
+
+def invalidate(namespace=CATALOG):
+    """Drop every key of a namespace at once by moving to a new version"""
+    cache = get_cache()
+    try:
+        cache.incr(_version_key(namespace))
+    except ValueError:
+        cache.set(_version_key(namespace), time.time_ns(), timeout=None)
+
+
+def invalidate_products(product_ids):
+    """
+    Drop what a stock change makes stale: the detail payloads of these
+    products and the list pages. The rest of the catalog stays cached.
+    """
+    get_cache().delete_many([make_key(CATALOG, f'product:{pk}') for pk in product_ids])
+    invalidate(PRODUCT_LISTS)
+
+
+def make_key(namespace, suffix):
+    if len(suffix) > 64:
+        suffix = hashlib.sha1(suffix.encode()).hexdigest()
+    version = namespace_version(namespace)
+    if namespace in PARENTS:
+        version = f'{namespace_version(PARENTS[namespace])}.{version}'
+    return f'shop:{namespace}:{version}:{suffix}'
+
+
+def _settings(timeout):
+    if timeout is None:
+        timeout = getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300)
+    return timeout, getattr(settings, 'CATALOG_CACHE_GRACE', 60)
+
+
+def _lookup(cache, key, grace):
+    """(True, value) when the cached value can be served, (False, holds the rebuild lock) otherwise"""
+    entry = cache.get(key)
+    if entry is not None:
+        fresh_until, value = entry
+        if time.time() < fresh_until:
+            _count('hits')
+            return True, value
+        if not cache.add(key + ':lock', 1, timeout=grace):
+            _count('stale_hits')
+            return True, value
+        locked = True
+    else:
+        # Nothing to fall back on, build it even if someone else already is
+        _count('misses')
+        locked = cache.add(key + ':lock', 1, timeout=grace)
+    _count('rebuilds')
+    return False, locked
+
+
+def _store(cache, key, value, timeout, grace):
+    cache.set(key, (time.time() + timeout, value), timeout=timeout + grace)
+
+
+def cached(namespace, suffix, builder, timeout=None):
+    """
+    Read-through cache for a serialized payload.
+
+    Entries are stored as (fresh_until, value) and kept for a grace period
+    after they go stale. When an entry is stale, the first worker to grab
+    the rebuild lock recomputes it while everyone else keeps serving the
+    stale value, so an expiring hot key does not send every worker to the
+    database at once.
+    """
+    cache = get_cache()
+    timeout, grace = _settings(timeout)
+    key = make_key(namespace, suffix)
+    found, result = _lookup(cache, key, grace)
+    if found:
+        return result
+    try:
+        value = builder()
+        _store(cache, key, value, timeout, grace)
+    finally:
+        if result:
+            cache.delete(key + ':lock')
+    return value
+
+
+async def acached(namespace, suffix, builder, timeout=None):
+    """
+    cached() for async views, builder is a coroutine function. The cache
+    calls themselves stay synchronous: they are short round trips, while
+    the async cache API would hop to a thread for each of them.
+    """
+    cache = get_cache()
+    timeout, grace = _settings(timeout)
+    key = make_key(namespace, suffix)
+    found, result = _lookup(cache, key, grace)
+    if found:
+        return result
+    try:
+        value = await builder()
+        _store(cache, key, value, timeout, grace)
+    finally:
+        if result:
+            cache.delete(key + ':lock')
+    return value
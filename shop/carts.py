@@ -0,0 +1,470 @@
+"""
+Cart stores behind CartAPI.
+
+DatabaseCartStore (the default) keeps the cart as the user's open Order and
+its OrderItems, exactly as before. CacheCartStore keeps the cart lines as a
+compact {product id: quantity} dict in the cache and only writes them to
+Order/OrderItem when the cart is checked out or when the write-behind flush
+runs, which takes the highest-write path in the shop off the database.
+
+Pick one with the CART_STORE setting.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections, transaction
+from django.db.models import F, Max
+from django.utils.module_loading import import_string
+
+from .cache import CATALOG, get_cache, namespace_version
+from .loaders import order_queryset
+from .models import Order, OrderItem, Product
+from .serializers import OrderSerializer
+
+
+def apply_operation(quantities, operation):
+    """Apply one validated cart operation to a {product id: quantity} map"""
+    product_id, quantity = operation['product_id'], operation['quantity']
+    if operation['op'] == 'add':
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+    elif operation['op'] == 'set' and quantity:
+        quantities[product_id] = quantity
+    else:
+        quantities.pop(product_id, None)
+
+
+class DatabaseCart:
+    """The user's open Order, every change is written straight away"""
+
+    def __init__(self, user):
+        self.user = user
+
+    def order(self):
+        order, created = order_queryset().get_or_create(customer=self.user, is_checked_out=False)
+        return order
+
+    def data(self):
+        return OrderSerializer(self.order()).data
+
+    async def adata(self):
+        """data() for async views"""
+        queryset = order_queryset().filter(customer_id=self.user.pk, is_checked_out=False)
+        order = await queryset.afirst()
+        if order is None:
+            await Order.objects.aget_or_create(customer_id=self.user.pk, is_checked_out=False)
+            order = await queryset.afirst()
+        return OrderSerializer(order).data
+
+    def add(self, product, quantity):
+        if quantity < 1:
+            raise ValueError('The quantity must be at least 1')
+        order, created = Order.objects.get_or_create(customer=self.user, is_checked_out=False)
+        with transaction.atomic():
+            item, created = OrderItem.objects.get_or_create(order=order, product=product, defaults={'quantity': quantity})
+            if not created:
+                # In the database, so concurrent adds of the same product all count
+                OrderItem.objects.filter(pk=item.pk).update(quantity=F('quantity') + quantity)
+            order.adjust_totals(quantity, product.price * quantity)
+
+    def line_id(self, product_id):
+        """Id of the line holding the product, None when it is not in the cart"""
+        try:
+            return OrderItem.objects.filter(
+                order__customer=self.user, order__is_checked_out=False, product_id=product_id,
+            ).values_list('id', flat=True).first()
+        except (TypeError, ValueError):
+            return None
+
+    def _item(self, item_id):
+        """The locked cart line, must run in a transaction"""
+        try:
+            # Lock the line only, not the order or the product
+            return OrderItem.objects.select_related('order', 'product').select_for_update(of=('self',)).get(
+                id=item_id, order__customer=self.user, order__is_checked_out=False)
+        except (OrderItem.DoesNotExist, ValueError):
+            return None
+
+    def set_quantity(self, item_id, quantity):
+        if quantity < 0:
+            raise ValueError('The quantity can not be negative')
+        if quantity == 0:
+            return self.remove(item_id)
+        with transaction.atomic():
+            item = self._item(item_id)
+            if item is None:
+                return False
+            delta = quantity - item.quantity
+            item.quantity = quantity
+            item.save(update_fields=['quantity'])
+            item.order.adjust_totals(delta, item.product.price * delta)
+        return True
+
+    def remove(self, item_id):
+        with transaction.atomic():
+            item = self._item(item_id)
+            if item is None:
+                return False
+            item.delete()
+            item.order.adjust_totals(-item.quantity, -item.product.price * item.quantity)
+        return True
+
+    def apply(self, operations, products):
+        """
+        Run a batch of add/set/remove operations (keyed by product id) in one
+        transaction: one read of the affected lines, then at most one bulk
+        insert, one bulk update, one delete and one totals update.
+        """
+        with transaction.atomic():
+            order, created = Order.objects.get_or_create(customer=self.user, is_checked_out=False)
+            items = {item.product_id: item for item in order.items.select_for_update().filter(product_id__in=products)}
+            quantities = {product_id: item.quantity for product_id, item in items.items()}
+            before = dict(quantities)
+            for operation in operations:
+                apply_operation(quantities, operation)
+
+            new, changed, removed = [], [], []
+            total_quantity, total_amount = 0, Decimal('0.00')
+            for product_id in set(before) | set(quantities):
+                old, current = before.get(product_id, 0), quantities.get(product_id, 0)
+                if old == current:
+                    continue
+                total_quantity += current - old
+                total_amount += products[product_id].price * (current - old)
+                if not current:
+                    removed.append(items[product_id].pk)
+                elif product_id in items:
+                    items[product_id].quantity = current
+                    changed.append(items[product_id])
+                else:
+                    new.append(OrderItem(order=order, product_id=product_id, quantity=current))
+
+            OrderItem.objects.bulk_create(new)
+            OrderItem.objects.bulk_update(changed, ['quantity'])
+            if removed:
+                OrderItem.objects.filter(pk__in=removed).delete()
+            if new or changed or removed:
+                # Even when the totals don't move (a swap at the same price), updated_at must, it is the cart's ETag
+                order.adjust_totals(total_quantity, total_amount)
+
+    def persist(self):
+        """Make sure the cart is in the database, already the case here"""
+
+    def clear(self):
+        """Forget the cart after checkout, the checked-out order is no longer open"""
+
+    def _fingerprint_query(self):
+        return Order.objects.filter(customer_id=self.user.pk, is_checked_out=False).values(
+            'id', 'updated_at').annotate(products_changed=Max('items__product__updated_at'))
+
+    def fingerprint(self):
+        """(etag parts, last modified) for conditional GET, None when there is no cart"""
+        return self._fingerprint(self._fingerprint_query().first())
+
+    async def afingerprint(self):
+        return self._fingerprint(await self._fingerprint_query().afirst())
+
+    def _fingerprint(self, state):
+        if state is None:
+            return None
+        last_modified = max(filter(None, [state['updated_at'], state['products_changed']]))
+        return (state['id'], state['updated_at'], state['products_changed']), last_modified
+
+
+class DatabaseCartStore:
+    cart_class = DatabaseCart
+
+    def get_cart(self, user):
+        return self.cart_class(user)
+
+
+_dirty_lock = threading.Lock()
+_dirty_users = set()
+_flusher = {'thread': None}
+
+
+class CartBusy(Exception):
+    """Another request kept the cart locked for longer than CART_LOCK_TIMEOUT"""
+
+
+class CacheCart:
+    """
+    Cart lines held in the cache as {'lines': {product id: quantity}, ...}.
+
+    Line ids exposed to clients are product ids. On a cache miss the cart is
+    loaded from the open Order, so the database stays the source of truth
+    for anything already flushed. Every change reads, modifies and writes
+    the entry while holding a per-cart lock taken with cache.add(), so two
+    requests changing the same cart don't lose one another's update.
+    """
+
+    def __init__(self, user, store):
+        self.user = user
+        self.store = store
+        self.key = f'shop:cart:{user.pk}'
+
+    def _load(self):
+        state = self.store.cache.get(self.key)
+        if state is None:
+            order = Order.objects.filter(customer=self.user, is_checked_out=False).first()
+            lines = {}
+            if order is not None:
+                lines = dict(order.items.values_list('product_id', 'quantity'))
+            state = self._loaded(order, lines)
+        return state
+
+    async def _aload(self):
+        state = self.store.cache.get(self.key)
+        if state is None:
+            order = await Order.objects.filter(customer_id=self.user.pk, is_checked_out=False).afirst()
+            lines = {}
+            if order is not None:
+                lines = {product_id: quantity async for product_id, quantity in order.items.values_list('product_id', 'quantity')}
+            state = self._loaded(order, lines)
+        return state
+
+    def _loaded(self, order, lines):
+        state = {'order_id': order.pk if order else None, 'lines': lines,
+                 'version': 0, 'updated': time.time()}
+        # Only fills a miss, never overwrites what a locked change stored meanwhile
+        if not self.store.cache.add(self.key, state, timeout=self.store.timeout):
+            state = self.store.cache.get(self.key) or state
+        return state
+
+    @contextmanager
+    def _locked(self):
+        """Hold the cart's lock, raises CartBusy when it can't be had within CART_LOCK_TIMEOUT"""
+        lock_key, timeout = self.key + ':lock', self.store.lock_timeout
+        deadline = time.monotonic() + timeout
+        # The lock expires on its own, a request that died holding it blocks the cart for `timeout` at most
+        while not self.store.cache.add(lock_key, 1, timeout=timeout):
+            if time.monotonic() >= deadline:
+                raise CartBusy('The cart is being changed by another request, try again')
+            time.sleep(0.005)
+        try:
+            yield
+        finally:
+            self.store.cache.delete(lock_key)
+
+    def _save(self, state):
+        state['version'] += 1
+        state['updated'] = time.time()
+        self.store.cache.set(self.key, state, timeout=self.store.timeout)
+        self.store.mark_dirty(self.user.pk)
+
+    def data(self):
+        state = self._load()
+        return self._payload(state, Product.objects.in_bulk(list(state['lines'])))
+
+    async def adata(self):
+        state = await self._aload()
+        return self._payload(state, await Product.objects.ain_bulk(list(state['lines'])))
+
+    def _payload(self, state, products):
+        items = []
+        total_price = Decimal('0.00')
+        total_items = 0
+        for product_id, quantity in state['lines'].items():
+            product = products.get(product_id)
+            if product is None:
+                continue
+            line_total = product.price * quantity
+            items.append({
+                'id': product_id,
+                'product': product_id,
+                'product_title': product.title,
+                'product_price': product.price,
+                'quantity': quantity,
+                'item_total_price': line_total,
+            })
+            total_price += line_total
+            total_items += quantity
+        return {
+            'id': state['order_id'],
+            'customer': self.user.pk,
+            'customer_name': self.user.username,
+            'created_at': None,
+            'status': 'pending',
+            'payment_method': 'COD',
+            'payment_status': 'in_progress',
+            'is_checked_out': False,
+            'completed': False,
+            'items': items,
+            'shipping_address': None,
+            'total_price': total_price,
+            'total_items': total_items,
+        }
+
+    def add(self, product, quantity):
+        if quantity < 1:
+            raise ValueError('The quantity must be at least 1')
+        with self._locked():
+            state = self._load()
+            state['lines'][product.pk] = state['lines'].get(product.pk, 0) + quantity
+            self._save(state)
+
+    def line_id(self, product_id):
+        """Id of the line holding the product, None when it is not in the cart"""
+        try:
+            product_id = int(product_id)
+        except (TypeError, ValueError):
+            return None
+        return product_id if product_id in self._load()['lines'] else None
+
+    def set_quantity(self, item_id, quantity):
+        if quantity < 0:
+            raise ValueError('The quantity can not be negative')
+        if quantity == 0:
+            return self.remove(item_id)
+        try:
+            item_id = int(item_id)
+        except (TypeError, ValueError):
+            return False
+        with self._locked():
+            state = self._load()
+            if item_id not in state['lines']:
+                return False
+            state['lines'][item_id] = quantity
+            self._save(state)
+        return True
+
+    def remove(self, item_id):
+        try:
+            item_id = int(item_id)
+        except (TypeError, ValueError):
+            return False
+        with self._locked():
+            state = self._load()
+            if state['lines'].pop(item_id, None) is None:
+                return False
+            self._save(state)
+        return True
+
+    def apply(self, operations, products):
+        with self._locked():
+            state = self._load()
+            for operation in operations:
+                apply_operation(state['lines'], operation)
+            self._save(state)
+
+    def persist(self):
+        """Write the cached lines to the open Order and its items"""
+        with transaction.atomic():
+            order = Order.objects.select_for_update().filter(customer=self.user, is_checked_out=False).first()
+            # Read under the order lock: a checkout that committed meanwhile has
+            # recorded its order in the entry (or cleared it) by now
+            state = self.store.cache.get(self.key)
+            if state is None:
+                return
+            if state['order_id'] is not None and (order is None or order.pk != state['order_id']):
+                # These lines were checked out since they were cached, writing them would revive them
+                self.store.cache.delete(self.key)
+                return
+            if order is None:
+                order = Order.objects.create(customer=self.user)
+            existing = {item.product_id: item for item in order.items.all()}
+            prices = dict(Product.objects.filter(pk__in=state['lines']).values_list('pk', 'price'))
+
+            new, changed = [], []
+            for product_id, quantity in state['lines'].items():
+                if product_id not in prices:
+                    continue
+                item = existing.pop(product_id, None)
+                if item is None:
+                    new.append(OrderItem(order=order, product_id=product_id, quantity=quantity))
+                elif item.quantity != quantity:
+                    item.quantity = quantity
+                    changed.append(item)
+            OrderItem.objects.bulk_create(new)
+            OrderItem.objects.bulk_update(changed, ['quantity'])
+            if existing:
+                OrderItem.objects.filter(pk__in=[item.pk for item in existing.values()]).delete()
+
+            order.total_items = sum(q for p, q in state['lines'].items() if p in prices)
+            order.total_price = sum((prices[p] * q for p, q in state['lines'].items() if p in prices), Decimal('0.00'))
+            order.save()
+
+        if state['order_id'] != order.pk:
+            with self._locked():
+                # Lines may have changed since the snapshot above, only record the order
+                current = self.store.cache.get(self.key)
+                if current is not None:
+                    current['order_id'] = order.pk
+                    self.store.cache.set(self.key, current, timeout=self.store.timeout)
+
+    def clear(self):
+        self.store.cache.delete(self.key)
+        with _dirty_lock:
+            _dirty_users.discard(self.user.pk)
+
+    def fingerprint(self):
+        return self._fingerprint(self._load())
+
+    async def afingerprint(self):
+        return self._fingerprint(await self._aload())
+
+    def _fingerprint(self, state):
+        last_modified = datetime.fromtimestamp(state['updated'], tz=dt_timezone.utc)
+        return (self.user.pk, state['version'], state['updated'], namespace_version(CATALOG)), last_modified
+
+
+class CacheCartStore:
+    """
+    Write-behind cart store. Carts changed in this process are remembered
+    and flushed to the database every CART_FLUSH_INTERVAL seconds by a
+    daemon thread (set it to None to only flush at checkout or through
+    flush_dirty_carts()). A cart evicted from the cache before it is
+    flushed loses the changes made since the last flush.
+    """
+    cart_class = CacheCart
+
+    def __init__(self):
+        self.cache = get_cache()
+        self.timeout = getattr(settings, 'CART_CACHE_TIMEOUT', 7 * 24 * 3600)
+        self.flush_interval = getattr(settings, 'CART_FLUSH_INTERVAL', 30)
+        self.lock_timeout = getattr(settings, 'CART_LOCK_TIMEOUT', 5)
+
+    def get_cart(self, user):
+        return self.cart_class(user, self)
+
+    def mark_dirty(self, user_id):
+        with _dirty_lock:
+            _dirty_users.add(user_id)
+            if self.flush_interval and _flusher['thread'] is None:
+                _flusher['thread'] = threading.Thread(target=self._flush_forever, name='cart-flusher', daemon=True)
+                _flusher['thread'].start()
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                flush_dirty_carts()
+            finally:
+                close_old_connections()
+
+
+def flush_dirty_carts():
+    """Persist every cart changed in this process since the last flush, returns how many"""
+    with _dirty_lock:
+        user_ids = list(_dirty_users)
+        _dirty_users.clear()
+    if not user_ids:
+        return 0
+    store = get_cart_store()
+    flushed = 0
+    for user in get_user_model().objects.filter(pk__in=user_ids):
+        try:
+            store.get_cart(user).persist()
+            flushed += 1
+        except Exception:
+            # Keep it for the next round
+            store.mark_dirty(user.pk)
+    return flushed
+
+
+def get_cart_store():
+    return import_string(getattr(settings, 'CART_STORE', 'shop.carts.DatabaseCartStore'))()
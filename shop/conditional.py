@@ -0,0 +1,168 @@
+"""
+Fingerprints for conditional GET.
+
+Each pair of etag/last_modified functions is handed to Django's
+``condition`` decorator. They cost one or two small aggregate queries per
+request, memoized on the request so the ETag and Last-Modified share them,
+and let the view answer 304 before anything is serialized.
+"""
+import datetime
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from .carts import get_cart_store
+from .models import Category, Product
+
+
+def _memoize(request, name, compute):
+    attr = f'_fingerprint_{name}'
+    if not hasattr(request, attr):
+        setattr(request, attr, compute())
+    return getattr(request, attr)
+
+
+def _etag(*parts):
+    return hashlib.md5('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def _table_state(model):
+    return model.objects.aggregate(last=Max('updated_at'), count=Count('id'))
+
+
+def _latest(*values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+def product_list_state(request, *args, **kwargs):
+    # Every row embeds its category, so renames count too
+    return _memoize(request, 'products', lambda: (_table_state(Product), _table_state(Category)))
+
+
+def product_list_etag(request, *args, **kwargs):
+    products, categories = product_list_state(request)
+    # The body depends on the cursor and page size too
+    return _etag('products', products['last'], products['count'], categories['last'], categories['count'],
+                 request.get_full_path())
+
+
+def product_list_last_modified(request, *args, **kwargs):
+    products, categories = product_list_state(request)
+    return _latest(products['last'], categories['last'])
+
+
+def product_detail_state(request, pk, *args, **kwargs):
+    # The category is nested in the payload, so its changes count too
+    return _memoize(request, f'product_{pk}', lambda: Product.objects.filter(pk=pk).values(
+        'updated_at', 'category__updated_at').first())
+
+
+def product_detail_etag(request, pk, *args, **kwargs):
+    state = product_detail_state(request, pk)
+    if state is None:
+        return None
+    return _etag('product', pk, state['updated_at'], state['category__updated_at'])
+
+
+def product_detail_last_modified(request, pk, *args, **kwargs):
+    state = product_detail_state(request, pk)
+    if state is None:
+        return None
+    return max(state['updated_at'], state['category__updated_at'])
+
+
+def category_list_state(request, *args, **kwargs):
+    return _memoize(request, 'categories', lambda: _table_state(Category))
+
+
+def category_list_etag(request, *args, **kwargs):
+    state = category_list_state(request)
+    return _etag('categories', state['last'], state['count'])
+
+
+def category_list_last_modified(request, *args, **kwargs):
+    return category_list_state(request)['last']
+
+
+def cart_state(request, *args, **kwargs):
+    def compute():
+        if not request.user.is_authenticated:
+            return None
+        return get_cart_store().get_cart(request.user).fingerprint()
+    return _memoize(request, 'cart', compute)
+
+
+def cart_etag(request, *args, **kwargs):
+    state = cart_state(request)
+    if state is None:
+        return None
+    return _etag('cart', *state[0])
+
+
+def cart_last_modified(request, *args, **kwargs):
+    state = cart_state(request)
+    if state is None:
+        return None
+    return state[1]
+
+
+# Async views cannot use the condition decorator with the functions above
+# (it calls them synchronously), they use these and respond() instead.
+
+async def _atable_state(model):
+    return await model.objects.aaggregate(last=Max('updated_at'), count=Count('id'))
+
+
+async def aproduct_list_fingerprint(request):
+    products, categories = await _atable_state(Product), await _atable_state(Category)
+    return (_etag('products', products['last'], products['count'], categories['last'], categories['count'],
+                  request.get_full_path()),
+            _latest(products['last'], categories['last']))
+
+
+async def aproduct_detail_fingerprint(request, pk):
+    state = await Product.objects.filter(pk=pk).values('updated_at', 'category__updated_at').afirst()
+    if state is None:
+        return None
+    return (_etag('product', pk, state['updated_at'], state['category__updated_at']),
+            max(state['updated_at'], state['category__updated_at']))
+
+
+async def acategory_list_fingerprint(request):
+    state = await _atable_state(Category)
+    return _etag('categories', state['last'], state['count']), state['last']
+
+
+async def acart_fingerprint(request):
+    state = await get_cart_store().get_cart(request.user).afingerprint()
+    if state is None:
+        return None
+    return _etag('cart', *state[0]), state[1]
+
+
+async def respond(request, fingerprint, view):
+    """
+    What condition() does for sync views: answer 304/412 from the
+    (etag, last modified) fingerprint, otherwise await view() and add the
+    ETag and Last-Modified headers to its response.
+    """
+    etag, last_modified = fingerprint or (None, None)
+    if last_modified is not None:
+        if not timezone.is_aware(last_modified):
+            last_modified = timezone.make_aware(last_modified, datetime.timezone.utc)
+        last_modified = int(last_modified.timestamp())
+    etag = quote_etag(etag) if etag is not None else None
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = await view()
+    if request.method in ('GET', 'HEAD'):
+        if last_modified and not response.has_header('Last-Modified'):
+            response.headers['Last-Modified'] = http_date(last_modified)
+        if etag:
+            response.headers.setdefault('ETag', etag)
+    return response
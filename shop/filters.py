@@ -0,0 +1,204 @@
+import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db.models import Case, Count, IntegerField, Q, Value, When
+from django.utils import timezone
+
+from .models import Order
+
+TRUE_VALUES = ('1', 'true', 'yes')
+FALSE_VALUES = ('0', 'false', 'no')
+
+
+class InvalidFilter(ValueError):
+    pass
+
+
+def _parse(params, name, cast):
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return cast(value)
+    except (ValueError, InvalidOperation):
+        raise InvalidFilter(f'{name} must be a number')
+
+
+def _decimal(value):
+    number = Decimal(value)
+    if not number.is_finite():
+        # NaN and Infinity parse, but the ORM refuses them in a filter
+        raise ValueError(f'{value} is not a finite number')
+    return number
+
+
+def _parse_bool(params, name):
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    if value.lower() in TRUE_VALUES:
+        return True
+    if value.lower() in FALSE_VALUES:
+        return False
+    raise InvalidFilter(f'{name} must be true or false')
+
+
+def _parse_date(params, name):
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise InvalidFilter(f'{name} must be a date as YYYY-MM-DD')
+
+
+def _parse_choice(params, name, choices):
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    if value not in dict(choices):
+        raise InvalidFilter(f'{name} must be one of ' + ', '.join(choice for choice, _ in choices))
+    return value
+
+
+def parse_product_filters(params):
+    """Read the catalog filters from query params, raises InvalidFilter"""
+    return {
+        'category_id': _parse(params, 'category', int),
+        'min_price': _parse(params, 'min_price', _decimal),
+        'max_price': _parse(params, 'max_price', _decimal),
+        'in_stock': _parse_bool(params, 'in_stock'),
+    }
+
+
+def filter_products(queryset, category_id=None, min_price=None, max_price=None, in_stock=None):
+    if category_id is not None:
+        queryset = queryset.filter(category_id=category_id)
+    if min_price is not None:
+        queryset = queryset.filter(price__gte=min_price)
+    if max_price is not None:
+        queryset = queryset.filter(price__lte=max_price)
+    if in_stock is True:
+        queryset = queryset.filter(stock__gt=0)
+    elif in_stock is False:
+        queryset = queryset.filter(stock=0)
+    return queryset
+
+
+def parse_order_filters(params):
+    """Read the admin order list filters from query params, raises InvalidFilter. Carts are left out unless asked for"""
+    checked_out = _parse_bool(params, 'is_checked_out')
+    filters = {
+        'status': _parse_choice(params, 'status', Order.STATUS_CHOICES),
+        'payment_status': _parse_choice(params, 'payment_status', Order.PAYMENT_STATUS),
+        'is_checked_out': True if checked_out is None else checked_out,
+        'completed': _parse_bool(params, 'completed'),
+        'customer_id': _parse(params, 'customer', int),
+        'date_from': _parse_date(params, 'date_from'),
+        'date_to': _parse_date(params, 'date_to'),
+    }
+    if filters['date_from'] and filters['date_to'] and filters['date_from'] > filters['date_to']:
+        raise InvalidFilter('date_from must not be after date_to')
+    return filters
+
+
+def day_bounds(date_from, date_to, field='created_at'):
+    """Filter kwargs for whole local days on a datetime field, a plain range the indexes can serve unlike __date"""
+    bounds = {}
+    tz = timezone.get_current_timezone()
+    if date_from:
+        bounds[f'{field}__gte'] = datetime.datetime.combine(date_from, datetime.time.min, tzinfo=tz)
+    if date_to:
+        bounds[f'{field}__lt'] = datetime.datetime.combine(date_to + datetime.timedelta(days=1), datetime.time.min, tzinfo=tz)
+    return bounds
+
+
+def filter_orders(queryset, status=None, payment_status=None, is_checked_out=True, completed=None,
+                  customer_id=None, date_from=None, date_to=None):
+    # Every combination starts with the equality columns of one of the Order indexes, see Order.Meta.
+    # A bool literal would render as a bare `WHERE is_checked_out`, which SQLite can't match to them.
+    queryset = queryset.filter(is_checked_out=Value(is_checked_out), **day_bounds(date_from, date_to))
+    if customer_id is not None:
+        queryset = queryset.filter(customer_id=customer_id)
+    if status is not None:
+        queryset = queryset.filter(status=status)
+    if payment_status is not None:
+        queryset = queryset.filter(payment_status=payment_status)
+    if completed is not None:
+        queryset = queryset.filter(completed=completed)
+    return queryset
+
+
+def price_buckets():
+    """[(label, low, high)] from the PRODUCT_PRICE_BUCKETS boundaries, the last one open ended"""
+    edges = getattr(settings, 'PRODUCT_PRICE_BUCKETS', [0, 50, 100, 500, 1000])
+    buckets = [(f'{low}-{high}', low, high) for low, high in zip(edges, edges[1:])]
+    buckets.append((f'{edges[-1]}+', edges[-1], None))
+    return buckets
+
+
+def facet_rows(queryset, min_price=None, max_price=None):
+    """Product counts grouped by category, price bucket, stock status and whether the price is in the asked range"""
+    buckets = price_buckets()
+    bucket = Case(
+        *[When(Q(price__gte=low, price__lt=high) if high is not None else Q(price__gte=low), then=Value(i))
+          for i, (_, low, high) in enumerate(buckets)],
+        default=Value(-1),
+        output_field=IntegerField(),
+    )
+    in_stock = Case(When(stock__gt=0, then=Value(1)), default=Value(0), output_field=IntegerField())
+    price_range = Q()
+    if min_price is not None:
+        price_range &= Q(price__gte=min_price)
+    if max_price is not None:
+        price_range &= Q(price__lte=max_price)
+    in_range = Case(When(price_range, then=Value(1)), default=Value(0), output_field=IntegerField()) if price_range else Value(1)
+    return queryset.order_by().annotate(price_bucket=bucket, available=in_stock, in_range=in_range).values(
+        'category_id', 'category__name', 'price_bucket', 'available', 'in_range',
+    ).annotate(count=Count('id'))
+
+
+def fold_facets(rows, category_id=None, in_stock=None):
+    buckets = price_buckets()
+    categories = {}
+    bucket_counts = [0] * len(buckets)
+    stock_counts = {'in_stock': 0, 'out_of_stock': 0}
+    for row in rows:
+        in_category = category_id is None or row['category_id'] == category_id
+        in_range = bool(row['in_range'])
+        stocked = in_stock is None or bool(row['available']) == in_stock
+        # Each facet counts the products that pass every filter but its own
+        if in_range and stocked:
+            category = categories.setdefault(row['category_id'], {
+                'id': row['category_id'], 'name': row['category__name'], 'count': 0})
+            category['count'] += row['count']
+        if in_category and stocked and row['price_bucket'] >= 0:
+            bucket_counts[row['price_bucket']] += row['count']
+        if in_category and in_range:
+            stock_counts['in_stock' if row['available'] else 'out_of_stock'] += row['count']
+
+    return {
+        'category': sorted(categories.values(), key=lambda c: (-c['count'], c['name'])),
+        'price': [
+            {'bucket': label, 'min': low, 'max': high, 'count': count}
+            for (label, low, high), count in zip(buckets, bucket_counts)
+        ],
+        'stock': stock_counts,
+    }
+
+
+def product_facets(queryset, category_id=None, min_price=None, max_price=None, in_stock=None):
+    """
+    Counts per category, price bucket and stock status, all from one GROUP
+    BY query over the unfiltered queryset that is folded per facet in
+    Python. Each facet is counted with every filter applied except its own,
+    so with ?category=X the other categories keep their counts and the
+    client can offer them as alternatives.
+    """
+    return fold_facets(facet_rows(queryset, min_price, max_price), category_id, in_stock)
+
+
+async def aproduct_facets(queryset, category_id=None, min_price=None, max_price=None, in_stock=None):
+    return fold_facets([row async for row in facet_rows(queryset, min_price, max_price)], category_id, in_stock)
@@ -0,0 +1,31 @@
+"""
+Password hashers whose cost comes from settings.
+
+They keep the algorithm names of Django's own hashers, so existing hashes
+keep verifying, and Django's must_update() sees a cost change as an outdated
+hash: the password is rehashed with the new parameters on the user's next
+successful login. The first entry of PASSWORD_HASHERS is the policy, every
+other entry only has to verify old hashes (and gets upgraded the same way).
+"""
+from django.conf import settings
+from django.contrib.auth.hashers import Argon2PasswordHasher, PBKDF2PasswordHasher
+
+
+class ConfigurablePBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    @property
+    def iterations(self):
+        return getattr(settings, 'PBKDF2_ITERATIONS', PBKDF2PasswordHasher.iterations)
+
+
+class ConfigurableArgon2PasswordHasher(Argon2PasswordHasher):
+    @property
+    def time_cost(self):
+        return getattr(settings, 'ARGON2_TIME_COST', Argon2PasswordHasher.time_cost)
+
+    @property
+    def memory_cost(self):
+        return getattr(settings, 'ARGON2_MEMORY_COST', Argon2PasswordHasher.memory_cost)
+
+    @property
+    def parallelism(self):
+        return getattr(settings, 'ARGON2_PARALLELISM', Argon2PasswordHasher.parallelism)
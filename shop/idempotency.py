@@ -0,0 +1,108 @@
+"""
+Idempotency-Key support for the mutating cart and order endpoints.
+
+A client that may retry (a gateway after a timeout, say) sends the same
+Idempotency-Key header with every attempt of one operation. The first
+attempt runs the view and its response is stored under (user, key). Later
+attempts get that response back, marked with an Idempotent-Replayed
+header, and nothing runs again. Reusing a key for a different request
+(another path or body) is refused with 422.
+
+The key's row is inserted and locked before the view runs, and the view
+runs in the same transaction. A concurrent duplicate blocks on the row
+until the first attempt commits and then replays its response. If the
+first attempt fails with an exception, everything it did rolls back along
+with the row, and the next attempt starts from scratch. Responses with a
+5xx status are never stored, retrying them runs the view again.
+
+Stored responses expire after IDEMPOTENCY_KEY_TTL seconds. An expired key
+counts as unused, and the purge_idempotency_keys command deletes the rows.
+"""
+import datetime
+import functools
+import hashlib
+import json
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = IdempotencyKey._meta.get_field('key').max_length
+
+
+def ttl():
+    return getattr(settings, 'IDEMPOTENCY_KEY_TTL', 24 * 3600)
+
+
+def fingerprint(request):
+    """SHA-256 of what makes two requests the same operation"""
+    digest = hashlib.sha256(f'{request.method} {request.path}\n'.encode())
+    digest.update(request.body)
+    return digest.hexdigest()
+
+
+def claim(user, key):
+    """The locked row of the key, created if needed. Must run in a transaction."""
+    expires_at = timezone.now() + datetime.timedelta(seconds=ttl())
+    # Never raises on a duplicate, a concurrent insert of the same key waits for ours to commit
+    IdempotencyKey.objects.bulk_create(
+        [IdempotencyKey(user=user, key=key, expires_at=expires_at)], ignore_conflicts=True)
+    record = IdempotencyKey.objects.select_for_update().get(user=user, key=key)
+    if record.status_code is not None and record.expires_at <= timezone.now():
+        # Expired, the key is free again
+        record.status_code, record.fingerprint, record.response = None, '', ''
+        record.expires_at = expires_at
+    return record
+
+
+def store(record, request_fingerprint, response):
+    record.fingerprint = request_fingerprint
+    record.status_code = response.status_code
+    # Compact JSON of the data, rendered again the same way on a replay
+    record.response = json.dumps(response.data, cls=JSONEncoder, separators=(',', ':'))
+    record.save(update_fields=['fingerprint', 'status_code', 'response', 'expires_at'])
+
+
+def replay(record):
+    response = Response(json.loads(record.response), status=record.status_code)
+    response[REPLAYED_HEADER] = 'true'
+    return response
+
+
+def idempotent(method):
+    """Make an APIView handler honour the Idempotency-Key header, requests without one run as usual"""
+    @functools.wraps(method)
+    def handler(view, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if key is None:
+            return method(view, request, *args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return Response({'error': f'{HEADER} must be 1 to {MAX_KEY_LENGTH} characters'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        request_fingerprint = fingerprint(request)
+        with transaction.atomic():
+            record = claim(request.user, key)
+            if record.status_code is not None:
+                if record.fingerprint != request_fingerprint:
+                    return Response({'error': f'This {HEADER} was already used for a different request'},
+                                    status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+                return replay(record)
+
+            response = method(view, request, *args, **kwargs)
+            if response.status_code < 500:
+                store(record, request_fingerprint, response)
+        return response
+    return handler
+
+
+def purge_expired():
+    """Delete the expired keys, returns how many"""
+    return IdempotencyKey.objects.filter(expires_at__lte=timezone.now()).delete()[0]
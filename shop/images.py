@@ -0,0 +1,182 @@
+"""
+Product image derivatives.
+
+Uploads are kept as the original, and a fixed set of downscaled WebP
+variants (PRODUCT_IMAGE_VARIANTS, name: longest edge in pixels) is generated
+from it with Pillow. List clients can then fetch a thumbnail instead of the
+original.
+
+Generation runs off the request path. After the transaction that saved a
+new image commits, the product is handed to a thread pool of
+PRODUCT_IMAGE_WORKERS threads (Pillow releases the GIL while it decodes,
+resizes and encodes). With PRODUCT_IMAGE_WORKERS = 0 it runs inline. Each
+variant is named after the hash of its bytes, so a URL never changes content
+and can be cached forever. Regenerating the same image writes nothing new.
+
+The result lands in Product.image_variants as
+{'source': <image name>, 'variants': {name: {'name', 'width', 'height'}}}.
+It is written with a conditional UPDATE, so variants of an image that was
+replaced in the meantime are dropped. Until the variants exist, the
+serializers return an empty map and clients use the original.
+"""
+import hashlib
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from PIL import Image, ImageOps
+
+from .cache import CATALOG, invalidate
+from .models import Product
+
+logger = logging.getLogger('shop.images')
+
+DEFAULT_VARIANTS = {'thumb': 160, 'small': 320, 'medium': 640, 'large': 1280}
+VARIANT_DIR = 'products/variants'
+
+_pool_lock = threading.Lock()
+_pool = {'executor': None}
+
+
+def variant_sizes():
+    """(name, longest edge) of the configured variants, largest first"""
+    variants = getattr(settings, 'PRODUCT_IMAGE_VARIANTS', DEFAULT_VARIANTS)
+    return sorted(variants.items(), key=lambda item: -item[1])
+
+
+def _workers():
+    workers = getattr(settings, 'PRODUCT_IMAGE_WORKERS', None)
+    if workers is None:
+        return min(4, os.cpu_count() or 1)
+    return workers
+
+
+def _executor():
+    with _pool_lock:
+        if _pool['executor'] is None:
+            _pool['executor'] = ThreadPoolExecutor(max_workers=_workers(), thread_name_prefix='image-variants')
+        return _pool['executor']
+
+
+def storage():
+    return Product._meta.get_field('image').storage
+
+
+def _open(field_file):
+    with field_file.open('rb') as handle:
+        image = Image.open(handle)
+        # JPEG can decode straight at a reduced scale, close above the largest variant
+        largest = variant_sizes()[0][1]
+        image.draft('RGB', (largest, largest))
+        image.load()
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+    return image
+
+
+def _save_variant(name, image):
+    buffer = io.BytesIO()
+    image.save(buffer, 'WEBP', quality=getattr(settings, 'PRODUCT_IMAGE_QUALITY', 80), method=4)
+    data = buffer.getvalue()
+    path = f'{VARIANT_DIR}/{name}/{hashlib.sha256(data).hexdigest()[:20]}.webp'
+    store = storage()
+    if not store.exists(path):
+        path = store.save(path, ContentFile(data))
+    return {'name': path, 'width': image.width, 'height': image.height}
+
+
+def render_variants(field_file):
+    """{variant: {'name', 'width', 'height'}} for an image file, stored under content-hash names"""
+    image = _open(field_file)
+    variants = {}
+    # Largest first, each one downscaled from the previous (never upscaled)
+    for name, edge in variant_sizes():
+        if max(image.size) > edge:
+            image = image.resize(_fit(image.size, edge), Image.LANCZOS)
+        variants[name] = _save_variant(name, image)
+    return variants
+
+
+def _fit(size, edge):
+    width, height = size
+    scale = edge / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def generate_variants(product_id, force=False):
+    """Render and record the variants of a product's current image, returns whether it changed"""
+    product = Product.objects.only('id', 'image', 'image_variants').filter(pk=product_id).first()
+    if product is None:
+        return False
+    source = product.image.name or ''
+    if not force and not is_stale(source, product.image_variants):
+        return False
+
+    payload = {'source': source, 'variants': render_variants(product.image) if source else {}}
+    # Only if the image was not replaced while we were rendering
+    current = Q(image=source) | Q(image__isnull=True) if not source else Q(image=source)
+    updated = Product.objects.filter(current, pk=product_id).update(image_variants=payload)
+    if updated:
+        invalidate(CATALOG)
+    return bool(updated)
+
+
+def _generate(product_id, force=False):
+    try:
+        return generate_variants(product_id, force)
+    except Exception:
+        logger.exception("Could not render the image variants of product %s", product_id)
+        return False
+
+
+def run_in_worker(product_id, force=False):
+    """generate_variants() on a pool thread, which owns its database connection"""
+    close_old_connections()
+    try:
+        return _generate(product_id, force)
+    finally:
+        close_old_connections()
+
+
+def submit(product_id, force=False):
+    """Generate the variants on the worker pool, returns a Future (the result, inline, with 0 workers)"""
+    if _workers() == 0:
+        return _generate(product_id, force)
+    return _executor().submit(run_in_worker, product_id, force)
+
+
+def is_stale(image_name, image_variants):
+    return (image_variants or {}).get('source', '') != (image_name or '')
+
+
+def schedule(product):
+    """Queue variant generation once the current transaction commits, if the image changed"""
+    if is_stale(product.image.name, product.image_variants):
+        transaction.on_commit(lambda: submit(product.pk))
+
+
+def variant_urls(product, request=None):
+    """{variant: {'url', 'width', 'height'}} for the product's current image"""
+    return variant_map(product.image.name, product.image_variants, request)
+
+
+def variant_map(image_name, image_variants, request=None):
+    if not image_name or (image_variants or {}).get('source') != image_name:
+        return {}
+    store = storage()
+    urls = {}
+    for name, variant in image_variants['variants'].items():
+        url = store.url(variant['name'])
+        urls[name] = {
+            'url': request.build_absolute_uri(url) if request is not None else url,
+            'width': variant['width'],
+            'height': variant['height'],
+        }
+    return urls
@@ -0,0 +1,87 @@
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Now
+
+from .cache import invalidate_products
+from .models import Product
+from .notifications import low_stock_threshold, stock_reserved
+
+
+class InsufficientStock(Exception):
+    """Raised when an order asks for more units than are in stock"""
+
+    def __init__(self, shortages):
+        self.shortages = shortages
+        super().__init__("Not enough stock for %d product(s)" % len(shortages))
+
+
+def _quantities(order):
+    """Units per product for an order, in product id order"""
+    quantities = Counter()
+    for product_id, quantity in order.items.values_list('product_id', 'quantity'):
+        quantities[product_id] += quantity
+    return sorted(quantities.items())
+
+
+def reserve_stock(order):
+    """
+    Take stock for every item of the order, all or nothing.
+
+    Must run inside transaction.atomic(). Each product is decremented with a
+    conditional UPDATE ... WHERE stock >= qty, which takes the row lock and
+    checks availability in one statement. Products are always visited in id
+    order, so two checkouts sharing products lock them in the same order and
+    cannot deadlock. On a shortage InsufficientStock is raised with a report
+    for every short item and the caller's transaction rolls everything back.
+    Products that fall to the low-stock threshold get an alert queued.
+    """
+    quantities = _quantities(order)
+    short = []
+    for product_id, quantity in quantities:
+        updated = Product.objects.filter(pk=product_id, stock__gte=quantity).update(
+            stock=F('stock') - quantity, updated_at=Now())
+        if not updated:
+            short.append((product_id, quantity))
+
+    if short:
+        products = Product.objects.in_bulk([product_id for product_id, _ in short])
+        raise InsufficientStock([
+            {
+                'product_id': product_id,
+                'product_title': products[product_id].title if product_id in products else None,
+                'requested': quantity,
+                'available': products[product_id].stock if product_id in products else 0,
+            }
+            for product_id, quantity in short
+        ])
+
+    stock_reserved(_crossed_threshold(quantities))
+    _stock_changed(quantities)
+
+
+def _crossed_threshold(quantities):
+    """Ids of the products this reservation took from above the low-stock threshold to at or below it"""
+    threshold = low_stock_threshold()
+    if threshold is None:
+        return []
+    taken = dict(quantities)
+    # Still locked by our UPDATEs, so the stock read is the one we left
+    low = Product.objects.filter(pk__in=taken, stock__lte=threshold).values_list('id', 'stock')
+    return [product_id for product_id, stock in low if stock + taken[product_id] > threshold]
+
+
+def release_stock(order):
+    """Give the order's units back to stock, e.g. when it is cancelled"""
+    quantities = _quantities(order)
+    for product_id, quantity in quantities:
+        Product.objects.filter(pk=product_id).update(stock=F('stock') + quantity, updated_at=Now())
+    _stock_changed(quantities)
+
+
+def _stock_changed(quantities):
+    # The UPDATEs bypass the Product signals. Only these products' payloads and the list pages
+    # show their stock, the rest of the catalog (and the search index) stays warm.
+    product_ids = [product_id for product_id, _ in quantities]
+    transaction.on_commit(lambda: invalidate_products(product_ids))
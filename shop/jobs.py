@@ -0,0 +1,184 @@
+"""
+A small database-backed job queue.
+
+Side effects that must not slow a request down (emails, alerts) are
+registered as tasks with @task and queued with enqueue(). The Job row is
+inserted from a transaction.on_commit() callback. A job is therefore only
+queued once the change that caused it has committed, and never for a
+transaction that rolled back. Outside a transaction it is inserted right
+away.
+
+The run_jobs command runs the workers: a pool of threads, optionally in
+several processes. A worker takes the oldest ready job with
+SELECT ... FOR UPDATE SKIP LOCKED, so workers never wait on each other,
+and marks it running. On SQLite, which has no row locks, the conditional
+UPDATE that marks it running is what keeps two workers from taking the
+same job. A job that succeeds is deleted. One that raises is queued again
+after an exponential backoff (JOB_RETRY_DELAY * 2^(attempt - 1), capped at
+JOB_RETRY_MAX_DELAY, with jitter), and after max_attempts it stays behind
+as failed. A job left running by a worker that died is queued again after
+JOB_LOCK_TIMEOUT seconds.
+
+Tasks take JSON-serializable keyword arguments and should be safe to run
+more than once, because a job may be retried after it partly succeeded.
+"""
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F
+from django.db.models.functions import Now
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger('shop.jobs')
+
+TASKS = {}
+
+
+def task(name):
+    """Register a function as the task run by jobs called `name`"""
+    def register(func):
+        TASKS[name] = func
+        return func
+    return register
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def enqueue(name, payload=None, delay=0, max_attempts=None):
+    """Queue a job once the current transaction commits"""
+    if name not in TASKS:
+        raise LookupError(f'No task is registered as {name}')
+    job = Job(name=name, payload=payload or {},
+              max_attempts=max_attempts or _setting('JOB_MAX_ATTEMPTS', 5))
+
+    def insert():
+        job.run_at = timezone.now() + timedelta(seconds=delay)
+        job.save()
+    transaction.on_commit(insert)
+
+
+def backoff(attempts):
+    """Seconds to wait before retrying a job that failed `attempts` times"""
+    delay = min(_setting('JOB_RETRY_DELAY', 30) * 2 ** (attempts - 1), _setting('JOB_RETRY_MAX_DELAY', 3600))
+    # Jobs that failed together don't all come back at the same moment
+    return delay * random.uniform(0.5, 1)
+
+
+def worker_name(index=0):
+    return f'{socket.gethostname()}:{os.getpid()}:{index}'
+
+
+def claim(worker):
+    """Take the oldest ready job for `worker`, None when there is none"""
+    with transaction.atomic():
+        job = Job.objects.select_for_update(skip_locked=True).filter(
+            status='queued', run_at__lte=timezone.now()).order_by('run_at', 'id').first()
+        if job is None:
+            return None
+        claimed = Job.objects.filter(pk=job.pk, status='queued').update(
+            status='running', locked_by=worker, locked_at=Now(), attempts=F('attempts') + 1)
+    if not claimed:
+        # Another worker got there first (only possible without row locks)
+        return None
+    job.status, job.locked_by, job.attempts = 'running', worker, job.attempts + 1
+    return job
+
+
+def execute(job):
+    """Run a claimed job, returns whether it succeeded"""
+    try:
+        func = TASKS.get(job.name)
+        if func is None:
+            raise LookupError(f'No task is registered as {job.name}')
+        func(**job.payload)
+    except Exception:
+        logger.exception("Job %s #%s failed (attempt %s of %s)", job.name, job.pk, job.attempts, job.max_attempts)
+        retry(job, traceback.format_exc(limit=5))
+        return False
+    Job.objects.filter(pk=job.pk).delete()
+    return True
+
+
+def retry(job, error):
+    if job.attempts >= job.max_attempts:
+        job.status = 'failed'
+    else:
+        job.status = 'queued'
+        job.run_at = timezone.now() + timedelta(seconds=backoff(job.attempts))
+    job.locked_by, job.locked_at, job.last_error = '', None, error
+    job.save(update_fields=['status', 'run_at', 'locked_by', 'locked_at', 'last_error'])
+
+
+def requeue_stale(timeout=None):
+    """Queue again the jobs of workers that died mid-run, returns how many"""
+    timeout = timeout if timeout is not None else _setting('JOB_LOCK_TIMEOUT', 600)
+    return Job.objects.filter(status='running', locked_at__lt=timezone.now() - timedelta(seconds=timeout)).update(
+        status='queued', locked_by='', locked_at=None)
+
+
+def run_pending(worker=None, limit=None):
+    """Run ready jobs in this thread until there are none left (or `limit` ran), returns (succeeded, failed)"""
+    worker = worker or worker_name()
+    succeeded = failed = 0
+    while limit is None or succeeded + failed < limit:
+        job = claim(worker)
+        if job is None:
+            break
+        if execute(job):
+            succeeded += 1
+        else:
+            failed += 1
+    return succeeded, failed
+
+
+def work(index, stop, poll=1.0):
+    """Worker thread: run jobs until `stop` is set, owns its database connection"""
+    worker = worker_name(index)
+    try:
+        while not stop.is_set():
+            close_old_connections()
+            try:
+                ran = sum(run_pending(worker, limit=100))
+            except Exception:
+                # The database went away or similar, keep the worker alive
+                logger.exception("Worker %s could not fetch jobs", worker)
+                ran = 0
+            if not ran:
+                stop.wait(poll)
+    finally:
+        connection.close()
+
+
+def serve(threads, stop, poll=1.0):
+    """Run `threads` worker threads until `stop` is set"""
+    workers = [threading.Thread(target=work, args=(index, stop, poll), name=f'jobs-{index}', daemon=True)
+               for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    last_sweep = 0
+    while not stop.is_set():
+        if time.monotonic() - last_sweep >= _setting('JOB_LOCK_TIMEOUT', 600) / 10:
+            close_old_connections()
+            try:
+                requeued = requeue_stale()
+            except Exception:
+                logger.exception("Could not requeue abandoned jobs")
+                requeued = 0
+            if requeued:
+                logger.warning("Requeued %s jobs left running by a dead worker", requeued)
+            last_sweep = time.monotonic()
+        stop.wait(poll)
+    for worker in workers:
+        worker.join()
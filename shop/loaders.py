@@ -0,0 +1,45 @@
+from decimal import Decimal
+
+from django.db.models import DecimalField,ExpressionWrapper,F,Prefetch,Sum,Value
+from django.db.models.functions import Coalesce
+
+from .models import Order,OrderItem,ShippingAddress
+
+
+def order_queryset(queryset=None, checked_out=False):
+    """
+    Orders with everything the order serializers read already loaded:
+    the customer, the items with their products and the shipping addresses
+    (oldest first, so the latest one is the last element).
+
+    Pass checked_out=True when only checked-out orders are listed: their
+    items carry a price snapshot, so the product join is skipped.
+    """
+    if queryset is None:
+        queryset = Order.objects.all()
+    items = OrderItem.objects.order_by('id')
+    if not checked_out:
+        items = items.select_related('product')
+    return queryset.select_related('customer').prefetch_related(
+        Prefetch('items', queryset=items),
+        Prefetch(
+            'shippingaddress_set',
+            queryset=ShippingAddress.objects.order_by('id'),
+            to_attr='prefetched_shipping',
+        ),
+    )
+
+
+def with_computed_totals(queryset=None):
+    """Annotate orders with totals summed from their items in SQL, preferring the price snapshot"""
+    if queryset is None:
+        queryset = Order.objects.all()
+    line_total = Coalesce(
+        'items__line_total',
+        ExpressionWrapper(F('items__quantity') * F('items__product__price'),
+                          output_field=DecimalField(max_digits=12, decimal_places=2)),
+    )
+    return queryset.annotate(
+        computed_items=Coalesce(Sum('items__quantity'), 0),
+        computed_price=Coalesce(Sum(line_total), Value(Decimal('0.00')), output_field=DecimalField(max_digits=12, decimal_places=2)),
+    )
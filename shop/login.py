@@ -0,0 +1,160 @@
+"""
+Login pipeline: rate limits in front of password hashing, and a bounded pool
+for the hashing itself.
+
+A login attempt is checked against two fixed-window counters kept in the
+cache before any hashing happens: every attempt counts against the client
+IP, failed attempts count against the username (a successful login resets
+it). Rejected attempts cost a couple of cache round trips instead of a full
+password hash.
+
+Hashing is the expensive part, so at most LOGIN_HASH_WORKERS attempts hash
+at once in a process. Sync views hash inline once they get a slot; the async
+login view hands the whole attempt to a dedicated thread pool so the event
+loop (and the single thread ASGI runs sync views on) is never blocked by it.
+When LOGIN_HASH_QUEUE attempts are already waiting, new ones are turned
+away with LoginBusy instead of piling up.
+"""
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import authenticate
+from django.db import close_old_connections
+
+from .cache import get_cache
+
+DEFAULT_RATE_LIMITS = {
+    'ip': (20, 60),
+    'username': (5, 300),
+}
+
+
+class LoginThrottled(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f'Too many login attempts, retry in {retry_after}s')
+        self.retry_after = retry_after
+
+
+class LoginBusy(Exception):
+    pass
+
+
+def _limits():
+    return getattr(settings, 'LOGIN_RATE_LIMITS', DEFAULT_RATE_LIMITS)
+
+
+def _window(scope, ident):
+    """(cache key, limit, seconds left in the window) or None when the scope is not limited"""
+    limit = _limits().get(scope)
+    if not limit or not ident:
+        return None
+    count, period = limit
+    window = int(time.time() // period)
+    return f'shop:login:{scope}:{ident.lower()}:{window}', count, period - int(time.time() % period)
+
+
+def _hit(cache, window):
+    key, count, remaining = window
+    if cache.add(key, 1, timeout=remaining + 1):
+        return 1
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # Expired between add() and incr()
+        cache.add(key, 1, timeout=remaining + 1)
+        return 1
+
+
+def check_rate(ip, username):
+    """Count the attempt against the IP and raise LoginThrottled when either limit is spent"""
+    cache = get_cache()
+    user_window = _window('username', username)
+    if user_window and (cache.get(user_window[0]) or 0) >= user_window[1]:
+        raise LoginThrottled(user_window[2])
+    ip_window = _window('ip', ip)
+    if ip_window and _hit(cache, ip_window) > ip_window[1]:
+        raise LoginThrottled(ip_window[2])
+
+
+def record_failure(username):
+    window = _window('username', username)
+    if window:
+        _hit(get_cache(), window)
+
+
+def record_success(username):
+    window = _window('username', username)
+    if window:
+        get_cache().delete(window[0])
+
+
+def _workers():
+    return getattr(settings, 'LOGIN_HASH_WORKERS', None) or min(4, os.cpu_count() or 1)
+
+
+_pool_lock = threading.Lock()
+_pool = {'executor': None, 'slots': None, 'waiting': 0, 'queued': 0}
+
+
+def _state():
+    with _pool_lock:
+        if _pool['slots'] is None:
+            _pool['slots'] = threading.BoundedSemaphore(_workers())
+        return _pool
+
+
+def _admit(pool, counter):
+    with _pool_lock:
+        if pool[counter] >= getattr(settings, 'LOGIN_HASH_QUEUE', 64):
+            raise LoginBusy
+        pool[counter] += 1
+
+
+def _leave(pool, counter):
+    with _pool_lock:
+        pool[counter] -= 1
+
+
+def authenticate_bounded(username, password):
+    """authenticate() once one of the LOGIN_HASH_WORKERS hashing slots is free"""
+    pool = _state()
+    _admit(pool, 'waiting')
+    try:
+        acquired = pool['slots'].acquire(timeout=getattr(settings, 'LOGIN_HASH_WAIT', 10))
+    finally:
+        _leave(pool, 'waiting')
+    if not acquired:
+        raise LoginBusy
+    try:
+        return authenticate(username=username, password=password)
+    finally:
+        pool['slots'].release()
+
+
+def _executor():
+    with _pool_lock:
+        if _pool['executor'] is None:
+            _pool['executor'] = ThreadPoolExecutor(max_workers=_workers(), thread_name_prefix='login-hash')
+        return _pool['executor']
+
+
+def _run(func, *args):
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+async def run_in_pool(func, *args):
+    """Await func(*args) run on the login hashing pool, LoginBusy when its queue is full"""
+    pool = _state()
+    _admit(pool, 'queued')
+    try:
+        return await asyncio.wrap_future(_executor().submit(_run, func, *args))
+    finally:
+        _leave(pool, 'queued')
@@ -0,0 +1,156 @@
+import json
+import platform
+from itertools import count
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+
+from shop.authentication import tokens_for
+from shop.benchmarks import PASSWORD, SCALES, measure, peak_memory, regressions, seed_dataset, summarize
+from shop.cache import CATALOG, invalidate
+from shop.carts import get_cart_store
+
+SCENARIOS = ['product_list', 'product_detail', 'cart_add', 'checkout', 'order_list', 'admin_order_list', 'sales_analytics', 'login']
+CHECKOUT_ADDRESS = {'address': 'Road 1', 'city': 'Dhaka', 'zip_code': '1200'}
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the API hot paths in-process on a synthetic dataset (rolled back afterwards). "
+        "Reports p50/p95/p99 latency, queries per request and peak allocated memory; --save writes "
+        "the results as a JSON baseline and --compare fails when they regress against one."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+        for name in SCALES['small']:
+            parser.add_argument(f'--{name}', type=int, help=f"override the number of {name} of the scale")
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=5)
+        parser.add_argument('--login-iterations', type=int, default=5, help="logins hash a password, keep them few")
+        parser.add_argument('--memory-samples', type=int, default=3)
+        parser.add_argument('--scenario', action='append', choices=SCENARIOS, help="run only these (repeatable)")
+        parser.add_argument('--cold', action='store_true', help="drop the catalog cache before every request")
+        parser.add_argument('--save', metavar='PATH', help="write the results as a JSON baseline")
+        parser.add_argument('--compare', metavar='PATH', help="fail when the results regress against this baseline")
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help="allowed latency/memory growth against the baseline (0.25 = 25%%)")
+
+    def handle(self, *args, **options):
+        size = dict(SCALES[options['scale']])
+        for name in size:
+            if options[name] is not None:
+                size[name] = options[name]
+        if size['users'] < 1 or size['categories'] < 1 or size['products'] < 1:
+            raise CommandError("users, categories and products must be at least 1")
+        baseline = self.load_baseline(options['compare']) if options['compare'] else None
+
+        overrides = {'ALLOWED_HOSTS': ['testserver'], 'LOGIN_RATE_LIMITS': {}, 'CART_FLUSH_INTERVAL': None}
+        results = {}
+        try:
+            with override_settings(**overrides), transaction.atomic():
+                self.stdout.write(f"Seeding {size} on {connection.vendor}...")
+                data = seed_dataset(**size)
+                invalidate(CATALOG)
+                for name in options['scenario'] or SCENARIOS:
+                    results[name] = self.run(name, data, options)
+                    self.report(name, results[name])
+                raise Rollback
+        except Rollback:
+            pass
+
+        document = {
+            'meta': {'vendor': connection.vendor, 'scale': size, 'python': platform.python_version()},
+            'results': results,
+        }
+        if options['save']:
+            with open(options['save'], 'w') as handle:
+                json.dump(document, handle, indent=2)
+            self.stdout.write(f"Baseline written to {options['save']}")
+        if baseline is not None:
+            self.check_baseline(baseline, document, options['tolerance'])
+
+    def load_baseline(self, path):
+        try:
+            with open(path) as handle:
+                return json.load(handle)
+        except (OSError, ValueError) as exc:
+            raise CommandError(f"Cannot read baseline {path}: {exc}")
+
+    def client_for(self, user):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens_for(user).access_token}')
+        return client
+
+    def scenario(self, name, data, options):
+        """(request, setup) callables for a scenario"""
+        customer, admin, products = data['customers'][0], data['admin'], data['products']
+        in_stock = [product for product in products if product.stock]
+        ids = count()
+        before = (lambda: invalidate(CATALOG)) if options['cold'] else None
+
+        if name == 'product_list':
+            client = self.client_for(customer)
+            return lambda: self.call(client.get, '/api/products/'), before
+        if name == 'product_detail':
+            client = self.client_for(customer)
+            return lambda: self.call(client.get, f'/api/products/{products[next(ids) % len(products)].pk}/'), before
+        if name == 'cart_add':
+            client = self.client_for(customer)
+            return lambda: self.call(client.post, '/api/cart/', {
+                'product_id': in_stock[next(ids) % len(in_stock)].pk, 'quantity': 1}, expect=201), None
+        if name == 'checkout':
+            client = self.client_for(customer)
+            cart = get_cart_store().get_cart(customer)
+            setup = lambda: cart.add(in_stock[next(ids) % len(in_stock)], 1)  # noqa: E731
+            return lambda: self.call(client.post, '/api/checkout/', CHECKOUT_ADDRESS, expect=201), setup
+        if name == 'order_list':
+            client = self.client_for(customer)
+            return lambda: self.call(client.get, '/api/orders/'), None
+        if name == 'admin_order_list':
+            client = self.client_for(admin)
+            return lambda: self.call(client.get, '/api/admin/orders/'), None
+        if name == 'sales_analytics':
+            client = self.client_for(admin)
+            return lambda: self.call(client.get, '/api/admin/analytics/sales/'), None
+        if name == 'login':
+            client = APIClient()
+            return lambda: self.call(client.post, '/api/login/', {'username': customer.username, 'password': PASSWORD}), None
+        raise CommandError(f"Unknown scenario {name}")
+
+    def call(self, method, url, data=None, expect=200):
+        response = method(url, data) if data is not None else method(url)
+        if response.status_code != expect:
+            raise CommandError(f"{url} answered {response.status_code}: {getattr(response, 'data', '')}")
+        return response
+
+    def run(self, name, data, options):
+        request, setup = self.scenario(name, data, options)
+        iterations = options['login_iterations'] if name == 'login' else options['iterations']
+        warmup = min(options['warmup'], 1) if name == 'login' else options['warmup']
+        latencies, queries = measure(request, iterations, warmup=warmup, setup=setup)
+        memory = peak_memory(request, options['memory_samples'], setup=setup)
+        return summarize(latencies, queries, memory)
+
+    def report(self, name, result):
+        self.stdout.write(
+            f"{name:<18} p50 {result['p50_ms']:9.2f} ms  p95 {result['p95_ms']:9.2f} ms  "
+            f"p99 {result['p99_ms']:9.2f} ms  {result['queries_per_request']:6.1f} queries  "
+            f"{result['peak_memory_kib']:9.1f} KiB"
+        )
+
+    def check_baseline(self, baseline, document, tolerance):
+        if baseline.get('meta', {}).get('vendor') != document['meta']['vendor']:
+            self.stderr.write("Warning: the baseline was recorded on a different database")
+        if baseline.get('meta', {}).get('scale') != document['meta']['scale']:
+            self.stderr.write("Warning: the baseline was recorded at a different scale")
+        found = regressions(baseline.get('results', {}), document['results'], tolerance)
+        if found:
+            raise CommandError("Regressions against the baseline:\n  " + "\n  ".join(found))
+        self.stdout.write(self.style.SUCCESS("No regressions against the baseline"))
@@ -0,0 +1,137 @@
+import asyncio
+import statistics
+import time
+
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from django.urls import include, path
+
+from shop.async_views import AsyncCartView, AsyncCategoryListView, AsyncOrderListView, AsyncProductDetailView, AsyncProductListView
+from shop.authentication import tokens_for
+from shop.cache import CATALOG, invalidate
+from shop.models import Category, CustomUser, Order, OrderItem, Product, ShippingAddress
+from shop.views import CartAPI, CategoryCreateOrListView, OrderListAPIView, ProductDetailOrDeleteView, ProductListCreateAPIView
+
+PREFIX = 'bench-async'
+
+# (route, sync view, async view)
+ROUTES = [
+    ('products/', ProductListCreateAPIView, AsyncProductListView),
+    ('products/<int:pk>/', ProductDetailOrDeleteView, AsyncProductDetailView),
+    ('categories/', CategoryCreateOrListView, AsyncCategoryListView),
+    ('cart/', CartAPI, AsyncCartView),
+    ('orders/', OrderListAPIView, AsyncOrderListView),
+]
+
+
+def urlconf(mode):
+    """URLconf serving the benchmarked routes with the sync or the async views"""
+    patterns = [path(route, (sync_view if mode == 'sync' else async_view).as_view())
+                for route, sync_view, async_view in ROUTES]
+    return type(f'{mode.title()}Routes', (), {'urlpatterns': [path('api/', include(patterns))]})
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test the sync and async read views through Django's ASGI handler with concurrent "
+        "requests. Seeds its own rows in the configured database and deletes them afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500, help="requests per endpoint and mode")
+        parser.add_argument('--concurrency', type=int, default=20)
+        parser.add_argument('--products', type=int, default=200)
+        parser.add_argument('--orders', type=int, default=20)
+        parser.add_argument('--cold', action='store_true', help="drop the catalog cache before every request")
+
+    def handle(self, *args, **options):
+        user, product = self.seed(options['products'], options['orders'])
+        try:
+            token = str(tokens_for(user).access_token)
+            urls = ['/api/products/', f'/api/products/{product.pk}/', '/api/categories/', '/api/cart/', '/api/orders/']
+            self.stdout.write(f"{'endpoint':<24} {'mode':<6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8}")
+            for url in urls:
+                for mode in ('sync', 'async'):
+                    invalidate(CATALOG)
+                    with override_settings(ROOT_URLCONF=urlconf(mode), ALLOWED_HOSTS=['testserver']):
+                        rate, latencies = asyncio.run(self.load(url, token, options))
+                    self.stdout.write(
+                        f"{url:<24} {mode:<6} {rate:8.1f} "
+                        f"{statistics.median(latencies):8.2f} {statistics.quantiles(latencies, n=20)[-1]:8.2f}"
+                    )
+        finally:
+            self.cleanup()
+
+    def seed(self, product_count, order_count):
+        self.cleanup()
+        category = Category.objects.create(name='Bench async', slug=PREFIX)
+        products = Product.objects.bulk_create([
+            Product(category=category, title=f'Async product {i}', slug=f'{PREFIX}-{i}',
+                    description='bench', price=10 + i, stock=1000)
+            for i in range(product_count)
+        ])
+        user = CustomUser.objects.create(username=PREFIX, email=f'{PREFIX}@example.com')
+        for _ in range(order_count):
+            order = Order.objects.create(customer=user, is_checked_out=True)
+            OrderItem.objects.bulk_create([OrderItem(order=order, product=p, quantity=1) for p in products[:3]])
+            order.snapshot_prices()
+            order.save()
+            ShippingAddress.objects.create(user=user, order=order, address='Road 1', city='Dhaka', zip_code='1200')
+        cart = Order.objects.create(customer=user)
+        OrderItem.objects.bulk_create([OrderItem(order=cart, product=p, quantity=2) for p in products[:5]])
+        invalidate(CATALOG)
+        return user, products[0]
+
+    def cleanup(self):
+        CustomUser.objects.filter(username=PREFIX).delete()
+        Product.objects.filter(slug__startswith=f'{PREFIX}-').delete()
+        Category.objects.filter(slug=PREFIX).delete()
+        invalidate(CATALOG)
+
+    async def load(self, url, token, options):
+        app = ASGIHandler()
+        gate = asyncio.Semaphore(options['concurrency'])
+        latencies = []
+
+        async def one():
+            async with gate:
+                if options['cold']:
+                    invalidate(CATALOG)
+                start = time.perf_counter()
+                status = await self.request(app, url, token)
+                latencies.append((time.perf_counter() - start) * 1000)
+                if status != 200:
+                    raise CommandError(f"GET {url} answered {status}")
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(options['requests'])))
+        return options['requests'] / (time.perf_counter() - start), latencies
+
+    async def request(self, app, url, token):
+        """One GET through the ASGI application, returns the status code"""
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+            'method': 'GET', 'scheme': 'http', 'path': url, 'raw_path': url.encode(),
+            'query_string': b'', 'root_path': '',
+            'headers': [(b'host', b'testserver'), (b'authorization', f'Bearer {token}'.encode())],
+            'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+        }
+        events = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+        finished = asyncio.Event()
+        status = {}
+
+        async def receive():
+            if events:
+                return events.pop(0)
+            await finished.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status['code'] = message['status']
+            elif message['type'] == 'http.response.body' and not message.get('more_body'):
+                finished.set()
+
+        await app(scope, receive, send)
+        return status.get('code')
@@ -0,0 +1,66 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIClient
+
+from shop.cache import get_cache
+from shop.models import Category, CustomUser, Product
+
+BACKENDS = {
+    'database': 'shop.carts.DatabaseCartStore',
+    'cache': 'shop.carts.CacheCartStore',
+}
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Compare add-to-cart throughput of the cart stores (all writes are rolled back)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--products', type=int, default=50)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                user, products = self.seed(options['products'])
+                for name, path in BACKENDS.items():
+                    with override_settings(CART_STORE=path, CART_FLUSH_INTERVAL=None, ALLOWED_HOSTS=['testserver']):
+                        self.run(name, user, products, options['requests'])
+                    get_cache().delete(f'shop:cart:{user.pk}')
+                raise Rollback
+        except Rollback:
+            pass
+
+    def seed(self, count):
+        category = Category.objects.create(name='Bench cart', slug='bench-cart')
+        products = Product.objects.bulk_create([
+            Product(category=category, title=f'Cart product {i}', slug=f'bench-cart-{i}',
+                    description='bench', price=10 + i, stock=1000)
+            for i in range(count)
+        ])
+        user = CustomUser.objects.create(username='bench-cart', email='bench-cart@example.com')
+        return user, products
+
+    def run(self, name, user, products, requests):
+        client = APIClient()
+        client.force_authenticate(user)
+        client.get('/api/cart/')
+
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for i in range(requests):
+                response = client.post('/api/cart/', {'product_id': products[i % len(products)].pk, 'quantity': 1})
+                if response.status_code != 201:
+                    raise CommandError(f"{name}: add to cart failed with {response.status_code}")
+            elapsed = time.perf_counter() - start
+
+        self.stdout.write(
+            f"{name:<9} {requests / elapsed:8.1f} adds/s   {elapsed / requests * 1000:6.2f} ms/add   "
+            f"{len(queries) / requests:5.1f} queries/add"
+        )
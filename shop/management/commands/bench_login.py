@@ -0,0 +1,69 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+
+from shop.models import CustomUser
+
+PASSWORD = 'bench-pass-12345'
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Measure logins/sec per core for each configured password hasher (all writes are rolled back)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--logins', type=int, default=20)
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="threads used to measure how hashing scales across cores")
+
+    def handle(self, *args, **options):
+        hashers = [path for path in settings.PASSWORD_HASHERS if 'SHA1' not in path]
+        self.stdout.write(f"{'hasher':<48} {'login/s/core':>12} {'ms/login':>9} {'hash/s x' + str(options['workers']):>12}")
+        for path in hashers:
+            with override_settings(PASSWORD_HASHERS=[path], LOGIN_RATE_LIMITS={}, ALLOWED_HOSTS=['testserver']):
+                try:
+                    encoded = make_password(PASSWORD)
+                except ValueError as exc:
+                    self.stdout.write(f"{path:<48} skipped: {exc}")
+                    continue
+                per_core = self.logins(encoded, options['logins'])
+                parallel = self.hashes(encoded, options['logins'], options['workers'])
+            self.stdout.write(f"{path:<48} {per_core:12.1f} {1000 / per_core:9.1f} {parallel:12.1f}")
+
+    def logins(self, encoded, count):
+        """End to end POST /api/login/ on one thread: rate limit check, hash, tokens"""
+        client = APIClient()
+        try:
+            with transaction.atomic():
+                CustomUser.objects.create(username='bench-login', email='bench-login@example.com', password=encoded)
+                start = time.perf_counter()
+                for _ in range(count):
+                    response = client.post('/api/login/', {'username': 'bench-login', 'password': PASSWORD})
+                    if response.status_code != 200:
+                        raise CommandError(f"login failed with {response.status_code}")
+                elapsed = time.perf_counter() - start
+                raise Rollback
+        except Rollback:
+            pass
+        return count / elapsed
+
+    def hashes(self, encoded, count, workers):
+        """Password checks per second with `workers` threads, the hashers release the GIL"""
+        total = count * workers
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            start = time.perf_counter()
+            results = list(pool.map(lambda _: check_password(PASSWORD, encoded), range(total)))
+            elapsed = time.perf_counter() - start
+        if not all(results):
+            raise CommandError("password check failed")
+        return total / elapsed
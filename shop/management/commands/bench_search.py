@@ -0,0 +1,100 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+
+from shop.cache import CATALOG, invalidate
+from shop.models import Category, Product
+from shop.search import search_products
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'ten', 'so', 'vi', 'pro', 'max', 'ul', 'tra', 'ne', 'zo', 'fi', 'dur']
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Benchmark product search against icontains scans on a synthetic catalog (rolled back afterwards)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=200000)
+        parser.add_argument('--queries', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        vocabulary = sorted({''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(3000)})
+        queries = [rng.choice(vocabulary) for _ in range(options['queries'])]
+
+        try:
+            with transaction.atomic():
+                self.seed(rng, vocabulary, options['products'])
+                self.run(queries)
+                raise Rollback
+        except Rollback:
+            pass
+        invalidate(CATALOG)
+
+    def seed(self, rng, vocabulary, count):
+        self.stdout.write(f"Seeding {count} products on {connection.vendor}...")
+        categories = Category.objects.bulk_create([
+            Category(name=f'Bench category {i}', slug=f'bench-category-{i}') for i in range(20)
+        ])
+        batch = []
+        for i in range(count):
+            batch.append(Product(
+                category=rng.choice(categories),
+                title=' '.join(rng.choices(vocabulary, k=3)),
+                slug=f'bench-product-{i}',
+                description=' '.join(rng.choices(vocabulary, k=25)),
+                price=rng.randint(1, 2000),
+                stock=rng.randint(0, 50),
+            ))
+            if len(batch) == 5000:
+                Product.objects.bulk_create(batch)
+                batch = []
+        Product.objects.bulk_create(batch)
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE shop_product")
+        invalidate(CATALOG)
+
+    def time_queries(self, queries, run):
+        timings = []
+        for query in queries:
+            start = time.perf_counter()
+            run(query)
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+    def report(self, label, timings):
+        ordered = sorted(timings)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        self.stdout.write(
+            f"{label:<12} mean {statistics.mean(timings):8.2f} ms   "
+            f"p50 {statistics.median(timings):8.2f} ms   p95 {p95:8.2f} ms"
+        )
+
+    def run(self, queries):
+        if connection.vendor != 'postgresql':
+            start = time.perf_counter()
+            search_products(queries[0])
+            self.stdout.write(f"Inverted index built in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+        search = self.time_queries(queries, lambda q: search_products(q, limit=20))
+        icontains = self.time_queries(queries, lambda q: list(
+            Product.objects.select_related('category').filter(
+                Q(title__icontains=q) | Q(description__icontains=q))[:20]))
+        # A misspelled query, only the search path can answer it
+        typo = self.time_queries([q[:-1] + 'x' for q in queries], lambda q: search_products(q, limit=20))
+
+        self.report('search', search)
+        self.report('search typo', typo)
+        self.report('icontains', icontains)
+        self.stdout.write(self.style.SUCCESS(
+            f"search is {statistics.mean(icontains) / statistics.mean(search):.1f}x faster than icontains on average"
+        ))
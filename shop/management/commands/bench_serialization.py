@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from rest_framework.renderers import JSONRenderer
+
+from shop.benchmarks import measure, peak_memory, seed_dataset, summarize
+from shop.loaders import order_queryset
+from shop.models import Order
+from shop.projection import OrderProjection
+from shop.serializers import OrderSerializer
+
+SUMMARY_FIELDS = 'id,created_at,status,payment_status,total_price,total_items'
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare building an order list with OrderSerializer against the values() projection, "
+        "full and summary, on a synthetic dataset (rolled back afterwards). Times include the "
+        "queries and rendering the JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=10000)
+        parser.add_argument('--items', type=int, default=3, help="items per order")
+        parser.add_argument('--iterations', type=int, default=5)
+        parser.add_argument('--memory-samples', type=int, default=1)
+
+    def handle(self, *args, **options):
+        if options['orders'] < 1 or options['iterations'] < 1:
+            raise CommandError("--orders and --iterations must be at least 1")
+        renderer = JSONRenderer()
+        modes = [
+            ('serializer', lambda orders: OrderSerializer(order_queryset(orders, checked_out=True), many=True).data),
+            ('values', lambda orders: OrderProjection(checked_out=True).project(orders)),
+            ('values summary', lambda orders: OrderProjection.from_params({'fields': SUMMARY_FIELDS}).project(orders)),
+        ]
+        try:
+            with transaction.atomic():
+                self.stdout.write(f"Seeding {options['orders']} orders on {connection.vendor}...")
+                seed_dataset(users=10, categories=5, products=max(options['items'], 500),
+                             orders=options['orders'], items=options['items'])
+                orders = Order.objects.filter(is_checked_out=True).order_by('-created_at', '-id')
+
+                baseline = None
+                for name, build in modes:
+                    request = lambda build=build: renderer.render(build(orders))  # noqa: E731
+                    latencies, queries = measure(request, options['iterations'], warmup=1)
+                    result = summarize(latencies, queries, peak_memory(request, options['memory_samples']))
+                    baseline = baseline or result['p50_ms']
+                    self.stdout.write(
+                        f"{name:<16} p50 {result['p50_ms']:9.1f} ms  "
+                        f"{options['orders'] / result['p50_ms'] * 1000:10.0f} rows/s  "
+                        f"{baseline / result['p50_ms']:5.1f}x  {result['queries_per_request']:4.0f} queries  "
+                        f"{result['peak_memory_kib'] / 1024:7.1f} MiB"
+                    )
+                raise Rollback
+        except Rollback:
+            pass
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from shop import bulk
+
+
+class Command(BaseCommand):
+    help = "Stream the catalog as CSV or NDJSON, in the layout import_products reads"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', dest='file_format', choices=bulk.FORMATS, default='csv')
+        parser.add_argument('--output', help="File to write, defaults to stdout")
+
+    def handle(self, *args, **options):
+        chunks = bulk.export_products(options['file_format'])
+        if not options['output']:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+            return
+        with open(options['output'], 'w', newline='') as out:
+            for chunk in chunks:
+                out.write(chunk)
@@ -0,0 +1,34 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.images import is_stale, run_in_worker
+from shop.models import Product
+
+
+class Command(BaseCommand):
+    help = (
+        "Render the resized WebP variants of product images that have none yet (or all of them "
+        "with --force), several products at a time."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help="re-render products whose variants are current")
+        parser.add_argument('--workers', type=int, default=4)
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError("--workers must be at least 1")
+        rows = Product.objects.exclude(image='').exclude(image__isnull=True).values_list('pk', 'image', 'image_variants')
+        pending = [pk for pk, image, variants in rows.iterator() if options['force'] or is_stale(image, variants)]
+        if not pending:
+            self.stdout.write(self.style.SUCCESS("Every product image has its variants"))
+            return
+
+        self.stdout.write(f"Rendering variants for {len(pending)} products with {options['workers']} workers...")
+        with ThreadPoolExecutor(max_workers=options['workers'], thread_name_prefix='image-backfill') as pool:
+            results = list(pool.map(lambda pk: run_in_worker(pk, options['force']), pending))
+        failed = results.count(False)
+        if failed:
+            raise CommandError(f"{failed} of {len(pending)} products were not updated, see the 'shop.images' log")
+        self.stdout.write(self.style.SUCCESS(f"Rendered variants for {len(pending)} products"))
@@ -0,0 +1,30 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shop import bulk
+
+
+class Command(BaseCommand):
+    help = "Upsert products by slug from a CSV or NDJSON file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', dest='file_format', choices=bulk.FORMATS,
+                            help="Defaults to the file extension")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        file_format = options['file_format'] or bulk.guess_format(options['path'])
+        if file_format is None:
+            raise CommandError("Cannot tell the format from the file name, pass --format")
+
+        with open(options['path'], 'rb') as binary:
+            report = bulk.import_products(bulk.text_stream(binary), file_format,
+                                          batch_size=max(1, options['batch_size']))
+
+        for error in report.errors:
+            self.stderr.write(f"row {error['row']}: {json.dumps(error['errors'])}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {report.imported} of {report.rows} rows, {report.error_count} failed"
+        ))
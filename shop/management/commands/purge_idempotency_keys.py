@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from shop.idempotency import purge_expired
+
+
+class Command(BaseCommand):
+    help = "Delete the stored Idempotency-Key responses older than IDEMPOTENCY_KEY_TTL"
+
+    def handle(self, *args, **options):
+        count = purge_expired()
+        self.stdout.write(self.style.SUCCESS(f"Purged {count} expired idempotency keys"))
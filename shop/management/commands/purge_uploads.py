@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from shop.uploads import purge_expired
+
+
+class Command(BaseCommand):
+    help = "Delete chunked uploads left open for longer than UPLOAD_SESSION_TTL, with their temp files"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ttl', type=int, help="idle seconds after which an upload expires")
+
+    def handle(self, *args, **options):
+        count = purge_expired(options['ttl'])
+        self.stdout.write(self.style.SUCCESS(f"Purged {count} expired uploads"))
@@ -0,0 +1,31 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.analytics import rebuild_rollups
+
+
+def iso_date(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f"{value} is not a date as YYYY-MM-DD")
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the daily sales rollups from the orders, e.g. after orders were written in bulk "
+        "or with queryset.update(). Rebuilds every day unless --from/--to narrow it down."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='date_from', type=str, help="first day to rebuild (YYYY-MM-DD)")
+        parser.add_argument('--to', dest='date_to', type=str, help="last day to rebuild (YYYY-MM-DD)")
+
+    def handle(self, *args, **options):
+        date_from = iso_date(options['date_from']) if options['date_from'] else None
+        date_to = iso_date(options['date_to']) if options['date_to'] else None
+        if date_from and date_to and date_from > date_to:
+            raise CommandError("--from must not be after --to")
+        sales, products = rebuild_rollups(date_from, date_to)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {sales} daily sales rows and {products} daily product rows"))
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F, Q
+
+from shop.loaders import with_computed_totals
+from shop.models import Order
+
+
+class Command(BaseCommand):
+    help = "Check the stored Order.total_price/total_items against the items and repair drift"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help="Only report mismatches, exit with status 1 if any are found")
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        mismatched = with_computed_totals().filter(
+            ~Q(total_items=F('computed_items')) | ~Q(total_price=F('computed_price'))
+        ).order_by('pk')
+
+        fixed = []
+        count = 0
+        for order in mismatched.iterator(chunk_size=batch_size):
+            count += 1
+            self.stdout.write(
+                f"Order #{order.pk}: stored {order.total_items} items / {order.total_price}, "
+                f"computed {order.computed_items} items / {order.computed_price}"
+            )
+            if options['check']:
+                continue
+            order.total_items = order.computed_items
+            order.total_price = order.computed_price
+            fixed.append(order)
+            if len(fixed) >= batch_size:
+                Order.objects.bulk_update(fixed, ['total_items', 'total_price'])
+                fixed = []
+        if fixed:
+            Order.objects.bulk_update(fixed, ['total_items', 'total_price'])
+
+        if not count:
+            self.stdout.write(self.style.SUCCESS("All order totals are consistent"))
+        elif options['check']:
+            raise CommandError(f"{count} orders have stale totals")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Repaired totals on {count} orders"))
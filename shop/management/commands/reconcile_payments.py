@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.payments import reconcile
+
+
+class Command(BaseCommand):
+    help = (
+        "Ask the payment gateway about online payments still pending after --older-than seconds "
+        "and settle them, --batch-size orders at a time. Makes up for lost webhooks."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--older-than', type=int, default=300, help="seconds since the order last changed")
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1")
+        results = reconcile(options['batch_size'], options['older_than'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Settled {results['updated']} payments, {results['pending']} still pending, "
+            f"{results['duplicate']} already settled, {results['unknown']} unknown"))
@@ -0,0 +1,65 @@
+import multiprocessing
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from shop.jobs import requeue_stale, run_pending, serve
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the background job workers: --threads worker threads in each of --processes "
+        "processes, until interrupted. --once runs the ready jobs in this thread and exits."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, help="worker threads per process (JOB_WORKERS by default)")
+        parser.add_argument('--processes', type=int, default=1, help="worker processes, forked from this one")
+        parser.add_argument('--poll', type=float, default=1.0, help="seconds between polls of an empty queue")
+        parser.add_argument('--once', action='store_true', help="run the jobs that are ready now, then exit")
+
+    def handle(self, *args, **options):
+        if options['once']:
+            requeue_stale()
+            succeeded, failed = run_pending()
+            self.stdout.write(self.style.SUCCESS(f"Ran {succeeded + failed} jobs, {failed} failed"))
+            return
+
+        threads = options['threads'] or getattr(settings, 'JOB_WORKERS', 4)
+        if threads < 1 or options['processes'] < 1:
+            raise CommandError("--threads and --processes must be at least 1")
+
+        stop = threading.Event()
+        if options['processes'] == 1:
+            self.stop_on_signals(stop)
+            self.stdout.write(f"Running jobs with {threads} threads, Ctrl-C to stop")
+            serve(threads, stop, options['poll'])
+            return
+
+        # The children must not share the parent's database connections
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        children = [context.Process(target=self.child, args=(threads, options['poll']), name=f'jobs-{index}')
+                    for index in range(options['processes'])]
+        for child in children:
+            child.start()
+        self.stdout.write(f"Running jobs with {options['processes']} processes of {threads} threads, Ctrl-C to stop")
+        self.stop_on_signals(stop)
+        stop.wait()
+        for child in children:
+            child.terminate()
+        for child in children:
+            child.join()
+
+    def child(self, threads, poll):
+        stop = threading.Event()
+        self.stop_on_signals(stop)
+        serve(threads, stop, poll)
+
+    def stop_on_signals(self, stop):
+        # Let the running jobs finish, then exit
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stop.set())
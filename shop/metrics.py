@@ -0,0 +1,243 @@
+"""
+Per-endpoint request metrics.
+
+MetricsMiddleware times every request and, through a database execute
+wrapper, counts its queries and the time spent in them. Serialization time
+is the time DRF spends rendering the Response (TimedJSONRenderer) or the
+async views spend encoding their JsonResponse. Everything is folded into
+in-process histograms keyed by URL name, exported in the Prometheus text
+format by MetricsAPIView.
+
+The execute wrapper is installed once per database connection and finds
+the request it belongs to through a context variable, which asgiref copies
+into the threads sync views and the async ORM run on.
+
+Slow-query log: with METRICS_SLOW_SAMPLE_RATE above 0, that fraction of
+requests also record the SQL of their queries, and the ones slower than
+METRICS_SLOW_REQUEST_MS are logged to the 'shop.metrics' logger. Requests
+that are not sampled only pay for a counter and two clock reads per query.
+"""
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from rest_framework.renderers import JSONRenderer
+
+logger = logging.getLogger('shop.metrics')
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+MAX_LOGGED_QUERIES = 20
+
+# name: (help, buckets, RequestMetrics attribute)
+HISTOGRAMS = {
+    'shop_request_duration_seconds': ('Wall time of the request', SECONDS_BUCKETS, 'wall'),
+    'shop_request_db_seconds': ('Time spent in database queries', SECONDS_BUCKETS, 'db_time'),
+    'shop_request_serialize_seconds': ('Time spent rendering the response body', SECONDS_BUCKETS, 'serialize_time'),
+    'shop_request_queries': ('Database queries per request', QUERY_BUCKETS, 'queries'),
+}
+
+_current = ContextVar('shop_request_metrics', default=None)
+
+
+class RequestMetrics:
+    __slots__ = ('wall', 'queries', 'db_time', 'serialize_time', 'sql')
+
+    def __init__(self, sampled=False):
+        self.wall = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+        # Only sampled requests keep their SQL
+        self.sql = [] if sampled else None
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+_lock = threading.Lock()
+_histograms = {}
+_requests = {}
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper, see install_query_recorder()"""
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.queries += 1
+        metrics.db_time += elapsed
+        if metrics.sql is not None:
+            metrics.sql.append((elapsed, sql))
+
+
+def install_query_recorder(sender=None, connection=None, **kwargs):
+    """connection_created receiver: add record_query to the connection's execute wrappers"""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@contextmanager
+def serialization():
+    """Count the time spent in the block as serialization time of the current request"""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.serialize_time += time.perf_counter() - start
+
+
+class TimedJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with serialization():
+            return super().render(data, accepted_media_type, renderer_context)
+
+
+def endpoint_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.url_name or match.route
+
+
+def observe(request, response, metrics):
+    endpoint = endpoint_name(request)
+    status = response.status_code if response is not None else 500
+    with _lock:
+        key = (endpoint, request.method, status)
+        _requests[key] = _requests.get(key, 0) + 1
+        for name, (_, buckets, attr) in HISTOGRAMS.items():
+            histogram = _histograms.get((name, endpoint))
+            if histogram is None:
+                histogram = _histograms[(name, endpoint)] = Histogram(buckets)
+            histogram.observe(getattr(metrics, attr))
+
+    threshold = getattr(settings, 'METRICS_SLOW_REQUEST_MS', 500)
+    if metrics.sql is not None and metrics.wall * 1000 >= threshold:
+        slowest = sorted(metrics.sql, reverse=True)[:MAX_LOGGED_QUERIES]
+        logger.warning(
+            "Slow request %s %s (%s): %.1f ms, %d queries in %.1f ms\n%s",
+            request.method, request.get_full_path(), endpoint, metrics.wall * 1000,
+            metrics.queries, metrics.db_time * 1000,
+            '\n'.join(f'  {elapsed * 1000:8.2f} ms  {sql}' for elapsed, sql in slowest),
+        )
+
+
+def _sampled():
+    rate = getattr(settings, 'METRICS_SLOW_SAMPLE_RATE', 0)
+    return rate > 0 and random.random() < rate
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        metrics = RequestMetrics(_sampled())
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        response = None
+        try:
+            response = self.get_response(request)
+            return response
+        finally:
+            metrics.wall = time.perf_counter() - start
+            _current.reset(token)
+            observe(request, response, metrics)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics(_sampled())
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        response = None
+        try:
+            response = await self.get_response(request)
+            return response
+        finally:
+            metrics.wall = time.perf_counter() - start
+            _current.reset(token)
+            observe(request, response, metrics)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def export_prometheus():
+    """All metrics of this process in the Prometheus text exposition format"""
+    with _lock:
+        requests = sorted(_requests.items())
+        histograms = {key: (list(h.counts), h.sum, h.count) for key, h in _histograms.items()}
+
+    lines = [
+        '# HELP shop_requests_total Requests handled, by endpoint, method and status',
+        '# TYPE shop_requests_total counter',
+    ]
+    for (endpoint, method, status), count in requests:
+        lines.append(f'shop_requests_total{{{_labels(endpoint=endpoint, method=method, status=status)}}} {count}')
+
+    for name, (help_text, buckets, _) in HISTOGRAMS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        for (metric, endpoint), (counts, total, count) in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{{_labels(endpoint=endpoint, le=_number(bound))}}} {cumulative}')
+            lines.append(f'{name}_bucket{{{_labels(endpoint=endpoint, le="+Inf")}}} {count}')
+            lines.append(f'{name}_sum{{{_labels(endpoint=endpoint)}}} {_number(total)}')
+            lines.append(f'{name}_count{{{_labels(endpoint=endpoint)}}} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+def reset_metrics():
+    with _lock:
+        _histograms.clear()
+        _requests.clear()
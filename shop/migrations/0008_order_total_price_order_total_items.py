@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:55
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import DecimalField, ExpressionWrapper, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_totals(apps, schema_editor):
+    Order = apps.get_model('shop', 'Order')
+    OrderItem = apps.get_model('shop', 'OrderItem')
+    items = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order')
+    line_total = ExpressionWrapper(F('quantity') * F('product__price'),
+                                   output_field=DecimalField(max_digits=12, decimal_places=2))
+    Order.objects.update(
+        total_items=Coalesce(Subquery(items.annotate(s=Sum('quantity')).values('s')), 0),
+        total_price=Coalesce(Subquery(items.annotate(s=Sum(line_total)).values('s')), Value(Decimal('0.00')),
+                             output_field=DecimalField(max_digits=12, decimal_places=2)),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0007_product_created_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='total_items',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_price',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.RunPython(backfill_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def backfill_snapshot(apps, schema_editor):
+    """Snapshot current product prices onto items of already checked-out orders"""
+    OrderItem = apps.get_model('shop', 'OrderItem')
+    pending = OrderItem.objects.filter(order__is_checked_out=True, unit_price__isnull=True).order_by('pk')
+    last_pk = 0
+    while True:
+        batch = list(pending.filter(pk__gt=last_pk).select_related('product')[:BATCH_SIZE])
+        if not batch:
+            break
+        for item in batch:
+            item.product_title = item.product.title
+            item.unit_price = item.product.price
+            item.line_total = item.product.price * item.quantity
+        OrderItem.objects.bulk_update(batch, ['product_title', 'unit_price', 'line_total'])
+        last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0009_orderitem_price_snapshot'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_snapshot, migrations.RunPython.noop),
+    ]
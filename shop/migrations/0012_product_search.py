@@ -0,0 +1,75 @@
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+FORWARD_SQL = [
+    "CREATE INDEX product_search_vector_idx ON shop_product USING gin (search_vector)",
+    "CREATE INDEX product_title_trgm_idx ON shop_product USING gin (title gin_trgm_ops)",
+    """
+    CREATE FUNCTION shop_product_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector :=
+            setweight(to_tsvector('pg_catalog.english', coalesce(NEW.title, '')), 'A') ||
+            setweight(to_tsvector('pg_catalog.english', coalesce(NEW.description, '')), 'B');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER shop_product_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF title, description ON shop_product
+    FOR EACH ROW EXECUTE FUNCTION shop_product_search_vector_update()
+    """,
+    # Fire the trigger once for the rows that already exist
+    "UPDATE shop_product SET title = title",
+]
+
+REVERSE_SQL = [
+    "DROP TRIGGER IF EXISTS shop_product_search_vector_trigger ON shop_product",
+    "DROP FUNCTION IF EXISTS shop_product_search_vector_update()",
+    "DROP INDEX IF EXISTS product_title_trgm_idx",
+    "DROP INDEX IF EXISTS product_search_vector_idx",
+]
+
+
+def run_on_postgres(statements):
+    def operation(apps, schema_editor):
+        # GIN indexes and plpgsql triggers only exist on PostgreSQL, other
+        # databases use the in-process index in shop/search.py
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0011_updated_at'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='product',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='product',
+                    index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='product_search_vector_idx'),
+                ),
+                migrations.AddIndex(
+                    model_name='product',
+                    index=django.contrib.postgres.indexes.GinIndex(fields=['title'], name='product_title_trgm_idx', opclasses=['gin_trgm_ops']),
+                ),
+            ],
+            database_operations=[
+                migrations.RunPython(run_on_postgres(FORWARD_SQL), run_on_postgres(REVERSE_SQL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+
+def backfill_rollups(apps, schema_editor):
+    """Roll up the orders checked out before the rollups existed"""
+    Order = apps.get_model('shop', 'Order')
+    OrderItem = apps.get_model('shop', 'OrderItem')
+    DailySales = apps.get_model('shop', 'DailySales')
+    DailyProductSales = apps.get_model('shop', 'DailyProductSales')
+
+    orders = Order.objects.filter(is_checked_out=True).order_by().annotate(day=TruncDate('created_at'))
+    DailySales.objects.bulk_create([
+        DailySales(day=row['day'], status=row['status'], payment_status=row['payment_status'],
+                   orders=row['n'], items=row['units'] or 0, revenue=row['sales'] or 0)
+        for row in orders.values('day', 'status', 'payment_status').annotate(
+            n=Count('id'), units=Sum('total_items'), sales=Sum('total_price'))
+    ], batch_size=1000)
+
+    lines = OrderItem.objects.filter(order__is_checked_out=True).exclude(order__status='cancelled').order_by()
+    DailyProductSales.objects.bulk_create([
+        DailyProductSales(day=row['day'], product_id=row['product_id'], quantity=row['units'], revenue=row['sales'] or 0)
+        for row in lines.annotate(day=TruncDate('order__created_at')).values('day', 'product_id').annotate(
+            units=Sum('quantity'), sales=Sum('line_total'))
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0014_customuser_token_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('shipped', 'Shipped'), ('delivered', 'Delivered'), ('cancelled', 'Cancelled')], max_length=20)),
+                ('payment_status', models.CharField(choices=[('success', 'Success'), ('in_progress', 'In Progress')], max_length=20)),
+                ('orders', models.IntegerField(default=0)),
+                ('items', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('day', 'status', 'payment_status'), name='daily_sales_key')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyProductSales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('quantity', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_sales', to='shop.product')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('day', 'product'), name='daily_product_sales_key')],
+            },
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
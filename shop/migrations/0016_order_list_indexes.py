@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0015_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['is_checked_out', '-created_at', '-id'], name='order_checked_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['is_checked_out', 'status', '-created_at', '-id'], name='order_checked_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['is_checked_out', 'payment_status', '-created_at', '-id'], name='order_checked_payment_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['customer', 'is_checked_out', '-created_at', '-id'], name='order_customer_created_idx'),
+        ),
+    ]
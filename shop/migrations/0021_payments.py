@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:56
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def clear_duplicate_transaction_ids(apps, schema_editor):
+    """Blank ids become NULL and only the first order keeps a shared one, so the unique index builds"""
+    Order = apps.get_model('shop', 'Order')
+    Order.objects.filter(transaction_id='').update(transaction_id=None)
+    shared = Order.objects.exclude(transaction_id=None).values('transaction_id').annotate(n=Count('id')).filter(n__gt=1)
+    for row in shared:
+        first = Order.objects.filter(transaction_id=row['transaction_id']).order_by('id').values_list('id', flat=True)[0]
+        Order.objects.filter(transaction_id=row['transaction_id']).exclude(id=first).update(transaction_id=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0020_job_queue'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_duplicate_transaction_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='dailysales',
+            name='payment_status',
+            field=models.CharField(choices=[('success', 'Success'), ('in_progress', 'In Progress'), ('failed', 'Failed')], max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='payment_status',
+            field=models.CharField(choices=[('success', 'Success'), ('in_progress', 'In Progress'), ('failed', 'Failed')], default='in_progress', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='transaction_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+    ]
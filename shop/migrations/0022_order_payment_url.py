@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0021_payments'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='payment_url',
+            field=models.URLField(blank=True, default='', max_length=500),
+        ),
+    ]
@@ -1,5 +1,13 @@
+import uuid
+from decimal import Decimal
+
 from django.db import models
+from django.db.models import F
+from django.db.models.functions import Now
+from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 
 # Custom user model
 class CustomUser(AbstractUser):
@@ -10,6 +18,7 @@ class CustomUser(AbstractUser):
     )
     email = models.EmailField(unique=True)  # Email must be unique
     role = models.CharField(max_length=20, choices=ROLE_CHOICES, default='customer')
+    token_version = models.PositiveIntegerField(default=0)  # bumped to revoke issued JWTs
 
     def __str__(self):
         return self.username
@@ -20,6 +29,7 @@ class CustomUser(AbstractUser):
 class Category(models.Model):
     name = models.CharField(max_length=100)
     slug = models.SlugField(unique=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.name
@@ -34,7 +44,24 @@ class Product(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2)
     stock = models.PositiveIntegerField()
     image = models.ImageField(upload_to='products/', blank=True, null=True)
+    # Downscaled WebP renditions of image, written by shop/images.py
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Weighted title/description tsvector, maintained by a database trigger on PostgreSQL
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Backs keyset pagination of the product list
+            models.Index(fields=['-created_at', '-id'], name='product_created_id_idx'),
+            # Catalog filters: category with a price range, and in/out of stock
+            models.Index(fields=['category', 'price'], name='product_category_price_idx'),
+            models.Index(fields=['stock'], name='product_stock_idx'),
+            # Full-text and typo tolerant search, PostgreSQL only (see migration 0012)
+            GinIndex(fields=['search_vector'], name='product_search_vector_idx'),
+            GinIndex(fields=['title'], opclasses=['gin_trgm_ops'], name='product_title_trgm_idx'),
+        ]
 
     def __str__(self):
         return self.title
@@ -56,11 +83,13 @@ class Order(models.Model):
 
     PAYMENT_STATUS=[
         ('success','Success'),
-        ('in_progress','In Progress')
+        ('in_progress','In Progress'),
+        ('failed','Failed')
     ]
 
     customer = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
     is_checked_out=models.BooleanField(default=False)
     completed = models.BooleanField(default=False)  # Used for cart vs order
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')  # ✅ new field
@@ -68,7 +97,24 @@ class Order(models.Model):
     #payment info
     payment_method=models.CharField(max_length=20,choices=PAYMENT_METHODS,default="COD")
     payment_status=models.CharField(max_length=20,choices=PAYMENT_STATUS,default='in_progress')
-    transaction_id=models.CharField(max_length=100,null=True,blank=True)
+    #the gateway's id of the order's payment, webhooks and reconciliation look orders up by it
+    transaction_id=models.CharField(max_length=100,null=True,blank=True,unique=True)
+    #where the customer completes that payment, handed out again when they retry
+    payment_url=models.URLField(max_length=500,blank=True,default='')
+
+    #stored totals, kept in step with the items by adjust_totals()
+    total_price=models.DecimalField(max_digits=12,decimal_places=2,default=0)
+    total_items=models.PositiveIntegerField(default=0)
+
+    class Meta:
+        # Equality filters first, then the (created_at, id) keyset order of the order lists
+        indexes = [
+            models.Index(fields=['is_checked_out', '-created_at', '-id'], name='order_checked_created_idx'),
+            models.Index(fields=['is_checked_out', 'status', '-created_at', '-id'], name='order_checked_status_idx'),
+            models.Index(fields=['is_checked_out', 'payment_status', '-created_at', '-id'], name='order_checked_payment_idx'),
+            # Admin filter by customer, the customer's own order list and the open cart lookup
+            models.Index(fields=['customer', 'is_checked_out', '-created_at', '-id'], name='order_customer_created_idx'),
+        ]
     
     @property
     def get_cart_total(self):
@@ -82,6 +128,32 @@ class Order(models.Model):
         items=self.items.all()
         return sum([item.quantity for item in items])
 
+    def snapshot_prices(self):
+        """Freeze the current product prices onto the items and the order totals"""
+        items = list(self.items.select_related('product'))
+        for item in items:
+            item.product_title = item.product.title
+            item.unit_price = item.product.price
+            item.line_total = item.unit_price * item.quantity
+        OrderItem.objects.bulk_update(items, ['product_title', 'unit_price', 'line_total'])
+        self.total_items = sum(item.quantity for item in items)
+        self.total_price = sum((item.line_total for item in items), Decimal('0.00'))
+
+    def adjust_totals(self, quantity, amount):
+        """Shift the stored totals by an item change in a single UPDATE"""
+        Order.objects.filter(pk=self.pk).update(
+            total_items=F('total_items') + quantity,
+            total_price=F('total_price') + amount,
+            updated_at=Now(),
+        )
+
+    @property
+    def latest_shipping_address(self):
+        """Most recent shipping address, read from the prefetch when loaded"""
+        if hasattr(self, 'prefetched_shipping'):
+            return self.prefetched_shipping[-1] if self.prefetched_shipping else None
+        return self.shippingaddress_set.order_by('id').last()
+
     def __str__(self):
         return f"Order #{self.id} by {self.customer.username} - {self.status}"
 
@@ -91,10 +163,25 @@ class OrderItem(models.Model):
     order = models.ForeignKey(Order, related_name='items', on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
+
+    #snapshot taken at checkout, so order history never reads the live product
+    product_title = models.CharField(max_length=200, blank=True)
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    line_total = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True)
+
+    @property
+    def get_product_title(self):
+        return self.product_title or self.product.title
+
+    @property
+    def get_unit_price(self):
+        return self.unit_price if self.unit_price is not None else self.product.price
     
     @property
     def get_total(self):
         """Total price of this item"""
+        if self.line_total is not None:
+            return self.line_total
         return self.product.price*self.quantity
 
     def __str__(self):
@@ -112,3 +199,113 @@ class ShippingAddress(models.Model):
 
     def __str__(self):
         return f"{self.address}, {self.city}"
+
+
+# Sales rollups, maintained incrementally by shop/analytics.py as orders change state
+class DailySales(models.Model):
+    """Checked-out orders of one day with one status/payment status pair"""
+    day = models.DateField()
+    status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES)
+    payment_status = models.CharField(max_length=20, choices=Order.PAYMENT_STATUS)
+    orders = models.IntegerField(default=0)
+    items = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'status', 'payment_status'], name='daily_sales_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.status}/{self.payment_status}: {self.orders} orders"
+
+
+class DailyProductSales(models.Model):
+    """Units and revenue of one product on one day, cancelled orders excluded"""
+    day = models.DateField()
+    product = models.ForeignKey(Product, related_name='daily_sales', on_delete=models.CASCADE)
+    quantity = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'product'], name='daily_product_sales_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.product_id}: {self.quantity} units"
+
+
+
+# Chunked upload of a product image, see shop/uploads.py
+class MediaUpload(models.Model):
+    STATUS_CHOICES = [
+        ('open', 'Open'),
+        ('complete', 'Complete'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    product = models.ForeignKey(Product, related_name='uploads', on_delete=models.CASCADE)
+    created_by = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    sha256 = models.CharField(max_length=64)
+    # Bytes received so far, always a prefix of the file
+    received = models.PositiveBigIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='open')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Upload {self.id} of {self.filename} ({self.received}/{self.size})"
+
+
+# The stored response of a request sent with an Idempotency-Key, see shop/idempotency.py
+class IdempotencyKey(models.Model):
+    user = models.ForeignKey(CustomUser, related_name='idempotency_keys', on_delete=models.CASCADE)
+    key = models.CharField(max_length=255)
+    # SHA-256 of the method, path and body of the request the response belongs to
+    fingerprint = models.CharField(max_length=64, blank=True)
+    # None until a response is stored
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='idempotency_key_per_user'),
+        ]
+
+    def __str__(self):
+        return f"{self.key} of user {self.user_id}: {self.status_code}"
+
+
+# A background job, queued and run by shop/jobs.py
+class Job(models.Model):
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('failed', 'Failed'),
+    ]
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    # Runs so far, including the current one
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        # The dequeue: status = 'queued' AND run_at <= now ORDER BY run_at, id
+        indexes = [
+            models.Index(fields=['status', 'run_at', 'id'], name='job_ready_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.id} ({self.status}, attempt {self.attempts})"
@@ -0,0 +1,78 @@
+"""
+Order emails and low-stock alerts, sent by the job queue (shop/jobs.py).
+
+order_changed() is called from the Order post_save signal with the sales
+states before and after the save. It queues an email to the customer when
+an order is placed (checked out) and when it moves to shipped, delivered or
+cancelled. reserve_stock() calls stock_reserved() with the products whose
+stock fell to LOW_STOCK_THRESHOLD or below in that checkout. The admins are
+told about those once, when the stock crosses the threshold, not on every
+later sale.
+"""
+from django.conf import settings
+from django.core.mail import send_mail
+
+from . import jobs
+from .models import CustomUser, Order, Product
+
+# Order status: subject of the email sent when an order reaches it
+STATUS_SUBJECTS = {
+    'shipped': 'Your order #{id} has shipped',
+    'delivered': 'Your order #{id} was delivered',
+    'cancelled': 'Your order #{id} was cancelled',
+}
+PLACED_SUBJECT = 'We received your order #{id}'
+
+
+def order_changed(order, before, after):
+    """Queue the customer email for an order that was placed or changed status"""
+    if after is None:
+        return
+    if before is None:
+        jobs.enqueue('order_email', {'order_id': order.pk, 'event': 'placed'})
+    elif before.status != after.status and after.status in STATUS_SUBJECTS:
+        jobs.enqueue('order_email', {'order_id': order.pk, 'event': after.status})
+
+
+def low_stock_threshold():
+    return getattr(settings, 'LOW_STOCK_THRESHOLD', 5)
+
+
+def stock_reserved(crossed):
+    """Queue a low-stock alert for the product ids whose stock just fell to the threshold"""
+    if crossed:
+        jobs.enqueue('low_stock_alert', {'product_ids': sorted(crossed)})
+
+
+@jobs.task('order_email')
+def send_order_email(order_id, event):
+    order = Order.objects.select_related('customer').filter(pk=order_id).first()
+    if order is None or not order.customer.email:
+        return
+    subject = (PLACED_SUBJECT if event == 'placed' else STATUS_SUBJECTS[event]).format(id=order.pk)
+    lines = [
+        f"Hello {order.customer.username},",
+        "",
+        f"{subject}.",
+        "",
+    ]
+    lines += [f"  {item.quantity} x {item.get_product_title} ({item.get_total})" for item in order.items.select_related('product')]
+    lines += [
+        "",
+        f"Total: {order.total_price}",
+        f"Status: {order.get_status_display()}, payment: {order.get_payment_status_display()}",
+    ]
+    send_mail(subject, "\n".join(lines), None, [order.customer.email])
+
+
+@jobs.task('low_stock_alert')
+def send_low_stock_alert(product_ids):
+    recipients = getattr(settings, 'LOW_STOCK_ALERT_EMAILS', None) or list(
+        CustomUser.objects.filter(role='admin', is_active=True).exclude(email='').values_list('email', flat=True))
+    products = Product.objects.filter(pk__in=product_ids).order_by('id').values_list('id', 'title', 'stock')
+    if not recipients or not products:
+        return
+    lines = [f"  #{product_id} {title}: {stock} left" for product_id, title, stock in products]
+    send_mail(f"Low stock on {len(lines)} product(s)",
+              f"Stock is at or below {low_stock_threshold()} for:\n\n" + "\n".join(lines),
+              None, recipients)
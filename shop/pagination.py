@@ -0,0 +1,129 @@
+import base64
+import json
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination keyed on (created_at, id), newest first.
+
+    The cursor is an opaque base64 token holding the boundary row and the
+    direction, so a page is always a single indexed range scan and we never
+    run COUNT(*) or OFFSET over the whole table.
+    """
+    page_size_setting = 'PRODUCT_PAGE_SIZE'
+    default_page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def get_page_size(self, request):
+        page_size = getattr(settings, self.page_size_setting, self.default_page_size)
+        try:
+            requested = int(request.query_params[self.page_size_query_param])
+            if requested > 0:
+                page_size = requested
+        except (KeyError, ValueError):
+            pass
+        return min(page_size, self.max_page_size)
+
+    def encode_cursor(self, obj, reverse):
+        # Pages hold model instances or, from a projection, values() rows
+        created_at, pk = (obj['created_at'], obj['id']) if isinstance(obj, dict) else (obj.created_at, obj.pk)
+        payload = {'c': created_at.isoformat(), 'i': pk, 'r': int(reverse)}
+        return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+    def decode_cursor(self, request):
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(token.encode()))
+            created_at = parse_datetime(payload['c'])
+            if created_at is None:
+                raise ValueError
+            return created_at, int(payload['i']), bool(payload['r'])
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def page_queryset(self, queryset, request):
+        """The queryset slice holding the requested page plus one extra row"""
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        cursor = self.decode_cursor(request)
+        self.has_cursor = cursor is not None
+
+        self.reverse = False
+        if cursor:
+            created_at, pk, self.reverse = cursor
+            if self.reverse:
+                # Walking back towards newer rows
+                queryset = queryset.filter(
+                    Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk)
+                ).order_by('created_at', 'id')
+            else:
+                queryset = queryset.filter(
+                    Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+                ).order_by('-created_at', '-id')
+        else:
+            queryset = queryset.order_by('-created_at', '-id')
+
+        # Fetch one extra row to know whether there is another page
+        return queryset[:self.page_size + 1]
+
+    def set_page(self, rows):
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if self.reverse:
+            rows.reverse()
+
+        self.page = rows
+        if self.reverse:
+            self.has_next = bool(rows)
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = self.has_cursor and bool(rows)
+        return rows
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.set_page(list(self.page_queryset(queryset, request)))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        return self.set_page([row async for row in self.page_queryset(queryset, request)])
+
+    def build_link(self, cursor):
+        params = self.request.query_params.copy()
+        params[self.cursor_query_param] = cursor
+        return self.request.build_absolute_uri(self.request.path) + '?' + params.urlencode()
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.build_link(self.encode_cursor(self.page[-1], reverse=False))
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.build_link(self.encode_cursor(self.page[0], reverse=True))
+
+    def get_paginated_data(self, data):
+        return {
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'page_size': self.page_size,
+            'results': data,
+        }
+
+
+class OrderKeysetPagination(KeysetPagination):
+    """Same cursor over Order.(created_at, id), sized by ADMIN_ORDER_PAGE_SIZE"""
+    page_size_setting = 'ADMIN_ORDER_PAGE_SIZE'
+    default_page_size = 50
+    max_page_size = 500
@@ -0,0 +1,243 @@
+"""
+Online payments.
+
+A PAYMENT_GATEWAY class talks to the payment provider: create_charge()
+starts the payment of an order and returns the provider's transaction id,
+fetch_statuses() asks for the outcome and amount of a batch of them, and
+parse_webhook() checks the signature of a callback and returns its event.
+A payment is only recorded as successful when the gateway's amount is
+the order's total.
+SimulatorGateway settles charges in memory for tests and local
+development.
+
+A transaction id is unique per order, so a callback finds its order through
+the unique index. settle() moves an order from in_progress to success or
+failed with one conditional UPDATE. A repeated or out-of-date callback
+matches no row and changes nothing. The row lock is held only for the rest
+of that short transaction, so bursts of callbacks for different orders
+don't wait on each other. Callbacks that never arrive are made up for by
+the reconcile_payments command, which asks the gateway about pending
+payments in batches and settles them the same way.
+
+Webhooks are signed with HMAC-SHA256 over "<timestamp>.<body>" using
+PAYMENT_WEBHOOK_SECRET, sent as "Payment-Signature: t=<timestamp>,v1=<hex>".
+Signatures older than PAYMENT_WEBHOOK_TOLERANCE seconds are refused, so a
+captured callback can't be replayed later.
+"""
+import hashlib
+import hmac
+import json
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Value, When
+from django.db.models.functions import Now
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import analytics
+from .models import Order
+
+SIGNATURE_HEADER = 'Payment-Signature'
+# Gateway outcome: Order.payment_status
+OUTCOMES = {'succeeded': 'success', 'failed': 'failed'}
+
+Charge = namedtuple('Charge', 'transaction_id redirect_url')
+
+
+class PaymentError(Exception):
+    pass
+
+
+class InvalidSignature(PaymentError):
+    pass
+
+
+def webhook_secret():
+    return getattr(settings, 'PAYMENT_WEBHOOK_SECRET', '') or settings.SECRET_KEY
+
+
+def sign(body, timestamp=None, secret=None):
+    """Payment-Signature header value for a webhook body"""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    digest = hmac.new((secret or webhook_secret()).encode(), f'{timestamp}.'.encode() + body, hashlib.sha256)
+    return f't={timestamp},v1={digest.hexdigest()}'
+
+
+def verify_signature(body, header, secret=None, tolerance=None):
+    """Raises InvalidSignature unless `header` signs `body` and is recent"""
+    tolerance = tolerance if tolerance is not None else getattr(settings, 'PAYMENT_WEBHOOK_TOLERANCE', 300)
+    try:
+        parts = dict(part.split('=', 1) for part in (header or '').split(','))
+        timestamp = int(parts['t'])
+    except (KeyError, ValueError):
+        raise InvalidSignature(f'{SIGNATURE_HEADER} must be "t=<timestamp>,v1=<signature>"')
+    if abs(time.time() - timestamp) > tolerance:
+        raise InvalidSignature('The signature has expired')
+    expected = sign(body, timestamp, secret).split('v1=', 1)[1]
+    if not hmac.compare_digest(expected, parts.get('v1', '')):
+        raise InvalidSignature('The signature does not match')
+
+
+class PaymentGateway(ABC):
+    """What the payment subsystem needs from a provider"""
+
+    @abstractmethod
+    def create_charge(self, order):
+        """Start the payment of the order's total, returns a Charge"""
+
+    @abstractmethod
+    def fetch_statuses(self, transaction_ids):
+        """
+        {transaction id: {'status': 'pending' | 'succeeded' | 'failed', 'amount': Decimal or None}}
+        for a batch of charges
+        """
+
+    def parse_webhook(self, body, headers):
+        """The event of a callback as {'transaction_id', 'status', 'amount'}, raises PaymentError"""
+        verify_signature(body, headers.get(SIGNATURE_HEADER))
+        try:
+            event = json.loads(body)
+            return {
+                'transaction_id': str(event['transaction_id']),
+                'status': str(event['status']),
+                'amount': Decimal(str(event['amount'])) if event.get('amount') is not None else None,
+            }
+        except (ValueError, TypeError, KeyError, InvalidOperation):
+            raise PaymentError('The callback is not a payment event')
+
+
+class SimulatorGateway(PaymentGateway):
+    """A gateway that keeps its charges in memory and settles them when told to"""
+
+    _lock = threading.Lock()
+    _charges = {}
+
+    def create_charge(self, order):
+        transaction_id = f'sim_{uuid.uuid4().hex}'
+        with self._lock:
+            self._charges[transaction_id] = {'amount': Decimal(order.total_price), 'status': 'pending'}
+        return Charge(transaction_id, f'https://simulator.invalid/pay/{transaction_id}')
+
+    def fetch_statuses(self, transaction_ids):
+        with self._lock:
+            return {tid: dict(self._charges[tid]) for tid in transaction_ids if tid in self._charges}
+
+    def complete(self, transaction_id, status='succeeded'):
+        """Settle a charge as the customer would, returns the (body, headers) of its webhook"""
+        with self._lock:
+            charge = self._charges[transaction_id]
+            charge['status'] = status
+        body = json.dumps({'transaction_id': transaction_id, 'status': status, 'amount': str(charge['amount'])}).encode()
+        return body, {SIGNATURE_HEADER: sign(body)}
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._charges.clear()
+
+
+def get_gateway():
+    return import_string(getattr(settings, 'PAYMENT_GATEWAY', 'shop.payments.SimulatorGateway'))()
+
+
+def _record_payment_change(transaction_id, previous):
+    """Apply a payment status change made with a queryset UPDATE (no signals) to the sales rollups"""
+    order = Order.objects.get(transaction_id=transaction_id)
+    after = analytics.order_state(order)
+    if after is not None:
+        analytics.record_change(order, after._replace(payment_status=previous), after)
+    return order
+
+
+def start_payment(order, gateway=None):
+    """
+    The charge for an online order's payment. A retry while it is pending
+    gets the same transaction id and redirect URL back, after a failed
+    payment a new charge is created.
+    """
+    if order.payment_status == 'success':
+        raise PaymentError('The order is already paid')
+    if order.transaction_id and order.payment_status == 'in_progress':
+        return Charge(order.transaction_id, order.payment_url or None)
+    charge = (gateway or get_gateway()).create_charge(order)
+    with transaction.atomic():
+        claimed = Order.objects.filter(
+            pk=order.pk, transaction_id=order.transaction_id, payment_status=order.payment_status,
+        ).update(transaction_id=charge.transaction_id, payment_url=charge.redirect_url or '',
+                 payment_status='in_progress', updated_at=Now())
+        if claimed and order.payment_status != 'in_progress':
+            _record_payment_change(charge.transaction_id, order.payment_status)
+    if not claimed:
+        # A concurrent request attached its charge first
+        order.refresh_from_db(fields=['transaction_id', 'payment_url', 'payment_status'])
+        return Charge(order.transaction_id, order.payment_url or None)
+    order.transaction_id, order.payment_status = charge.transaction_id, 'in_progress'
+    order.payment_url = charge.redirect_url or ''
+    return charge
+
+
+def settle(transaction_id, outcome, amount=None):
+    """
+    Record the gateway's outcome of a payment. Returns 'updated', 'duplicate'
+    (already settled), 'ignored' (not final yet), 'unknown' (no such
+    transaction) or 'mismatch' (a success without an amount, or not for the
+    order's total, nothing is changed).
+    """
+    payment_status = OUTCOMES.get(outcome)
+    if payment_status is None:
+        # Nothing to record until the payment is final
+        return 'ignored'
+    pending = Order.objects.filter(transaction_id=transaction_id, payment_status='in_progress')
+    if payment_status == 'success':
+        # Never mark an order paid without knowing what was paid
+        pending = pending.filter(total_price=amount) if amount is not None else pending.none()
+
+    with transaction.atomic():
+        updated = pending.update(
+            payment_status=payment_status,
+            # What AdminOrderUpdateView does: paid and delivered is complete
+            completed=Case(When(status='delivered', then=Value(payment_status == 'success')), default=Value(False)),
+            updated_at=Now(),
+        )
+        if updated:
+            _record_payment_change(transaction_id, 'in_progress')
+            return 'updated'
+
+    current = Order.objects.filter(transaction_id=transaction_id).values_list('payment_status', flat=True).first()
+    if current is None:
+        return 'unknown'
+    if current == 'in_progress':
+        return 'mismatch'
+    return 'duplicate'
+
+
+def reconcile(batch_size=100, older_than=300, gateway=None):
+    """Settle the online payments pending for longer than `older_than` seconds, returns {result: count}"""
+    gateway = gateway or get_gateway()
+    pending = Order.objects.filter(
+        is_checked_out=True, payment_status='in_progress', transaction_id__isnull=False,
+        updated_at__lt=timezone.now() - timedelta(seconds=older_than),
+    ).order_by('id')
+    results = {'updated': 0, 'duplicate': 0, 'unknown': 0, 'mismatch': 0, 'pending': 0}
+    last_id = 0
+    while True:
+        # Keyset batches, settled orders drop out of the filter as we go
+        batch = list(pending.filter(id__gt=last_id).values_list('id', 'transaction_id')[:batch_size])
+        if not batch:
+            return results
+        last_id = batch[-1][0]
+        statuses = gateway.fetch_statuses([transaction_id for _, transaction_id in batch])
+        for _, transaction_id in batch:
+            charge = statuses.get(transaction_id, {'status': 'pending', 'amount': None})
+            if charge['status'] in OUTCOMES:
+                results[settle(transaction_id, charge['status'], charge['amount'])] += 1
+            else:
+                results['pending'] += 1
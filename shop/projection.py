@@ -0,0 +1,210 @@
+"""
+Projections for the list endpoints.
+
+?fields=id,status,total_price picks the fields of every row and
+?expand=items,shipping_address adds nested ones. When only expand is given,
+the resource's summary fields come with it. Without either, the full
+representation is returned, exactly as the model serializers render it.
+
+Lists are built from .values() rows into plain dicts, with no model
+instances and no serializer per row. An expanded relation that is not a
+join costs one more query for the whole page. Dates and decimals are
+formatted by the same DRF fields the serializers use, so both paths produce
+identical JSON.
+"""
+from rest_framework import serializers
+
+from .images import variant_map
+from .models import OrderItem, Product, ShippingAddress
+from .serializers import AdminOrderSerializer, OrderSerializer, ProductSerializer
+
+
+class InvalidProjection(ValueError):
+    pass
+
+
+def _split(value):
+    if value is None:
+        return None
+    return [name.strip() for name in value.split(',') if name.strip()]
+
+
+def column(lookup, field=None):
+    """(lookups, getter) of a field read from one values() column, formatted by a DRF field if given"""
+    if field is None:
+        return (lookup,), lambda row: row[lookup]
+
+    def get(row):
+        value = row[lookup]
+        return None if value is None else field.to_representation(value)
+    return (lookup,), get
+
+
+class Projection:
+    # name: (values() lookups, getter(row)) of the fields read from the main query
+    columns = {}
+    # Fields that need a query of their own, built by related_<name>() and fold_<name>()
+    relations = {}
+    # Field names accepted by ?expand=
+    nested = ()
+    # Field order of the full representation, the serializer's Meta.fields
+    full = ()
+    # Always read, e.g. for the pagination cursor
+    required = ('id',)
+
+    def __init__(self, fields=None):
+        selected = set(self.full if fields is None else fields)
+        self.fields = [name for name in self.full if name in selected]
+        self.getters = [(name, self.columns[name][1]) for name in self.fields if name in self.columns]
+        self.expanded = [name for name in self.fields if name in self.relations]
+
+    @classmethod
+    def summary(cls):
+        return [name for name in cls.full if name not in cls.nested]
+
+    @classmethod
+    def from_params(cls, params, **kwargs):
+        """The projection asked for by ?fields= and ?expand=, raises InvalidProjection"""
+        fields, expand = _split(params.get('fields')), _split(params.get('expand'))
+        unknown = sorted(set(fields or ()) - set(cls.full))
+        if unknown:
+            raise InvalidProjection(f"Unknown field(s) {', '.join(unknown)}, choose from {', '.join(cls.full)}")
+        unknown = sorted(set(expand or ()) - set(cls.nested))
+        if unknown:
+            raise InvalidProjection(f"Cannot expand {', '.join(unknown)}, choose from {', '.join(cls.nested)}")
+        if fields is None and expand is not None:
+            fields = cls.summary()
+        if fields is not None:
+            fields = set(fields) | set(expand or ())
+        return cls(fields, **kwargs)
+
+    def values(self, queryset):
+        lookups = dict.fromkeys(self.required)
+        for name, _ in self.getters:
+            lookups.update(dict.fromkeys(self.columns[name][0]))
+        return queryset.values(*lookups)
+
+    def related_querysets(self, ids):
+        return {name: getattr(self, f'related_{name}')(ids) for name in self.expanded}
+
+    def build(self, rows, related):
+        folded = {name: getattr(self, f'fold_{name}')(related[name]) for name in self.expanded}
+        getters = self.getters
+        results = []
+        for row in rows:
+            item = {name: get(row) for name, get in getters}
+            for name in self.expanded:
+                item[name] = folded[name].get(row['id'], self.relations[name])
+            if self.expanded:
+                # Back into the declared field order
+                item = {name: item[name] for name in self.fields}
+            results.append(item)
+        return results
+
+    def render(self, rows):
+        """Dicts for values() rows, one query per expanded relation"""
+        if not rows:
+            return []
+        related = self.related_querysets([row['id'] for row in rows])
+        return self.build(rows, {name: list(queryset) for name, queryset in related.items()})
+
+    async def arender(self, rows):
+        if not rows:
+            return []
+        related = self.related_querysets([row['id'] for row in rows])
+        return self.build(rows, {name: [row async for row in queryset] for name, queryset in related.items()})
+
+    def project(self, queryset):
+        return self.render(list(self.values(queryset)))
+
+    async def aproject(self, queryset):
+        return await self.arender([row async for row in self.values(queryset)])
+
+
+class OrderProjection(Projection):
+    columns = {
+        'id': column('id'),
+        'customer': column('customer_id'),
+        'customer_name': column('customer__username'),
+        'created_at': column('created_at', serializers.DateTimeField()),
+        'status': column('status'),
+        'payment_method': column('payment_method'),
+        'payment_status': column('payment_status'),
+        'is_checked_out': column('is_checked_out'),
+        'completed': column('completed'),
+        'total_price': column('total_price'),
+        'total_items': column('total_items'),
+    }
+    # name: value for an order without any
+    relations = {'items': [], 'shipping_address': None}
+    nested = ('items', 'shipping_address')
+    full = tuple(OrderSerializer.Meta.fields)
+    required = ('id', 'created_at')
+
+    def __init__(self, fields=None, checked_out=False):
+        super().__init__(fields)
+        # Items of checked-out orders carry a price snapshot, the product join is skipped
+        self.checked_out = checked_out
+
+    def related_items(self, ids):
+        lookups = ['order_id', 'id', 'product_id', 'quantity', 'product_title', 'unit_price', 'line_total']
+        if not self.checked_out:
+            # Cart items have no snapshot yet, fall back to the live product like OrderItem's properties
+            lookups += ['product__title', 'product__price']
+        return OrderItem.objects.filter(order_id__in=ids).order_by('id').values(*lookups)
+
+    def fold_items(self, rows):
+        items = {}
+        for row in rows:
+            price, total = row['unit_price'], row['line_total']
+            if price is None:
+                price = row['product__price']
+            if total is None:
+                total = row['product__price'] * row['quantity']
+            items.setdefault(row['order_id'], []).append({
+                'id': row['id'],
+                'product': row['product_id'],
+                'product_title': row['product_title'] or row.get('product__title'),
+                'product_price': price,
+                'quantity': row['quantity'],
+                'item_total_price': total,
+            })
+        return items
+
+    def related_shipping_address(self, ids):
+        return ShippingAddress.objects.filter(order_id__in=ids).order_by('id').values(
+            'order_id', 'address', 'city', 'zip_code')
+
+    def fold_shipping_address(self, rows):
+        # Oldest first, so the latest address of each order wins
+        return {row.pop('order_id'): row for row in rows}
+
+
+class AdminOrderProjection(OrderProjection):
+    full = tuple(AdminOrderSerializer.Meta.fields)
+
+
+def _image_url(name, storage=Product._meta.get_field('image').storage):
+    # What ImageField renders without a request in the serializer context
+    return storage.url(name) if name else None
+
+
+class ProductProjection(Projection):
+    columns = {
+        'id': column('id'),
+        'title': column('title'),
+        'description': column('description'),
+        'price': column('price', serializers.DecimalField(max_digits=10, decimal_places=2)),
+        'stock': column('stock'),
+        'image': (('image',), lambda row: _image_url(row['image'])),
+        'image_variants': (('image', 'image_variants'), lambda row: variant_map(row['image'], row['image_variants'])),
+        'slug': column('slug'),
+        # Joined in the main query, so expanding it costs nothing extra
+        'category': (
+            ('category_id', 'category__name', 'category__slug'),
+            lambda row: {'id': row['category_id'], 'name': row['category__name'], 'slug': row['category__slug']},
+        ),
+    }
+    nested = ('category',)
+    full = tuple(name for name in ProductSerializer.Meta.fields if name != 'category_id')
+    required = ('id', 'created_at')
@@ -0,0 +1,133 @@
+"""
+Product search.
+
+On PostgreSQL the search runs against Product.search_vector, a weighted
+tsvector kept up to date by a trigger (see migration 0012) and backed by a
+GIN index, with pg_trgm similarity on the title for typo tolerance. Other
+databases (SQLite in tests) fall back to an in-process inverted index that
+is rebuilt whenever the catalog cache version moves.
+"""
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+from django.db import connection
+from django.db.models import F, Q
+
+from .cache import CATALOG, namespace_version
+from .filters import filter_products
+from .models import Product
+
+SEARCH_CONFIG = 'english'
+TRIGRAM_THRESHOLD = 0.3
+TITLE_WEIGHT = 2.0
+DESCRIPTION_WEIGHT = 1.0
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return [token for token in TOKEN_RE.findall(text.lower()) if len(token) > 1]
+
+
+def trigrams(word):
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def trigram_similarity(a, b):
+    """Same measure as pg_trgm's similarity(): shared trigrams over all trigrams"""
+    ta, tb = trigrams(a), trigrams(b)
+    if not ta or not tb:
+        return 0.0
+    return len(ta & tb) / len(ta | tb)
+
+
+class InvertedIndex:
+    """Token -> {product id: weight} postings for the whole catalog"""
+
+    def __init__(self, rows):
+        self.postings = defaultdict(dict)
+        self.products = {}
+        self.trigram_vocabulary = defaultdict(set)
+        for pk, title, description, category_id, price in rows:
+            self.products[pk] = (category_id, price)
+            weights = Counter()
+            for token in tokenize(title):
+                weights[token] += TITLE_WEIGHT
+            for token in tokenize(description):
+                weights[token] += DESCRIPTION_WEIGHT
+            for token, weight in weights.items():
+                self.postings[token][pk] = weight
+        for token in self.postings:
+            for gram in trigrams(token):
+                self.trigram_vocabulary[gram].add(token)
+
+    def expand(self, token):
+        """The token itself, or the closest indexed tokens when it is misspelled"""
+        if token in self.postings:
+            return [(token, 1.0)]
+        candidates = set()
+        for gram in trigrams(token):
+            candidates |= self.trigram_vocabulary.get(gram, set())
+        scored = [(other, trigram_similarity(token, other)) for other in candidates]
+        return [(other, score) for other, score in scored if score >= TRIGRAM_THRESHOLD]
+
+    def search(self, query, category_id=None, min_price=None, max_price=None, limit=20):
+        scores = Counter()
+        total = len(self.products) or 1
+        for token in tokenize(query):
+            for term, closeness in self.expand(token):
+                postings = self.postings[term]
+                idf = math.log(1 + total / len(postings))
+                for pk, weight in postings.items():
+                    scores[pk] += weight * idf * closeness
+
+        results = []
+        for pk, score in scores.most_common():
+            product_category, price = self.products[pk]
+            if category_id is not None and product_category != category_id:
+                continue
+            if min_price is not None and price < min_price:
+                continue
+            if max_price is not None and price > max_price:
+                continue
+            results.append(pk)
+            if len(results) >= limit:
+                break
+        return results
+
+
+_index_lock = threading.Lock()
+_index = {'version': None, 'index': None}
+
+
+def get_inverted_index():
+    version = namespace_version(CATALOG)
+    with _index_lock:
+        if _index['version'] != version:
+            rows = Product.objects.values_list('id', 'title', 'description', 'category_id', 'price').iterator(chunk_size=5000)
+            _index['index'] = InvertedIndex(rows)
+            _index['version'] = version
+        return _index['index']
+
+
+def search_products(query, category_id=None, min_price=None, max_price=None, limit=20):
+    """Products matching the query, best match first"""
+    products = Product.objects.select_related('category')
+
+    if connection.vendor == 'postgresql':
+        search_query = SearchQuery(query, search_type='websearch', config=SEARCH_CONFIG)
+        queryset = filter_products(products, category_id, min_price, max_price).annotate(
+            rank=SearchRank(F('search_vector'), search_query),
+            similarity=TrigramSimilarity('title', query),
+        ).filter(
+            Q(search_vector=search_query) | Q(title__trigram_similar=query)
+        ).order_by('-rank', '-similarity', '-id')
+        return list(queryset[:limit])
+
+    ids = get_inverted_index().search(query, category_id, min_price, max_price, limit)
+    found = products.in_bulk(ids)
+    return [found[pk] for pk in ids if pk in found]
@@ -1,8 +1,9 @@
-from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from rest_framework.validators import UniqueValidator
 from .models import Category,Product,Order,OrderItem,ShippingAddress
+from .authentication import tokens_for
+from .images import variant_urls
 
 User=get_user_model()
 
@@ -34,12 +35,14 @@ class LoginSerializer(serializers.Serializer):
     password=serializers.CharField()
 
     def validate(self,data):
-        from django.contrib.auth import authenticate
+        from .login import authenticate_bounded
 
-        user=authenticate(username=data['username'],password=data['password'])
+        # At most LOGIN_HASH_WORKERS password hashes run at once, raises LoginBusy past the queue
+        user=authenticate_bounded(data['username'],data['password'])
 
         if user:
-            refresh=RefreshToken.for_user(user)
+            # username/role/version claims let ClaimsJWTAuthentication skip the user query
+            refresh=tokens_for(user)
 
             return {
                 'refresh':str(refresh),
@@ -71,6 +74,7 @@ class UserSerializer(serializers.ModelSerializer):
         
         new_role=validated_data.get('role',instance.role)
 
+        # Saving a role or password change revokes the issued tokens, see shop/signals.py
         if is_admin: 
             instance.role=new_role
             if new_role == 'admin':
@@ -103,16 +107,21 @@ class ProductSerializer(serializers.ModelSerializer):
         write_only=True,
         source='category'
     )
+    # Resized WebP renditions of image, empty until they have been generated
+    image_variants = serializers.SerializerMethodField()
 
     class Meta:
         model = Product
-        fields = ['id', 'title', 'description', 'price', 'stock', 'image', 'slug', 'category', 'category_id']
+        fields = ['id', 'title', 'description', 'price', 'stock', 'image', 'image_variants', 'slug', 'category', 'category_id']
+
+    def get_image_variants(self, obj):
+        return variant_urls(obj, self.context.get('request'))
 
 
 # Order Item Serializer
 class OrderItemSerializer(serializers.ModelSerializer):
-    product_title = serializers.ReadOnlyField(source='product.title')
-    product_price = serializers.ReadOnlyField(source='product.price')
+    product_title = serializers.ReadOnlyField(source='get_product_title')
+    product_price = serializers.ReadOnlyField(source='get_unit_price')
     item_total_price=serializers.ReadOnlyField(source='get_total')
 
     class Meta:
@@ -120,6 +129,20 @@ class OrderItemSerializer(serializers.ModelSerializer):
         fields = ['id', 'product', 'product_title', 'product_price', 'quantity','item_total_price']
 
 
+# One step of a batch cart update
+class CartOperationSerializer(serializers.Serializer):
+    OPERATIONS=['add','set','remove']
+
+    op=serializers.ChoiceField(choices=OPERATIONS,default='add')
+    product_id=serializers.IntegerField()
+    quantity=serializers.IntegerField(min_value=0,default=1)
+
+    def validate(self,data):
+        if data['op']=='add' and data['quantity']<1:
+            raise serializers.ValidationError("quantity must be at least 1 when adding")
+        return data
+
+
 class ShippingAddressSerializer(serializers.ModelSerializer):
     class Meta:
        model=ShippingAddress
@@ -129,12 +152,12 @@ class ShippingAddressSerializer(serializers.ModelSerializer):
 class OrderSerializer(serializers.ModelSerializer):
     items=OrderItemSerializer(many=True,read_only=True)
     customer_name=serializers.ReadOnlyField(source='customer.username')
-    total_price=serializers.ReadOnlyField(source='get_cart_total')
-    total_items=serializers.ReadOnlyField(source='get_total_item')     
+    total_price=serializers.ReadOnlyField()
+    total_items=serializers.ReadOnlyField()
     shipping_address=serializers.SerializerMethodField()
 
     def get_shipping_address(self, obj):
-         shipping = ShippingAddress.objects.filter(order=obj).last()  # or `.first()` based on your logic
+         shipping = obj.latest_shipping_address
          if shipping:
              return {
                  "address": shipping.address,
@@ -155,11 +178,11 @@ class AdminOrderSerializer(serializers.ModelSerializer):
     items=OrderItemSerializer(many=True,read_only=True)
     customer_name=serializers.ReadOnlyField(source='customer.username')
     shipping_address=serializers.SerializerMethodField()
-    total_price=serializers.ReadOnlyField(source='get_cart_total')
-    total_items=serializers.ReadOnlyField(source="get_total_item")
+    total_price=serializers.ReadOnlyField()
+    total_items=serializers.ReadOnlyField()
 
     def get_shipping_address(self, obj):
-         shipping = ShippingAddress.objects.filter(order=obj).last()  # or `.first()` based on your logic
+         shipping = obj.latest_shipping_address
          if shipping:
              return {
                  "address": shipping.address,
@@ -175,3 +198,20 @@ class AdminOrderSerializer(serializers.ModelSerializer):
 
         
 
+
+
+#Bulk import: one row of a supplier catalog, matched to an existing product by slug
+class ProductImportSerializer(serializers.ModelSerializer):
+    category = serializers.SlugField()
+
+    class Meta:
+        model = Product
+        fields = ['title', 'slug', 'description', 'price', 'stock', 'category']
+        # Existing slugs are updated, not rejected
+        extra_kwargs = {'slug': {'validators': []}}
+
+    def validate_category(self, value):
+        category = self.context['categories'].get(value)
+        if category is None:
+            raise serializers.ValidationError(f"Unknown category '{value}'")
+        return category
@@ -0,0 +1,74 @@
+from django.db import transaction
+from django.db.models.signals import post_delete,post_save,pre_delete,pre_save
+from django.dispatch import receiver
+
+from . import analytics,images,notifications
+from .authentication import forget_token_version,revoke_tokens
+from .cache import CATALOG,invalidate
+from .models import Category,CustomUser,Order,Product
+
+
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_catalog(sender, **kwargs):
+    """Any product or category change retires every cached catalog payload, once it is committed"""
+    # Before the commit a concurrent request would cache the old rows under the new version
+    transaction.on_commit(lambda: invalidate(CATALOG))
+
+
+# Claimed by issued tokens or deciding whether they are honoured at all
+TOKEN_FIELDS = ('role', 'is_staff', 'is_active', 'password')
+
+
+@receiver(pre_save, sender=CustomUser)
+def revoke_tokens_on_change(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Issued tokens must not outlive a change of role, staff flag, active flag or password"""
+    if raw or instance.pk is None:
+        return
+    if update_fields is not None and not set(update_fields) & set(TOKEN_FIELDS):
+        return
+    stored = CustomUser.objects.filter(pk=instance.pk).values(*TOKEN_FIELDS, 'token_version').first()
+    if stored is None:
+        return
+    changed = {field for field in TOKEN_FIELDS if stored[field] != getattr(instance, field)}
+    if changed == {'password'} and instance._password is None and update_fields is not None:
+        # check_password() upgrading the hash of the same password on login
+        return
+    if changed:
+        # A queryset update, save(update_fields=...) may leave token_version out
+        revoke_tokens(instance)
+        instance.token_version = stored['token_version'] + 1
+
+
+@receiver([post_save, post_delete], sender=CustomUser)
+def forget_cached_token_version(sender, instance, **kwargs):
+    """Re-read the token version (and whether the user is active) after any change"""
+    forget_token_version(instance.pk)
+
+
+@receiver(pre_save, sender=Order)
+def remember_sales_state(sender, instance, raw=False, **kwargs):
+    """What the stored order contributes to the sales rollups, before it is overwritten"""
+    instance._sales_state = None if raw else analytics.stored_state(instance)
+
+
+@receiver(post_save, sender=Order)
+def update_sales_rollups(sender, instance, raw=False, **kwargs):
+    """Apply the change to the rollups, and queue the customer's email when the order was placed or moved on"""
+    if not raw:
+        before, after = instance.__dict__.pop('_sales_state', None), analytics.order_state(instance)
+        analytics.record_change(instance, before, after)
+        notifications.order_changed(instance, before, after)
+
+
+@receiver(pre_delete, sender=Order)
+def retire_sales(sender, instance, **kwargs):
+    # Before the cascade, the items are still there to subtract
+    analytics.record_change(instance, analytics.stored_state(instance), None)
+
+
+@receiver(post_save, sender=Product)
+def queue_image_variants(sender, instance, raw=False, **kwargs):
+    """A new or removed image gets its variants (re)generated after the commit"""
+    if not raw:
+        images.schedule(instance)
@@ -1,3 +1,2028 @@
-from django.test import TestCase
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from decimal import Decimal
+from importlib.util import find_spec
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
+
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.test import AsyncRequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from .async_views import AsyncCartView, AsyncCategoryListView, AsyncLoginView, AsyncOrderListView, AsyncProductDetailView, AsyncProductListView
+from .analytics import sales_summary
+from .benchmarks import percentile, regressions, seed_dataset
+from .carts import DatabaseCart, flush_dirty_carts, get_cart_store
+from .filters import filter_orders
+from .authentication import revoke_tokens, tokens_for
+from .cache import CATALOG, cache_stats, cached, invalidate, make_key, namespace_version, reset_cache_stats
+from .inventory import InsufficientStock, reserve_stock
+from . import jobs
+from .metrics import reset_metrics
+from .payments import PaymentGateway, SimulatorGateway, sign
+from .models import CustomUser,Category,Product,Order,OrderItem,ShippingAddress,MediaUpload,IdempotencyKey,Job
+from .loaders import order_queryset
+from .projection import AdminOrderProjection, OrderProjection, ProductProjection
+from .serializers import AdminOrderSerializer, OrderSerializer, ProductSerializer
 
 # Create your tests here.
+
+
+def make_catalog(count, category=None):
+    category = category or Category.objects.create(name='Phones', slug='phones')
+    Product.objects.bulk_create([
+        Product(category=category, title=f'Product {i}', slug=f'product-{i}',
+                description='test product', price=10 + i, stock=5)
+        for i in range(count)
+    ])
+    return category
+
+
+def make_user(username, role='customer'):
+    return CustomUser.objects.create_user(
+        username=username, email=f'{username}@example.com', password='pass12345', role=role)
+
+
+def make_orders(customer, count, products):
+    for _ in range(count):
+        order = Order.objects.create(customer=customer, is_checked_out=True)
+        for product in products:
+            OrderItem.objects.create(order=order, product=product, quantity=2)
+        order.snapshot_prices()
+        order.save()
+        ShippingAddress.objects.create(user=customer, order=order, address='Road 1', city='Dhaka', zip_code='1200')
+        ShippingAddress.objects.create(user=customer, order=order, address='Road 2', city='Dhaka', zip_code='1207')
+
+
+class ProductPaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        make_catalog(7)
+
+    def test_walks_all_pages_with_cursor(self):
+        seen = []
+        response = self.client.get('/api/products/', {'page_size': 3})
+        while True:
+            self.assertEqual(response.status_code, 200)
+            seen.extend(p['id'] for p in response.data['product_list'])
+            if not response.data['next']:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(len(seen), 7)
+        self.assertEqual(len(set(seen)), 7)
+
+    def test_previous_cursor_returns_prior_page(self):
+        first = self.client.get('/api/products/', {'page_size': 3})
+        self.assertIsNone(first.data['previous'])
+        second = self.client.get(first.data['next'])
+        back = self.client.get(second.data['previous'])
+        self.assertEqual(
+            [p['id'] for p in back.data['product_list']],
+            [p['id'] for p in first.data['product_list']],
+        )
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/products/', {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_ndjson_export_streams_every_product(self):
+        response = self.client.get('/api/products/', {'export': 'ndjson'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 7)
+        self.assertEqual(json.loads(lines[0])['slug'], 'product-0')
+
+
+class OrderQueryCountTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        make_catalog(3)
+        self.products = list(Product.objects.all())
+        self.admin = make_user('boss', role='admin')
+        self.customer = make_user('alice')
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx), response
+
+    def test_admin_order_list_query_count_is_constant(self):
+        self.client.force_authenticate(self.admin)
+        make_orders(self.customer, 2, self.products)
+        small, _ = self.count_queries('/api/admin/orders/')
+        make_orders(self.customer, 10, self.products)
+        large, response = self.count_queries('/api/admin/orders/')
+        self.assertEqual(small, large)
+        order = response.data['orders'][0]
+        self.assertEqual(order['shipping_address']['address'], 'Road 2')
+        self.assertEqual(order['total_items'], 6)
+
+    def test_customer_order_list_query_count_is_constant(self):
+        self.client.force_authenticate(self.customer)
+        make_orders(self.customer, 1, self.products)
+        small, _ = self.count_queries('/api/orders/')
+        make_orders(self.customer, 8, self.products)
+        large, response = self.count_queries('/api/orders/')
+        self.assertEqual(small, large)
+        self.assertEqual(len(response.data), 9)
+
+
+class OrderTotalsTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        make_catalog(2)
+        self.first, self.second = Product.objects.order_by('id')
+        self.customer = make_user('alice')
+        self.client.force_authenticate(self.customer)
+
+    def stored_totals(self):
+        order = Order.objects.get(customer=self.customer, is_checked_out=False)
+        return order.total_items, order.total_price
+
+    def test_cart_mutations_keep_totals_in_step(self):
+        self.client.post('/api/cart/', {'product_id': self.first.id, 'quantity': 2})
+        response = self.client.post('/api/cart/', {'product_id': self.second.id, 'quantity': 1})
+        self.assertEqual(self.stored_totals(), (3, Decimal('31.00')))
+        self.assertEqual(response.data['total_items'], 3)
+
+        item_id = response.data['items'][0]['id']
+        self.client.put('/api/cart/', {'item_id': item_id, 'quantity': 5})
+        self.assertEqual(self.stored_totals(), (6, Decimal('61.00')))
+
+        self.client.delete('/api/cart/', {'item_id': item_id})
+        self.assertEqual(self.stored_totals(), (1, Decimal('11.00')))
+
+    def test_lines_can_be_named_by_product(self):
+        self.client.post('/api/cart/', {'product_id': self.first.id, 'quantity': 1})
+        self.client.put('/api/cart/', {'product_id': self.first.id, 'quantity': 4})
+        self.assertEqual(self.stored_totals(), (4, Decimal('40.00')))
+        self.client.delete('/api/cart/', {'product_id': self.first.id})
+        self.assertEqual(self.stored_totals(), (0, Decimal('0.00')))
+        self.assertEqual(self.client.put('/api/cart/', {'product_id': self.second.id, 'quantity': 1}).status_code, 400)
+
+    def test_add_increments_in_the_database(self):
+        self.client.post('/api/cart/', {'product_id': self.first.id, 'quantity': 2})
+        stale = OrderItem.objects.get()
+        # Another request adds 3 after this one read the line
+        OrderItem.objects.filter(pk=stale.pk).update(quantity=5)
+        with mock.patch.object(OrderItem.objects, 'get_or_create', return_value=(stale, False)):
+            DatabaseCart(self.customer).add(self.first, 1)
+        self.assertEqual(OrderItem.objects.get().quantity, 6)
+
+    def test_add_rejects_quantities_below_one(self):
+        for quantity in ('abc', -3, 0):
+            response = self.client.post('/api/cart/', {'product_id': self.first.id, 'quantity': quantity})
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(OrderItem.objects.exists())
+        with self.assertRaises(ValueError):
+            DatabaseCart(self.customer).add(self.first, 0)
+        self.assertFalse(OrderItem.objects.exists())
+
+    def test_set_quantity_rejects_negatives_and_removes_on_zero(self):
+        response = self.client.post('/api/cart/', {'product_id': self.first.id, 'quantity': 2})
+        item_id = response.data['items'][0]['id']
+        for quantity in (-3, 'two'):
+            response = self.client.put('/api/cart/', {'item_id': item_id, 'quantity': quantity})
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.stored_totals(), (2, Decimal('20.00')))
+
+        response = self.client.put('/api/cart/', {'item_id': item_id, 'quantity': 0})
+        self.assertEqual(response.data['items'], [])
+        self.assertEqual(self.stored_totals(), (0, Decimal('0.00')))
+
+    def test_command_repairs_drift(self):
+        order = Order.objects.create(customer=self.customer, is_checked_out=True)
+        OrderItem.objects.create(order=order, product=self.first, quantity=3)
+
+        with self.assertRaises(CommandError):
+            call_command('recompute_order_totals', '--check', stdout=StringIO())
+
+        call_command('recompute_order_totals', stdout=StringIO())
+        order.refresh_from_db()
+        self.assertEqual((order.total_items, order.total_price), (3, Decimal('30.00')))
+        call_command('recompute_order_totals', '--check', stdout=StringIO())
+
+
+class PriceSnapshotTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        make_catalog(1)
+        self.product = Product.objects.get()
+        self.customer = make_user('alice')
+        self.client.force_authenticate(self.customer)
+
+    def test_checkout_freezes_prices_for_order_history(self):
+        self.client.post('/api/cart/', {'product_id': self.product.id, 'quantity': 3})
+        response = self.client.post('/api/checkout/', {'address': 'Road 1', 'city': 'Dhaka', 'zip_code': '1200'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['total_price'], Decimal('30.00'))
+
+        Product.objects.filter(pk=self.product.pk).update(price=99, title='Renamed')
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/orders/')
+        self.assertFalse(any('"shop_product"' in q['sql'] for q in ctx.captured_queries))
+        item = response.data[0]['items'][0]
+        self.assertEqual(item['product_title'], 'Product 0')
+        self.assertEqual(item['product_price'], Decimal('10.00'))
+        self.assertEqual(item['item_total_price'], Decimal('30.00'))
+        self.assertEqual(response.data[0]['total_price'], Decimal('30.00'))
+
+
+CHECKOUT_ADDRESS = {'address': 'Road 1', 'city': 'Dhaka', 'zip_code': '1200'}
+
+
+class StockReservationTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        make_catalog(2)
+        self.first, self.second = Product.objects.order_by('id')
+        self.customer = make_user('alice')
+        self.client.force_authenticate(self.customer)
+
+    def test_checkout_decrements_and_cancel_restores_stock(self):
+        self.client.post('/api/cart/', {'product_id': self.first.id, 'quantity': 3})
+        response = self.client.post('/api/checkout/', CHECKOUT_ADDRESS)
+        self.assertEqual(response.status_code, 201)
+        self.first.refresh_from_db()
+        self.assertEqual(self.first.stock, 2)
+
+        response = self.client.patch(f"/api/orders/{response.data['order_id']}/")
+        self.assertEqual(response.status_code, 200)
+        self.first.refresh_from_db()
+        self.assertEqual(self.first.stock, 5)
+
+    def checkout(self, quantity):
+        self.client.force_authenticate(self.customer)
+        self.client.post('/api/cart/', {'product_id': self.first.id, 'quantity': quantity})
+        order_id = self.client.post('/api/checkout/', CHECKOUT_ADDRESS).data['order_id']
+        self.client.force_authenticate(make_user(f'boss{order_id}', role='admin'))
+        return f'/api/admin/orders/{order_id}/'
+
+    def stock(self):
+        self.first.refresh_from_db()
+        return self.first.stock
+
+    def test_admin_cancel_releases_and_reopening_reserves(self):
+        url = self.checkout(3)
+        self.assertEqual(self.client.patch(url, {'status': 'cancelled'}).status_code, 200)
+        self.assertEqual(self.stock(), 5)
+        # Cancelling again gives nothing back twice
+        self.client.patch(url, {'status': 'cancelled'})
+        self.assertEqual(self.stock(), 5)
+
+        self.assertEqual(self.client.patch(url, {'status': 'processing'}).status_code, 200)
+        self.assertEqual(self.stock(), 2)
+        self.client.patch(url, {'status': 'cancelled'})
+        # Sold to someone else in the meantime
+        Product.objects.filter(pk=self.first.pk).update(stock=1)
+        response = self.client.patch(url, {'status': 'processing'})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Order.objects.get().status, 'cancelled')
+
+    def test_admin_delete_releases_unshipped_orders(self):
+        url = self.checkout(3)
+        self.client.delete(url)
+        self.assertEqual(self.stock(), 5)
+
+        url = self.checkout(2)
+        self.client.patch(url, {'status': 'shipped'})
+        self.client.delete(url)
+        self.assertEqual(self.stock(), 3)
+
+    def test_shortage_rejects_whole_checkout(self):
+        self.client.post('/api/cart/', {'product_id': self.first.id, 'quantity': 2})
+        self.client.post('/api/cart/', {'product_id': self.second.id, 'quantity': 9})
+        response = self.client.post('/api/checkout/', CHECKOUT_ADDRESS)
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['shortages'], [{
+            'product_id': self.second.id, 'product_title': 'Product 1', 'requested': 9, 'available': 5,
+        }])
+        self.first.refresh_from_db()
+        self.assertEqual(self.first.stock, 5)
+        self.assertFalse(Order.objects.get(customer=self.customer).is_checked_out)
+        self.assertFalse(ShippingAddress.objects.exists())
+
+
+class ConcurrentStockReservationTests(TransactionTestCase):
+    threads = 12
+    stock = 5
+
+    def setUp(self):
+        category = Category.objects.create(name='Rare', slug='rare')
+        self.product = Product.objects.create(category=category, title='Rare', slug='rare',
+                                              description='scarce', price=50, stock=self.stock)
+        self.orders = []
+        for i in range(self.threads):
+            order = Order.objects.create(customer=make_user(f'buyer{i}'))
+            OrderItem.objects.create(order=order, product=self.product, quantity=1)
+            self.orders.append(order)
+
+    def test_stock_never_goes_negative(self):
+        results = []
+        start = threading.Barrier(self.threads)
+
+        def checkout(order):
+            start.wait()
+            try:
+                for _ in range(50):
+                    try:
+                        with transaction.atomic():
+                            reserve_stock(order)
+                        results.append(True)
+                        return
+                    except InsufficientStock:
+                        results.append(False)
+                        return
+                    except OperationalError:
+                        # SQLite allows a single writer, try again
+                        continue
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=checkout, args=(order,)) for order in self.orders]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.product.refresh_from_db()
+        self.assertGreaterEqual(self.product.stock, 0)
+        self.assertEqual(results.count(True), self.stock)
+        self.assertEqual(self.product.stock, 0)
+
+
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_cache_stats()
+        self.client = APIClient()
+        make_catalog(2)
+        self.product = Product.objects.order_by('id').first()
+
+    def test_product_detail_is_served_from_cache(self):
+        url = f'/api/products/{self.product.id}/'
+        self.client.get(url)
+        # Only the conditional GET fingerprint reaches the database
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(response.data['title'], 'Product 0')
+        self.assertEqual(cache_stats()['hits'], 1)
+        self.assertEqual(cache_stats()['misses'], 1)
+
+    def test_save_invalidates_cached_payloads(self):
+        url = f'/api/products/{self.product.id}/'
+        self.client.get(url)
+        self.client.get('/api/products/')
+        self.product.title = 'Renamed'
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.product.save()
+            # Nothing is dropped until the change is committed
+            self.assertEqual(self.client.get(url).data['title'], 'Product 0')
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(self.client.get(url).data['title'], 'Renamed')
+        titles = [p['title'] for p in self.client.get('/api/products/').data['product_list']]
+        self.assertIn('Renamed', titles)
+
+    def test_stock_changes_invalidate_cached_payloads(self):
+        url = f'/api/products/{self.product.id}/'
+        self.assertEqual(self.client.get(url).data['stock'], 5)
+        self.client.get('/api/products/')
+        customer = make_user('alice')
+        self.client.force_authenticate(customer)
+        self.client.post('/api/cart/', {'product_id': self.product.id, 'quantity': 3})
+        with self.captureOnCommitCallbacks(execute=True):
+            order_id = self.client.post('/api/checkout/', CHECKOUT_ADDRESS).data['order_id']
+
+        self.assertEqual(self.client.get(url).data['stock'], 2)
+        stock = {p['id']: p['stock'] for p in self.client.get('/api/products/').data['product_list']}
+        self.assertEqual(stock[self.product.id], 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f'/api/orders/{order_id}/')
+        self.assertEqual(self.client.get(url).data['stock'], 5)
+
+    def test_stock_changes_keep_the_rest_of_the_catalog_cached(self):
+        other = f'/api/products/{Product.objects.order_by("id").last().id}/'
+        self.client.force_authenticate(make_user('alice'))
+        self.client.get(other)
+        version = namespace_version(CATALOG)
+        self.client.post('/api/cart/', {'product_id': self.product.id, 'quantity': 1})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/checkout/', CHECKOUT_ADDRESS)
+        reset_cache_stats()
+        self.client.get(other)
+        self.assertEqual(cache_stats()['hits'], 1)
+        # The search index is keyed on the catalog version, it is not rebuilt either
+        self.assertEqual(namespace_version(CATALOG), version)
+
+    def test_category_delete_invalidates_list(self):
+        user = make_user('alice')
+        self.client.force_authenticate(user)
+        self.assertEqual(self.client.get('/api/categories/').data['total'], 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            Category.objects.create(name='Laptops', slug='laptops')
+        self.assertEqual(self.client.get('/api/categories/').data['total'], 2)
+
+    def test_stale_value_is_served_while_another_worker_rebuilds(self):
+        with self.settings(CATALOG_CACHE_TIMEOUT=-1):
+            cached(CATALOG, 'key', lambda: 'old')
+        # Another worker holds the rebuild lock
+        cache.add(make_key(CATALOG, 'key') + ':lock', 1)
+        self.assertEqual(cached(CATALOG, 'key', lambda: 'new'), 'old')
+        self.assertEqual(cache_stats()['stale_hits'], 1)
+        cache.delete(make_key(CATALOG, 'key') + ':lock')
+        self.assertEqual(cached(CATALOG, 'key', lambda: 'new'), 'new')
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        make_catalog(2)
+        self.product = Product.objects.order_by('id').first()
+        self.customer = make_user('alice')
+
+    def assert_revalidates(self, url, change):
+        first = self.client.get(url)
+        self.assertEqual(first.status_code, 200)
+        etag = first['ETag']
+        self.assertTrue(first.has_header('Last-Modified'))
+
+        again = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.content, b'')
+
+        change()
+        changed = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], etag)
+
+    def test_product_list(self):
+        self.assert_revalidates('/api/products/', lambda: Product.objects.create(
+            category=self.product.category, title='New', slug='new', description='new', price=5, stock=1))
+
+    def test_product_detail(self):
+        def change():
+            self.product.price = 99
+            self.product.save()
+        self.assert_revalidates(f'/api/products/{self.product.id}/', change)
+
+    def test_product_list_category_rename(self):
+        def change():
+            self.product.category.name = 'Mobiles'
+            with self.captureOnCommitCallbacks(execute=True):
+                self.product.category.save()
+        self.assert_revalidates('/api/products/', change)
+        rows = self.client.get('/api/products/').data['product_list']
+        self.assertEqual({row['category']['name'] for row in rows}, {'Mobiles'})
+
+    def test_product_detail_after_checkout(self):
+        url = f'/api/products/{self.product.id}/'
+        etag = self.client.get(url)['ETag']
+        self.client.force_authenticate(self.customer)
+        self.client.post('/api/cart/', {'product_id': self.product.id, 'quantity': 3})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/checkout/', CHECKOUT_ADDRESS)
+
+        changed = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((changed.status_code, changed.data['stock']), (200, 2))
+        # The new ETag stands for the new stock
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=changed['ETag']).status_code, 304)
+        self.assertEqual(self.client.get(url).data['stock'], 2)
+
+    def test_category_list(self):
+        self.client.force_authenticate(self.customer)
+        self.assert_revalidates('/api/categories/', lambda: Category.objects.create(name='B', slug='b'))
+
+    def test_cart(self):
+        self.client.force_authenticate(self.customer)
+        self.client.post('/api/cart/', {'product_id': self.product.id})
+        self.assert_revalidates('/api/cart/', lambda: self.client.post('/api/cart/', {'product_id': self.product.id}))
+
+    def test_not_modified_skips_serialization(self):
+        etag = self.client.get(f'/api/products/{self.product.id}/')['ETag']
+        cache.clear()
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/api/products/{self.product.id}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        phones = Category.objects.create(name='Phones', slug='phones')
+        self.laptops = Category.objects.create(name='Laptops', slug='laptops')
+        Product.objects.create(category=phones, title='Galaxy phone', slug='galaxy',
+                               description='Android smartphone with a big screen', price=500, stock=3)
+        Product.objects.create(category=phones, title='Pixel', slug='pixel',
+                               description='Camera phone from Google', price=400, stock=3)
+        Product.objects.create(category=self.laptops, title='ThinkPad', slug='thinkpad',
+                               description='Business laptop with a great keyboard', price=1200, stock=3)
+
+    def search(self, **params):
+        response = self.client.get('/api/products/search/', params)
+        self.assertEqual(response.status_code, 200)
+        return [p['slug'] for p in response.data['product_list']]
+
+    def test_title_matches_rank_above_description_matches(self):
+        self.assertEqual(self.search(q='phone'), ['galaxy', 'pixel'])
+
+    def test_typo_tolerance(self):
+        self.assertEqual(self.search(q='keybord'), ['thinkpad'])
+
+    def test_filters(self):
+        self.assertEqual(self.search(q='phone', max_price=450), ['pixel'])
+        self.assertEqual(self.search(q='phone laptop', category=self.laptops.id), ['thinkpad'])
+
+    def test_index_follows_catalog_changes(self):
+        self.assertEqual(self.search(q='tablet'), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(slug='pixel').get().delete()
+            product = Product.objects.get(slug='galaxy')
+            product.title = 'Galaxy tablet'
+            product.save()
+        self.assertEqual(self.search(q='tablet'), ['galaxy'])
+        self.assertEqual(self.search(q='camera'), [])
+
+    def test_query_required(self):
+        self.assertEqual(self.client.get('/api/products/search/').status_code, 400)
+        self.assertEqual(self.client.get('/api/products/search/', {'q': 'x', 'min_price': 'abc'}).status_code, 400)
+
+    def test_limit(self):
+        self.assertEqual(self.search(q='phone', limit=1), ['galaxy'])
+        with mock.patch('shop.views.search_products', return_value=[]) as search_products:
+            for limit in (-5, 0, 1000):
+                self.search(q='phone', limit=limit)
+        self.assertEqual([call.kwargs['limit'] for call in search_products.call_args_list], [1, 1, 100])
+        self.assertEqual(self.client.get('/api/products/search/', {'q': 'phone', 'limit': 'ten'}).status_code, 400)
+
+
+class ProductFacetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.phones = Category.objects.create(name='Phones', slug='phones')
+        self.laptops = Category.objects.create(name='Laptops', slug='laptops')
+        for slug, category, price, stock in [('a', self.phones, 20, 3), ('b', self.phones, 80, 0),
+                                             ('c', self.phones, 700, 1), ('d', self.laptops, 1500, 2)]:
+            Product.objects.create(category=category, title=slug, slug=slug, description='x', price=price, stock=stock)
+
+    def test_facets_come_from_one_query(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/products/')
+        self.assertEqual(sum('GROUP BY' in q['sql'] for q in ctx.captured_queries), 1)
+        facets = response.data['facets']
+        self.assertEqual(facets['category'], [
+            {'id': self.phones.id, 'name': 'Phones', 'count': 3},
+            {'id': self.laptops.id, 'name': 'Laptops', 'count': 1},
+        ])
+        self.assertEqual([b['count'] for b in facets['price']], [1, 1, 0, 1, 1])
+        self.assertEqual(facets['stock'], {'in_stock': 3, 'out_of_stock': 1})
+
+    def test_each_facet_ignores_its_own_filter(self):
+        response = self.client.get('/api/products/', {'category': self.phones.id, 'min_price': 50, 'in_stock': 'true'})
+        self.assertEqual([p['slug'] for p in response.data['product_list']], ['c'])
+        facets = response.data['facets']
+        # Other categories keep their counts under ?category=, and so on for price and stock
+        self.assertEqual(facets['category'], [
+            {'id': self.laptops.id, 'name': 'Laptops', 'count': 1},
+            {'id': self.phones.id, 'name': 'Phones', 'count': 1},
+        ])
+        self.assertEqual([b['count'] for b in facets['price']], [1, 0, 0, 1, 0])
+        self.assertEqual(facets['stock'], {'in_stock': 1, 'out_of_stock': 1})
+
+    def test_no_match_keeps_listing_shape(self):
+        response = self.client.get('/api/products/', {'max_price': 1})
+        self.assertEqual(response.data['product_list'], [])
+        self.assertEqual(response.data['facets']['category'], [])
+
+    def test_invalid_filter(self):
+        self.assertEqual(self.client.get('/api/products/', {'in_stock': 'maybe'}).status_code, 400)
+        for params in ({'min_price': 'nan'}, {'max_price': 'Infinity'}, {'min_price': '-inf'}):
+            response = self.client.get('/api/products/', params)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('must be a number', response.data['error'])
+
+
+class BulkProductTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(make_user('boss', role='admin'))
+        self.phones = Category.objects.create(name='Phones', slug='phones')
+        Product.objects.create(category=self.phones, title='Old', slug='galaxy', description='x', price=1, stock=1)
+
+    def upload(self, name, content, **extra):
+        upload = SimpleUploadedFile(name, content.encode())
+        return self.client.post('/api/admin/products/bulk/', {'file': upload, **extra}, format='multipart')
+
+    def test_csv_upsert_reports_bad_rows(self):
+        response = self.upload('catalog.csv', (
+            'title,slug,description,price,stock,category\n'
+            'Galaxy,galaxy,Updated,499.00,7,phones\n'
+            'Pixel,pixel,New,399.00,3,phones\n'
+            'Broken,broken,Bad,-,3,phones\n'
+            'Lost,lost,Bad,10,3,nowhere\n'
+        ), batch_size=1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['rows'], response.data['imported'], response.data['failed']), (4, 2, 2))
+        self.assertEqual([e['row'] for e in response.data['errors']], [3, 4])
+        self.assertIn('price', response.data['errors'][0]['errors'])
+        galaxy = Product.objects.get(slug='galaxy')
+        self.assertEqual((galaxy.title, galaxy.stock, galaxy.price), ('Galaxy', 7, Decimal('499.00')))
+        self.assertEqual(Product.objects.count(), 2)
+
+    def test_repeated_slug_counts_once(self):
+        response = self.upload('catalog.csv', (
+            'title,slug,description,price,stock,category\n'
+            'Pixel,pixel,First,399.00,3,phones\n'
+            'Pixel 2,pixel,Second,449.00,5,phones\n'
+        ))
+        self.assertEqual((response.data['rows'], response.data['imported']), (2, 1))
+        self.assertEqual(Product.objects.get(slug='pixel').title, 'Pixel 2')
+
+    def test_ndjson_round_trip(self):
+        self.upload('catalog.ndjson', '{"title":"Pixel","slug":"pixel","description":"d","price":"5","stock":2,"category":"phones"}\nnot json\n')
+        response = self.client.get('/api/admin/products/bulk/', {'file_format': 'ndjson'})
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([line['slug'] for line in lines], ['galaxy', 'pixel'])
+        self.assertEqual(lines[1]['category'], 'phones')
+
+    def test_import_invalidates_catalog_cache(self):
+        self.assertEqual(self.client.get(f'/api/products/{Product.objects.get().id}/').data['title'], 'Old')
+        self.upload('catalog.csv', 'title,slug,description,price,stock,category\nNew,galaxy,d,1,1,phones\n')
+        self.assertEqual(self.client.get(f'/api/products/{Product.objects.get().id}/').data['title'], 'New')
+
+    def test_admin_only(self):
+        self.client.force_authenticate(make_user('alice'))
+        self.assertEqual(self.client.get('/api/admin/products/bulk/').status_code, 403)
+
+    def test_management_commands(self):
+        out = StringIO()
+        call_command('export_products', stdout=out)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'catalog.csv')
+            with open(path, 'w') as f:
+                f.write(out.getvalue().replace('Old', 'Renamed'))
+            call_command('import_products', path, stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(Product.objects.get().title, 'Renamed')
+
+
+@override_settings(CART_STORE='shop.carts.CacheCartStore', CART_FLUSH_INTERVAL=None)
+class CacheCartStoreTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        make_catalog(2)
+        self.first, self.second = Product.objects.order_by('id')
+        self.customer = make_user('alice')
+        self.client.force_authenticate(self.customer)
+
+    def test_cart_changes_stay_out_of_the_database(self):
+        self.client.get('/api/cart/')
+        with self.assertNumQueries(2):
+            # product lookup + pricing the lines for the response
+            response = self.client.post('/api/cart/', {'product_id': self.first.id, 'quantity': 2})
+        self.client.post('/api/cart/', {'product_id': self.second.id})
+        response = self.client.put('/api/cart/', {'item_id': self.first.id, 'quantity': 4})
+        self.assertEqual(response.data['total_items'], 5)
+        self.assertEqual(response.data['total_price'], Decimal('51.00'))
+        self.assertFalse(OrderItem.objects.exists())
+
+        response = self.client.delete('/api/cart/', {'item_id': self.second.id})
+        self.assertEqual([item['product'] for item in response.data['items']], [self.first.id])
+        self.assertEqual(self.client.delete('/api/cart/', {'item_id': 999}).status_code, 400)
+
+    def test_add_rejects_quantities_below_one(self):
+        for quantity in (-4, 0, 'abc'):
+            response = self.client.post('/api/cart/', {'product_id': self.first.id, 'quantity': quantity})
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get('/api/cart/').data['items'], [])
+        with self.assertRaises(ValueError):
+            get_cart_store().get_cart(self.customer).add(self.first, -4)
+
+    def test_set_quantity_rejects_negatives_and_removes_on_zero(self):
+        self.client.post('/api/cart/', {'product_id': self.first.id, 'quantity': 2})
+        response = self.client.put('/api/cart/', {'item_id': self.first.id, 'quantity': -1})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get('/api/cart/').data['total_items'], 2)
+
+        response = self.client.put('/api/cart/', {'item_id': self.first.id, 'quantity': 0})
+        self.assertEqual(response.data['items'], [])
+        self.assertEqual(response.data['total_items'], 0)
+
+    def test_write_behind_flush(self):
+        self.client.post('/api/cart/', {'product_id': self.first.id, 'quantity': 2})
+        self.assertEqual(flush_dirty_carts(), 1)
+        order = Order.objects.get(customer=self.customer, is_checked_out=False)
+        self.assertEqual((order.total_items, order.total_price), (2, Decimal('20.00')))
+
+        self.client.delete('/api/cart/', {'item_id': self.first.id})
+        flush_dirty_carts()
+        self.assertFalse(order.items.exists())
+        self.assertEqual(flush_dirty_carts(), 0)
+
+    def test_concurrent_changes_are_not_lost(self):
+        self.client.post('/api/cart/', {'product_id': self.first.id, 'quantity': 1})
+        cart = get_cart_store().get_cart(self.customer)
+        load = cart._load
+
+        def slow_load():
+            state = load()
+            time.sleep(0.01)
+            return state
+        with mock.patch.object(cart, '_load', slow_load):
+            threads = [threading.Thread(target=cart.add, args=(self.first, 1)) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(self.client.get('/api/cart/').data['total_items'], 6)
+
+    @override_settings(CART_LOCK_TIMEOUT=0.05)
+    def test_locked_cart_answers_409(self):
+        self.client.post('/api/cart/', {'product_id': self.first.id, 'quantity': 1})
+        cache.add(f'shop:cart:{self.customer.pk}:lock', 1)
+        response = self.client.put('/api/cart/', {'item_id': self.first.id, 'quantity': 3})
+        self.assertEqual(response.status_code, 409)
+        cache.delete(f'shop:cart:{self.customer.pk}:lock')
+        self.assertEqual(self.client.put('/api/cart/', {'item_id': self.first.id, 'quantity': 3}).status_code, 200)
+
+    def test_lines_can_be_named_by_product(self):
+        self.client.post('/api/cart/', {'product_id': self.first.id, 'quantity': 1})
+        response = self.client.put('/api/cart/', {'product_id': self.first.id, 'quantity': 4})
+        self.assertEqual(response.data['total_items'], 4)
+        response = self.client.delete('/api/cart/', {'product_id': self.first.id})
+        self.assertEqual(response.data['items'], [])
+        self.assertEqual(self.client.delete('/api/cart/', {'product_id': self.first.id}).status_code, 400)
+
+    def test_flush_after_checkout_does_not_revive_the_lines(self):
+        self.client.post('/api/cart/', {'product_id': self.first.id, 'quantity': 2})
+        flush_dirty_carts()
+        order = Order.objects.get(customer=self.customer, is_checked_out=False)
+        # A checkout commits while the flusher is about to write, before clear() runs
+        Order.objects.filter(pk=order.pk).update(is_checked_out=True)
+        get_cart_store().mark_dirty(self.customer.pk)
+        flush_dirty_carts()
+        self.assertFalse(Order.objects.filter(customer=self.customer, is_checked_out=False).exists())
+        self.assertEqual(self.client.get('/api/cart/').data['items'], [])
+
+    def test_checkout_persists_cart(self):
+        self.client.post('/api/cart/', {'product_id': self.first.id, 'quantity': 3})
+        response = self.client.post('/api/checkout/', CHECKOUT_ADDRESS)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['total_price'], Decimal('30.00'))
+        self.first.refresh_from_db()
+        self.assertEqual(self.first.stock, 2)
+        self.assertEqual(self.client.get('/api/cart/').data['items'], [])
+
+    def test_cart_is_loaded_from_database_on_cache_miss(self):
+        order = Order.objects.create(customer=self.customer)
+        OrderItem.objects.create(order=order, product=self.second, quantity=2)
+        response = self.client.get('/api/cart/')
+        self.assertEqual(response.data['id'], order.id)
+        self.assertEqual(response.data['total_items'], 2)
+
+    def test_conditional_get(self):
+        self.client.post('/api/cart/', {'product_id': self.first.id})
+        etag = self.client.get('/api/cart/')['ETag']
+        self.assertEqual(self.client.get('/api/cart/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.client.post('/api/cart/', {'product_id': self.first.id})
+        self.assertEqual(self.client.get('/api/cart/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class BatchCartTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        make_catalog(5)
+        self.products = list(Product.objects.order_by('id'))
+        self.customer = make_user('alice')
+        self.client.force_authenticate(self.customer)
+
+    def batch(self, operations):
+        return self.client.post('/api/cart/', {'operations': operations}, format='json')
+
+    def run_batch_checks(self):
+        first, second, third = self.products[:3]
+        self.client.post('/api/cart/', {'product_id': third.id, 'quantity': 2})
+        response = self.batch([
+            {'product_id': first.id, 'quantity': 2},
+            {'op': 'add', 'product_id': first.id},
+            {'op': 'set', 'product_id': second.id, 'quantity': 4},
+            {'op': 'remove', 'product_id': third.id},
+        ])
+        self.assertEqual(response.status_code, 200)
+        lines = {item['product']: item['quantity'] for item in response.data['items']}
+        self.assertEqual(lines, {first.id: 3, second.id: 4})
+        self.assertEqual(response.data['total_items'], 7)
+        self.assertEqual(response.data['total_price'], Decimal('74.00'))
+
+    def test_batch_database_store(self):
+        self.run_batch_checks()
+        order = Order.objects.get(customer=self.customer, is_checked_out=False)
+        self.assertEqual((order.total_items, order.total_price), (7, Decimal('74.00')))
+
+    @override_settings(CART_STORE='shop.carts.CacheCartStore', CART_FLUSH_INTERVAL=None)
+    def test_batch_cache_store(self):
+        self.run_batch_checks()
+
+    def test_swap_at_the_same_price_changes_the_etag(self):
+        first, second, third = self.products[:3]
+        Product.objects.filter(pk__in=[first.id, second.id, third.id]).update(price=10)
+        self.batch([{'product_id': second.id}, {'product_id': third.id}])
+        etag = self.client.get('/api/cart/')['ETag']
+
+        # Same item count and total, different lines
+        self.batch([{'op': 'remove', 'product_id': second.id}, {'product_id': first.id}])
+        response = self.client.get('/api/cart/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({item['product'] for item in response.data['items']}, {first.id, third.id})
+
+    def test_query_count_does_not_grow_with_operations(self):
+        self.client.get('/api/cart/')
+        with CaptureQueriesContext(connection) as small:
+            self.batch([{'product_id': self.products[0].id}])
+        with CaptureQueriesContext(connection) as large:
+            self.batch([{'product_id': p.id, 'quantity': 2} for p in self.products])
+        self.assertLessEqual(len(large), len(small) + 1)
+
+    def test_whole_batch_rejected_on_unknown_product(self):
+        response = self.batch([{'product_id': self.products[0].id}, {'product_id': 999}])
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data['product_ids'], [999])
+        self.assertFalse(OrderItem.objects.exists())
+
+    def test_invalid_operation(self):
+        response = self.client.post('/api/cart/', [{'op': 'explode', 'product_id': 1}], format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class ClaimsAuthenticationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.admin = make_user('boss', role='admin')
+        self.customer = make_user('alice')
+
+    def login(self, username):
+        self.client.credentials()
+        response = self.client.post('/api/login/', {'username': username, 'password': 'pass12345'})
+        self.assertEqual(response.status_code, 200)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        return response.data
+
+    def test_role_checks_do_not_load_the_user(self):
+        self.login('boss')
+        self.client.get('/api/admin/cache/stats/')
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/admin/cache/stats/')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(any('shop_customuser' in q['sql'] for q in ctx.captured_queries))
+
+    def test_role_claim_is_enforced(self):
+        self.login('alice')
+        self.assertEqual(self.client.get('/api/admin/cache/stats/').status_code, 403)
+
+    def test_views_that_need_the_row_still_work(self):
+        make_catalog(1)
+        self.login('alice')
+        product = Product.objects.get()
+        self.client.post('/api/cart/', {'product_id': product.id, 'quantity': 1})
+        response = self.client.post('/api/checkout/', CHECKOUT_ADDRESS)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['order_username'], 'alice')
+        self.assertEqual(self.client.get('/api/orders/').data[0]['customer'], self.customer.id)
+        self.assertEqual(self.client.get(f'/api/user/{self.customer.id}/').data['username'], 'alice')
+
+    def test_revoked_tokens_are_rejected(self):
+        self.login('alice')
+        self.assertEqual(self.client.get('/api/cart/').status_code, 200)
+        revoke_tokens(self.customer)
+        self.assertEqual(self.client.get('/api/cart/').status_code, 401)
+        self.login('alice')
+        self.assertEqual(self.client.get('/api/cart/').status_code, 200)
+
+    def test_deleted_user_is_rejected(self):
+        self.login('alice')
+        self.customer.delete()
+        self.assertEqual(self.client.get('/api/cart/').status_code, 401)
+
+    def test_saving_a_privilege_change_revokes_tokens(self):
+        self.login('alice')
+        self.customer.role = 'staff'
+        self.customer.save()
+        self.assertEqual(self.client.get('/api/cart/').status_code, 401)
+
+        self.login('alice')
+        self.customer.refresh_from_db()
+        self.customer.set_password('new-pass-123')
+        self.customer.save(update_fields=['password'])
+        self.assertEqual(self.client.get('/api/cart/').status_code, 401)
+
+    def test_ignored_role_change_keeps_tokens(self):
+        self.login('alice')
+        response = self.client.put(f'/api/user/{self.customer.id}/', {'role': 'admin'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(CustomUser.objects.get(pk=self.customer.pk).role, 'customer')
+        self.assertEqual(self.client.get('/api/cart/').status_code, 200)
+
+    def test_unrelated_changes_keep_tokens(self):
+        self.login('alice')
+        self.customer.first_name = 'Alice'
+        self.customer.save()
+        self.assertEqual(self.client.get('/api/cart/').status_code, 200)
+
+
+@override_settings(LOGIN_RATE_LIMITS={'ip': (4, 60), 'username': (2, 60)})
+class LoginThrottleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        make_user('alice')
+
+    def attempt(self, username='alice', password='wrong-pass', **extra):
+        return self.client.post('/api/login/', {'username': username, 'password': password}, **extra)
+
+    def test_failed_attempts_lock_the_username_before_hashing(self):
+        self.assertEqual(self.attempt().status_code, 401)
+        self.assertEqual(self.attempt().status_code, 401)
+        with mock.patch('shop.login.authenticate') as authenticate:
+            response = self.attempt(password='pass12345')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        authenticate.assert_not_called()
+
+    def test_success_resets_the_username_counter(self):
+        self.assertEqual(self.attempt().status_code, 401)
+        self.assertEqual(self.attempt(password='pass12345').status_code, 200)
+        self.assertEqual(self.attempt().status_code, 401)
+        self.assertEqual(self.attempt(password='pass12345').status_code, 200)
+
+    def test_every_attempt_counts_against_the_ip(self):
+        for i in range(4):
+            self.assertEqual(self.attempt(username=f'nobody{i}').status_code, 401)
+        self.assertEqual(self.attempt(username='someone-else').status_code, 429)
+        self.assertEqual(self.attempt(REMOTE_ADDR='10.0.0.9', password='pass12345').status_code, 200)
+
+    @override_settings(LOGIN_HASH_QUEUE=0)
+    def test_full_hashing_queue_answers_503(self):
+        self.assertEqual(self.attempt(password='pass12345').status_code, 503)
+
+
+class PasswordRehashTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def login(self):
+        response = self.client.post('/api/login/', {'username': 'alice', 'password': 'pass12345'})
+        self.assertEqual(response.status_code, 200)
+        return CustomUser.objects.get(username='alice').password
+
+    def test_cost_change_rehashes_on_login(self):
+        with override_settings(PASSWORD_HASHERS=['shop.hashers.ConfigurablePBKDF2PasswordHasher'], PBKDF2_ITERATIONS=1000):
+            make_user('alice')
+            self.assertTrue(CustomUser.objects.get().password.startswith('pbkdf2_sha256$1000$'))
+        with override_settings(PASSWORD_HASHERS=['shop.hashers.ConfigurablePBKDF2PasswordHasher'], PBKDF2_ITERATIONS=2000):
+            self.assertTrue(self.login().startswith('pbkdf2_sha256$2000$'))
+        # Same password, so the tokens issued before the upgrade still work
+        self.assertEqual(CustomUser.objects.get().token_version, 0)
+
+    @skipUnless(find_spec('argon2'), 'argon2-cffi is not installed')
+    def test_new_policy_upgrades_old_hashes(self):
+        with override_settings(PASSWORD_HASHERS=['shop.hashers.ConfigurablePBKDF2PasswordHasher'], PBKDF2_ITERATIONS=1000):
+            make_user('alice')
+        policy = ['shop.hashers.ConfigurableArgon2PasswordHasher', 'shop.hashers.ConfigurablePBKDF2PasswordHasher']
+        with override_settings(PASSWORD_HASHERS=policy, ARGON2_MEMORY_COST=1024, ARGON2_PARALLELISM=1):
+            self.assertTrue(self.login().startswith('argon2$'))
+            self.assertTrue(self.login().startswith('argon2$'))
+
+
+class AsyncLoginTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        make_user('alice')
+
+    async def post(self, payload):
+        request = AsyncRequestFactory().post('/api/login/', payload, content_type='application/json')
+        return await AsyncLoginView.as_view()(request)
+
+    async def test_login_runs_on_the_hashing_pool(self):
+        response = await self.post({'username': 'alice', 'password': 'pass12345'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['role'], 'customer')
+
+        response = await self.post({'username': 'alice', 'password': 'wrong-pass'})
+        self.assertEqual(response.status_code, 401)
+        self.assertIn('non_field_errors', json.loads(response.content))
+
+
+class AsyncRoutes:
+    """URLconf serving the async implementations of the read views"""
+    urlpatterns = [path('api/', include([
+        path('products/', AsyncProductListView.as_view()),
+        path('products/<int:pk>/', AsyncProductDetailView.as_view()),
+        path('categories/', AsyncCategoryListView.as_view()),
+        path('cart/', AsyncCartView.as_view()),
+        path('orders/', AsyncOrderListView.as_view()),
+    ]))]
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.category = make_catalog(5)
+        self.user = make_user('alice')
+        make_orders(self.user, 2, list(Product.objects.all()[:2]))
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens_for(self.user).access_token}')
+
+    def compare(self, url):
+        """Same status and body from the sync and the async view"""
+        expected = self.client.get(url)
+        invalidate(CATALOG)
+        with override_settings(ROOT_URLCONF=AsyncRoutes):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, expected.status_code)
+        self.assertEqual(json.loads(response.content), json.loads(expected.content))
+        return response
+
+    def test_payloads_match_the_sync_views(self):
+        product = Product.objects.first()
+        self.client.get('/api/cart/')
+        for url in ['/api/products/?page_size=2', f'/api/products/?category={self.category.id}&in_stock=true',
+                    f'/api/products/{product.id}/', '/api/products/999999/', '/api/categories/',
+                    '/api/orders/', '/api/cart/']:
+            with self.subTest(url=url):
+                self.compare(url)
+
+    def test_cache_cart_store(self):
+        product = Product.objects.first()
+        with override_settings(CART_STORE='shop.carts.CacheCartStore', CART_FLUSH_INTERVAL=None):
+            self.client.post('/api/cart/', {'product_id': product.id, 'quantity': 3})
+            response = self.compare('/api/cart/')
+        self.assertEqual(json.loads(response.content)['total_items'], 3)
+
+    @override_settings(ROOT_URLCONF=AsyncRoutes)
+    def test_conditional_get(self):
+        response = self.client.get('/api/categories/')
+        self.assertIn('ETag', response)
+        again = self.client.get('/api/categories/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(again.status_code, 304)
+
+    @override_settings(ROOT_URLCONF=AsyncRoutes)
+    def test_authentication(self):
+        self.client.credentials()
+        response = self.client.get('/api/categories/')
+        self.assertEqual(response.status_code, 401)
+        self.assertIn('WWW-Authenticate', response)
+        self.assertEqual(self.client.get('/api/products/').status_code, 200)
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer not-a-token')
+        self.assertEqual(self.client.get('/api/products/').status_code, 401)
+
+    @override_settings(ROOT_URLCONF=AsyncRoutes)
+    def test_writes_go_to_the_sync_view(self):
+        response = self.client.post('/api/categories/', {'name': 'Laptops', 'slug': 'laptops'})
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(Category.objects.filter(slug='laptops').exists())
+
+    @override_settings(ROOT_URLCONF=AsyncRoutes)
+    def test_serializers_never_query_from_the_event_loop(self):
+        # SynchronousOnlyOperation would surface as a 500
+        for url in ['/api/products/', '/api/orders/', '/api/cart/', '/api/categories/']:
+            self.assertEqual(self.client.get(url).status_code, 200, url)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_metrics()
+        self.client = APIClient()
+        make_catalog(3)
+        self.admin = make_user('boss', role='admin')
+
+    def metrics(self):
+        self.client.force_authenticate(self.admin)
+        response = self.client.get('/api/admin/metrics/')
+        self.client.force_authenticate(None)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        return response.content.decode()
+
+    def test_requests_are_recorded_per_url_name(self):
+        self.client.get('/api/products/')
+        self.client.get('/api/products/')
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get('/api/products/?page_size=1')
+        text = self.metrics()
+        self.assertIn('shop_requests_total{endpoint="products",method="GET",status="200"} 3', text)
+        self.assertIn('shop_request_duration_seconds_count{endpoint="products"} 3', text)
+        self.assertIn('shop_request_queries_bucket{endpoint="products",le="+Inf"} 3', text)
+        self.assertIn('# TYPE shop_request_serialize_seconds histogram', text)
+        queries = next(line for line in text.splitlines() if line.startswith('shop_request_queries_sum{endpoint="products"}'))
+        self.assertGreaterEqual(float(queries.split()[-1]), len(ctx.captured_queries))
+
+    def test_serialization_time_is_recorded(self):
+        self.client.get('/api/products/')
+        text = self.metrics()
+        serialize = next(line for line in text.splitlines() if line.startswith('shop_request_serialize_seconds_sum{endpoint="products"}'))
+        self.assertGreater(float(serialize.split()[-1]), 0)
+
+    def test_unnamed_routes_use_the_route(self):
+        self.client.force_authenticate(self.admin)
+        self.client.get('/api/admin/orders/')
+        self.assertIn('endpoint="api/admin/orders/"', self.metrics())
+
+    def test_admin_only(self):
+        self.client.force_authenticate(make_user('alice'))
+        self.assertEqual(self.client.get('/api/admin/metrics/').status_code, 403)
+
+    def test_slow_requests_are_logged_when_sampled(self):
+        with override_settings(METRICS_SLOW_SAMPLE_RATE=1, METRICS_SLOW_REQUEST_MS=0):
+            with self.assertLogs('shop.metrics', 'WARNING') as logs:
+                self.client.get('/api/products/')
+        self.assertIn('Slow request GET /api/products/', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+    def test_nothing_is_logged_without_sampling(self):
+        with override_settings(METRICS_SLOW_REQUEST_MS=0), mock.patch('shop.metrics.logger') as logger:
+            self.client.get('/api/products/')
+        logger.warning.assert_not_called()
+
+    @override_settings(ROOT_URLCONF=AsyncRoutes)
+    def test_async_views_are_measured(self):
+        self.client.get('/api/products/')
+        with override_settings(ROOT_URLCONF='ecommerce_project.urls'):
+            text = self.metrics()
+        line = next(line for line in text.splitlines() if line.startswith('shop_request_queries_sum{endpoint="api/products/"}'))
+        self.assertGreater(float(line.split()[-1]), 0)
+
+
+class BenchmarkTests(TestCase):
+    def test_seed_dataset(self):
+        data = seed_dataset(users=3, categories=2, products=10, orders=7, items=2)
+        self.assertEqual(len(data['customers']), 3)
+        self.assertEqual(Order.objects.filter(customer=data['customers'][0]).count(), 3)
+        order = Order.objects.first()
+        self.assertEqual(order.items.count(), 2)
+        self.assertEqual(order.total_price, sum(item.line_total for item in order.items.all()))
+        self.assertEqual(ShippingAddress.objects.count(), 7)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 95), 7)
+
+    def test_regressions(self):
+        baseline = {'order_list': {'p50_ms': 10, 'p95_ms': 20, 'peak_memory_kib': 100, 'queries_per_request': 4}}
+        same = {'order_list': {'p50_ms': 11, 'p95_ms': 24, 'peak_memory_kib': 110, 'queries_per_request': 4}}
+        self.assertEqual(regressions(baseline, same, 0.25), [])
+        worse = {'order_list': {'p50_ms': 11, 'p95_ms': 40, 'peak_memory_kib': 110, 'queries_per_request': 5}}
+        self.assertEqual(len(regressions(baseline, worse, 0.25)), 2)
+
+    def test_serialization_benchmark(self):
+        out = StringIO()
+        call_command('bench_serialization', '--orders', '5', '--iterations', '1', stdout=out)
+        self.assertIn('values summary', out.getvalue())
+        self.assertFalse(Order.objects.exists())
+
+    def test_command_saves_and_compares_baselines(self):
+        size = ['--users', '2', '--categories', '1', '--products', '5', '--orders', '4']
+        run = ['--iterations', '2', '--warmup', '0', '--memory-samples', '1',
+               '--scenario', 'product_list', '--scenario', 'order_list']
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'baseline.json')
+            call_command('bench_api', *size, *run, '--save', path, stdout=StringIO())
+            with open(path) as handle:
+                document = json.load(handle)
+            self.assertEqual(set(document['results']), {'product_list', 'order_list'})
+            self.assertFalse(Order.objects.exists())
+
+            document['results']['order_list']['queries_per_request'] = 0
+            with open(path, 'w') as handle:
+                json.dump(document, handle)
+            with self.assertRaisesMessage(CommandError, 'order_list: queries_per_request'):
+                call_command('bench_api', *size, *run, '--compare', path, '--tolerance', '100', stdout=StringIO(), stderr=StringIO())
+
+
+class SalesAnalyticsTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        make_catalog(3)
+        self.products = list(Product.objects.order_by('id'))
+        self.admin = make_user('boss', role='admin')
+        self.customer = make_user('alice')
+
+    def checkout(self, *lines):
+        self.client.force_authenticate(self.customer)
+        for product, quantity in lines:
+            self.client.post('/api/cart/', {'product_id': product.pk, 'quantity': quantity})
+        response = self.client.post('/api/checkout/', {'address': 'Road 1', 'city': 'Dhaka', 'zip_code': '1200'})
+        self.assertEqual(response.status_code, 201)
+        return Order.objects.get(pk=response.data['order_id'])
+
+    def summary(self, **params):
+        self.client.force_authenticate(self.admin)
+        response = self.client.get('/api/admin/analytics/sales/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def assertRollupMatchesLive(self, **params):
+        rollup = self.summary(**params)
+        live = self.summary(source='live', **params)
+        rollup.pop('source'), live.pop('source')
+        self.assertEqual(rollup, live)
+        return rollup
+
+    def test_rollups_follow_order_state(self):
+        first, second = self.products[0], self.products[1]
+        cancelled = self.checkout((first, 2), (second, 1))
+        shipped = self.checkout((second, 3))
+
+        self.client.force_authenticate(self.admin)
+        self.client.patch(f'/api/admin/orders/{shipped.pk}/', {'status': 'shipped', 'payment_status': 'success'})
+        self.client.force_authenticate(self.customer)
+        self.assertEqual(self.client.patch(f'/api/orders/{cancelled.pk}/').status_code, 200)
+
+        data = self.assertRollupMatchesLive()
+        self.assertEqual(data['totals'], {'orders': 1, 'items': 3, 'revenue': '33.00', 'average_order_value': '33.00'})
+        self.assertEqual(data['orders_by_status']['cancelled'], 1)
+        self.assertEqual(data['orders_by_status']['shipped'], 1)
+        self.assertEqual(data['orders_by_payment_status'], {'success': 1, 'in_progress': 0, 'failed': 0})
+        self.assertEqual(data['best_sellers'], [{'product_id': second.pk, 'title': second.title, 'quantity': 3, 'revenue': '33.00'}])
+        self.assertEqual(data['daily'], [{'date': timezone.localdate(), 'orders': 1, 'revenue': '33.00'}])
+
+        self.client.force_authenticate(self.admin)
+        self.client.delete(f'/api/admin/orders/{shipped.pk}/')
+        data = self.assertRollupMatchesLive()
+        self.assertEqual(data['totals']['orders'], 0)
+        self.assertEqual(data['best_sellers'], [])
+
+    def test_orders_edited_after_checkout_stay_consistent(self):
+        make_orders(self.customer, 2, self.products)
+        data = self.assertRollupMatchesLive()
+        self.assertEqual(data['totals']['orders'], 2)
+        self.assertEqual([row['quantity'] for row in data['best_sellers']], [4, 4, 4])
+
+    def test_date_range_and_monthly_series(self):
+        old = self.checkout((self.products[0], 1))
+        self.checkout((self.products[1], 1))
+        Order.objects.filter(pk=old.pk).update(created_at=timezone.now() - datetime.timedelta(days=62))
+        call_command('rebuild_sales_rollup', stdout=StringIO())
+
+        everything = self.assertRollupMatchesLive()
+        self.assertEqual(len(everything['daily']), 2)
+        self.assertEqual(len(everything['monthly']), 2)
+        self.assertEqual(everything['totals']['revenue'], '21.00')
+
+        since = (timezone.localdate() - datetime.timedelta(days=7)).isoformat()
+        recent = self.assertRollupMatchesLive(date_from=since)
+        self.assertEqual(recent['totals']['revenue'], '11.00')
+        self.assertEqual(recent['best_sellers'][0]['product_id'], self.products[1].pk)
+
+    def test_rebuild_matches_incremental_rollups(self):
+        self.checkout((self.products[0], 2), (self.products[2], 1))
+        before = self.summary()
+        call_command('rebuild_sales_rollup', stdout=StringIO())
+        self.assertEqual(self.summary(), before)
+
+    def test_invalid_params_and_permissions(self):
+        self.client.force_authenticate(self.customer)
+        self.assertEqual(self.client.get('/api/admin/analytics/sales/').status_code, 403)
+        self.client.force_authenticate(self.admin)
+        for params in ({'date_from': '2026-13-01'}, {'date_from': '2026-02-01', 'date_to': '2026-01-01'},
+                       {'top': '0'}, {'source': 'guess'}):
+            response = self.client.get('/api/admin/analytics/sales/', params)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('error', response.data)
+
+
+class AdminOrderListTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        make_catalog(2)
+        self.products = list(Product.objects.all())
+        self.admin = make_user('boss', role='admin')
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        make_orders(self.alice, 3, self.products)
+        make_orders(self.bob, 2, self.products)
+        Order.objects.create(customer=self.bob)  # open cart
+        self.client.force_authenticate(self.admin)
+
+    def get(self, **params):
+        response = self.client.get('/api/admin/orders/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_carts_are_left_out_unless_asked_for(self):
+        data = self.get()
+        self.assertEqual(data['total_orders'], 5)
+        self.assertTrue(all(order['is_checked_out'] for order in data['orders']))
+        self.assertEqual(self.get(is_checked_out='false')['total_orders'], 1)
+
+    def test_filters(self):
+        shipped = Order.objects.filter(customer=self.bob, is_checked_out=True).first()
+        Order.objects.filter(pk=shipped.pk).update(status='shipped', payment_status='success', completed=True)
+        self.assertEqual(self.get(customer=self.alice.pk)['total_orders'], 3)
+        self.assertEqual([o['id'] for o in self.get(status='shipped')['orders']], [shipped.pk])
+        self.assertEqual(self.get(payment_status='success')['total_orders'], 1)
+        self.assertEqual(self.get(completed='true')['total_orders'], 1)
+        self.assertEqual(self.get(status='pending', customer=self.bob.pk)['total_orders'], 1)
+
+    def test_date_range(self):
+        old = Order.objects.filter(customer=self.alice).first()
+        Order.objects.filter(pk=old.pk).update(created_at=timezone.now() - datetime.timedelta(days=40))
+        today = timezone.localdate()
+        recent = self.get(date_from=(today - datetime.timedelta(days=7)).isoformat())
+        self.assertEqual(recent['total_orders'], 4)
+        before = self.get(date_to=(today - datetime.timedelta(days=30)).isoformat())
+        self.assertEqual([o['id'] for o in before['orders']], [old.pk])
+
+    def test_pagination_walks_every_order_once(self):
+        first = self.get(page_size=2)
+        self.assertEqual(len(first['orders']), 2)
+        seen = [o['id'] for o in first['orders']]
+        url = first['next']
+        while url:
+            data = self.client.get(url).data
+            seen += [o['id'] for o in data['orders']]
+            url = data['next']
+        self.assertEqual(seen, list(Order.objects.filter(is_checked_out=True).order_by('-created_at', '-id').values_list('id', flat=True)))
+
+    def test_invalid_filters(self):
+        for params in ({'status': 'lost'}, {'customer': 'bob'}, {'date_from': 'yesterday'},
+                       {'date_from': '2026-02-01', 'date_to': '2026-01-01'}, {'completed': 'maybe'}):
+            response = self.client.get('/api/admin/orders/', params)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('error', response.data)
+
+
+@skipUnless(connection.vendor in ('sqlite', 'postgresql'), 'EXPLAIN output is backend specific')
+class AdminOrderIndexTests(TestCase):
+    """The admin order list filters are served by the Order indexes, in list order"""
+
+    def plan(self, **filters):
+        queryset = filter_orders(Order.objects.all(), **filters).order_by('-created_at', '-id')[:51]
+        if connection.vendor == 'postgresql':
+            # An empty test table is cheaper to scan, make the planner show its index choice
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        return queryset.explain()
+
+    def assertUsesIndex(self, index, **filters):
+        plan = self.plan(**filters)
+        self.assertIn(index, plan)
+        if connection.vendor == 'sqlite':
+            # A search on the index, already in the requested order
+            self.assertIn('SEARCH', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_index_per_filter(self):
+        since = datetime.date(2026, 1, 1)
+        self.assertUsesIndex('order_checked_created_idx')
+        self.assertUsesIndex('order_checked_created_idx', date_from=since, date_to=datetime.date(2026, 2, 1))
+        self.assertUsesIndex('order_checked_created_idx', completed=True)
+        self.assertUsesIndex('order_checked_status_idx', status='pending')
+        self.assertUsesIndex('order_checked_status_idx', status='shipped', date_from=since)
+        self.assertUsesIndex('order_checked_payment_idx', payment_status='success')
+        self.assertUsesIndex('order_customer_created_idx', customer_id=1)
+        self.assertUsesIndex('order_customer_created_idx', customer_id=1, is_checked_out=False)
+
+
+class ProjectionTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        make_catalog(3)
+        self.products = list(Product.objects.all())
+        self.admin = make_user('boss', role='admin')
+        self.customer = make_user('alice')
+        make_orders(self.customer, 3, self.products)
+        cart = Order.objects.create(customer=self.customer)
+        OrderItem.objects.create(order=cart, product=self.products[0], quantity=4)
+
+    def rendered(self, data):
+        return json.loads(json.dumps(data, cls=json.JSONEncoder, default=str))
+
+    def test_full_projection_matches_the_serializers(self):
+        orders = Order.objects.order_by('id')
+        self.assertEqual(
+            self.rendered(OrderProjection(checked_out=True).project(orders.filter(is_checked_out=True))),
+            self.rendered(OrderSerializer(order_queryset(orders.filter(is_checked_out=True)), many=True).data))
+        # Carts have no price snapshot, their items read the live product
+        self.assertEqual(
+            self.rendered(AdminOrderProjection().project(orders)),
+            self.rendered(AdminOrderSerializer(order_queryset(orders), many=True).data))
+        products = Product.objects.select_related('category').order_by('id')
+        self.assertEqual(
+            self.rendered(ProductProjection().project(products)),
+            self.rendered(ProductSerializer(products, many=True).data))
+
+    def test_fields_and_expand(self):
+        self.client.force_authenticate(self.customer)
+        rows = self.client.get('/api/orders/', {'fields': 'id,total_price'}).data
+        self.assertEqual([set(row) for row in rows], [{'id', 'total_price'}] * 3)
+
+        rows = self.client.get('/api/orders/', {'expand': 'items'}).data
+        self.assertEqual(set(rows[0]), set(OrderProjection.summary()) | {'items'})
+        self.assertEqual(len(rows[0]['items']), 3)
+
+        rows = self.client.get('/api/orders/', {'fields': 'id', 'expand': 'shipping_address'}).data
+        self.assertEqual(rows[0]['shipping_address']['address'], 'Road 2')
+
+        page = self.client.get('/api/products/', {'fields': 'id,title', 'expand': 'category'}).data
+        self.assertEqual(set(page['product_list'][0]), {'id', 'title', 'category'})
+        self.assertEqual(page['product_list'][0]['category']['slug'], 'phones')
+
+    def test_projection_query_counts(self):
+        self.client.force_authenticate(self.admin)
+        with CaptureQueriesContext(connection) as summary:
+            self.client.get('/api/admin/orders/', {'fields': 'id,status'})
+        with CaptureQueriesContext(connection) as expanded:
+            self.client.get('/api/admin/orders/', {'expand': 'items,shipping_address'})
+        self.assertEqual(len(expanded), len(summary) + 2)
+
+    def test_admin_pages_keep_the_projection(self):
+        self.client.force_authenticate(self.admin)
+        first = self.client.get('/api/admin/orders/', {'fields': 'id', 'page_size': 2}).data
+        second = self.client.get(first['next']).data
+        self.assertEqual(len(second['orders']), 1)
+        self.assertEqual(set(second['orders'][0]), {'id'})
+
+    def test_unknown_fields(self):
+        self.client.force_authenticate(self.customer)
+        for params in ({'fields': 'id,secret'}, {'expand': 'customer_name'}):
+            response = self.client.get('/api/orders/', params)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('error', response.data)
+        self.assertEqual(self.client.get('/api/products/', {'expand': 'items'}).status_code, 400)
+
+
+def image_upload(size, name='photo.png', image_format='PNG'):
+    from PIL import Image
+    buffer = BytesIO()
+    Image.new('RGB', size, (200, 30, 30)).save(buffer, image_format)
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type=f'image/{image_format.lower()}')
+
+
+class ImageMediaMixin:
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        overrides = override_settings(MEDIA_ROOT=media.name, PRODUCT_IMAGE_WORKERS=0)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.media_root = media.name
+        self.category = Category.objects.create(name='Phones', slug='phones')
+
+
+class ProductImageVariantTests(ImageMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(make_user('boss', role='admin'))
+
+    def create(self, upload):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/products/', {
+                'title': 'Phone', 'slug': 'phone', 'description': 'x', 'price': '10.00', 'stock': 1,
+                'category_id': self.category.pk, 'image': upload}, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        return Product.objects.get(pk=response.data['data']['id'])
+
+    def test_upload_renders_content_addressed_variants(self):
+        product = self.create(image_upload((2200, 1100)))
+        variants = product.image_variants['variants']
+        self.assertEqual(product.image_variants['source'], product.image.name)
+        self.assertEqual(set(variants), {'thumb', 'small', 'medium', 'large'})
+        self.assertEqual((variants['large']['width'], variants['large']['height']), (1280, 640))
+        self.assertEqual((variants['thumb']['width'], variants['thumb']['height']), (160, 80))
+        for variant in variants.values():
+            self.assertRegex(variant['name'], r'^products/variants/\w+/[0-9a-f]{20}\.webp$')
+            self.assertTrue(os.path.exists(os.path.join(self.media_root, variant['name'])))
+
+        data = self.client.get(f'/api/products/{product.pk}/').data
+        self.assertTrue(data['image_variants']['thumb']['url'].endswith(variants['thumb']['name']))
+        listed = self.client.get('/api/products/').data['product_list'][0]
+        self.assertEqual(listed['image_variants']['small']['width'], 320)
+
+    def test_small_images_are_not_upscaled(self):
+        product = self.create(image_upload((100, 50), 'small.jpg', 'JPEG'))
+        sizes = {(v['width'], v['height']) for v in product.image_variants['variants'].values()}
+        self.assertEqual(sizes, {(100, 50)})
+
+    def test_unchanged_image_is_not_rendered_again(self):
+        product = self.create(image_upload((300, 300)))
+        with mock.patch('shop.images.submit') as submit, self.captureOnCommitCallbacks(execute=True):
+            self.client.put(f'/api/products/{product.pk}/', {'stock': 5}, format='multipart')
+        submit.assert_not_called()
+
+    def test_variants_of_a_replaced_image_are_dropped(self):
+        from .images import generate_variants
+        product = self.create(image_upload((300, 300)))
+        Product.objects.filter(pk=product.pk).update(image_variants={})
+        with mock.patch('shop.images.render_variants', side_effect=lambda field_file: (
+                Product.objects.filter(pk=product.pk).update(image='products/other.png'), {})[1]):
+            self.assertFalse(generate_variants(product.pk))
+        self.assertEqual(Product.objects.get(pk=product.pk).image_variants, {})
+
+
+class ImageBackfillTests(ImageMediaMixin, TransactionTestCase):
+    def test_backfill_renders_missing_variants(self):
+        products = []
+        for i in range(3):
+            product = Product(category=self.category, title=f'P{i}', slug=f'p-{i}', description='x', price=1, stock=1)
+            product.image.save(f'p{i}.png', image_upload((400, 200)), save=False)
+            products.append(product)
+        Product.objects.bulk_create(products)  # no signals, like a raw import
+
+        out = StringIO()
+        call_command('generate_image_variants', '--workers', '2', stdout=out)
+        self.assertIn('Rendered variants for 3 products', out.getvalue())
+        for product in Product.objects.all():
+            self.assertEqual(product.image_variants['variants']['small']['width'], 320)
+
+        out = StringIO()
+        call_command('generate_image_variants', stdout=out)
+        self.assertIn('Every product image has its variants', out.getvalue())
+
+
+class MediaUploadTests(ImageMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        parts = tempfile.TemporaryDirectory()
+        self.addCleanup(parts.cleanup)
+        overrides = override_settings(UPLOAD_TEMP_DIR=parts.name, UPLOAD_CHUNK_SIZE=4096, UPLOAD_READ_SIZE=512)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.parts = parts.name
+
+        from PIL import Image
+        buffer = BytesIO()
+        # Noise, so the PNG does not compress to a single chunk
+        Image.frombytes('RGB', (64, 64), os.urandom(64 * 64 * 3)).save(buffer, 'PNG')
+        self.data = buffer.getvalue()
+        self.product = Product.objects.create(category=self.category, title='Phone', slug='phone',
+                                              description='x', price=10, stock=1)
+        self.client = APIClient()
+        self.client.force_authenticate(make_user('boss', role='admin'))
+
+    def start(self, data=None, sha256=None):
+        data = self.data if data is None else data
+        response = self.client.post('/api/admin/uploads/', {
+            'product_id': self.product.pk, 'filename': '../photo.png', 'size': len(data),
+            'sha256': sha256 or hashlib.sha256(data).hexdigest()}, format='json')
+        self.assertEqual(response.status_code, 201)
+        return response.data['id']
+
+    def put(self, upload_id, start, body, end=None, total=None):
+        end = start + len(body) - 1 if end is None else end
+        return self.client.put(f'/api/admin/uploads/{upload_id}/', body, content_type='application/octet-stream',
+                               HTTP_CONTENT_RANGE=f'bytes {start}-{end}/{total or len(self.data)}')
+
+    def send(self, upload_id, offset=0, size=4096):
+        while offset < len(self.data):
+            response = self.put(upload_id, offset, self.data[offset:offset + size])
+            self.assertEqual(response.status_code, 200)
+            offset = response.data['offset']
+
+    def finalize(self, upload_id):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(f'/api/admin/uploads/{upload_id}/finalize/')
+
+    def test_chunks_are_assembled_and_attached(self):
+        self.assertGreater(len(self.data), 8192)
+        upload_id = self.start()
+        self.send(upload_id)
+        response = self.finalize(upload_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['upload']['status'], 'complete')
+
+        self.product.refresh_from_db()
+        with self.product.image.open('rb') as handle:
+            self.assertEqual(handle.read(), self.data)
+        self.assertTrue(self.product.image.name.startswith('products/photo'))
+        self.assertIn('thumb', self.product.image_variants['variants'])
+        self.assertEqual(os.listdir(self.parts), [])
+        # A repeated finalize is harmless
+        self.assertEqual(self.finalize(upload_id).status_code, 200)
+
+    def test_interrupted_chunk_resumes_from_the_offset(self):
+        upload_id = self.start()
+        self.assertEqual(self.put(upload_id, 0, self.data[:4096]).status_code, 200)
+        # The client claimed 4096 bytes but the connection dropped after 1000
+        response = self.put(upload_id, 4096, self.data[4096:5096], end=8191)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['offset'], 5096)
+
+        self.assertEqual(self.client.get(f'/api/admin/uploads/{upload_id}/').data['offset'], 5096)
+        # Retrying a chunk we have is a no-op, skipping ahead is refused
+        self.assertEqual(self.put(upload_id, 0, self.data[:4096]).data['offset'], 5096)
+        skipped = self.put(upload_id, 6000, self.data[6000:7000])
+        self.assertEqual((skipped.status_code, skipped.data['offset']), (409, 5096))
+
+        self.send(upload_id, offset=5096)
+        self.assertEqual(self.finalize(upload_id).status_code, 200)
+
+    def test_checksum_mismatch_resets_the_upload(self):
+        upload_id = self.start(sha256='0' * 64)
+        self.send(upload_id)
+        response = self.finalize(upload_id)
+        self.assertEqual((response.status_code, response.data['offset']), (422, 0))
+        self.assertEqual(MediaUpload.objects.get(pk=upload_id).received, 0)
+        self.product.refresh_from_db()
+        self.assertFalse(self.product.image)
+
+    def test_rejected_requests(self):
+        upload_id = self.start()
+        self.assertEqual(self.finalize(upload_id).status_code, 409)
+        self.assertEqual(self.put(upload_id, 0, self.data[:5000]).status_code, 413)
+        response = self.client.put(f'/api/admin/uploads/{upload_id}/', b'x', content_type='application/octet-stream')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/admin/uploads/', {'product_id': self.product.pk, 'filename': 'a.png',
+                                                            'size': 10 ** 10, 'sha256': '0' * 64}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        text = b'not an image at all'
+        upload_id = self.start(text)
+        self.put(upload_id, 0, text, total=len(text))
+        self.assertEqual(self.finalize(upload_id).status_code, 422)
+
+        self.client.force_authenticate(make_user('alice'))
+        self.assertEqual(self.client.get(f'/api/admin/uploads/{upload_id}/').status_code, 403)
+
+    def test_abort_and_purge(self):
+        aborted, stale = self.start(), self.start()
+        self.assertEqual(self.client.delete(f'/api/admin/uploads/{aborted}/').status_code, 200)
+        MediaUpload.objects.filter(pk=stale).update(updated_at=timezone.now() - datetime.timedelta(days=2))
+        out = StringIO()
+        call_command('purge_uploads', stdout=out)
+        self.assertIn('Purged 1 expired uploads', out.getvalue())
+        self.assertFalse(MediaUpload.objects.exists())
+        self.assertEqual(os.listdir(self.parts), [])
+
+
+class IdempotencyKeyTests(TestCase):
+    def setUp(self):
+        make_catalog(1)
+        self.product = Product.objects.get()
+        self.customer = make_user('alice')
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer)
+        self.client.post('/api/cart/', {'product_id': self.product.id, 'quantity': 2})
+
+    def checkout(self, key, data=CHECKOUT_ADDRESS):
+        return self.client.post('/api/checkout/', data, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retried_cart_add_is_counted_once(self):
+        for _ in range(2):
+            response = self.client.post('/api/cart/', {'product_id': self.product.id, 'quantity': 1},
+                                        format='json', HTTP_IDEMPOTENCY_KEY='add-1')
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+        self.assertEqual(response.data['total_items'], 3)
+        operations = {'operations': [{'op': 'add', 'product_id': self.product.id, 'quantity': 2}]}
+        for _ in range(2):
+            self.client.post('/api/cart/', operations, format='json', HTTP_IDEMPOTENCY_KEY='batch-1')
+        self.assertEqual(OrderItem.objects.get().quantity, 5)
+
+    def test_retried_checkout_replays_the_first_response(self):
+        first = self.checkout('attempt-1')
+        self.assertEqual(first.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', first)
+
+        with CaptureQueriesContext(connection) as queries:
+            retry = self.checkout('attempt-1')
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(json.loads(retry.content), json.loads(first.content))
+        # Only the key is read, the checkout does not run again
+        self.assertLessEqual(len(queries), 5)
+        self.assertEqual(ShippingAddress.objects.count(), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 3)
+
+        # A new key is a new checkout, and the cart is empty by now
+        self.assertEqual(self.checkout('attempt-2').status_code, 400)
+
+    def test_key_reused_for_another_request(self):
+        self.checkout('attempt-1')
+        response = self.checkout('attempt-1', {**CHECKOUT_ADDRESS, 'city': 'Sylhet'})
+        self.assertEqual(response.status_code, 422)
+        # Keys are per user
+        self.client.force_authenticate(make_user('bob'))
+        self.assertEqual(self.checkout('attempt-1').status_code, 400)
+        self.assertEqual(IdempotencyKey.objects.count(), 2)
+
+    def test_requests_without_a_key_are_not_recorded(self):
+        self.assertEqual(self.client.post('/api/checkout/', CHECKOUT_ADDRESS).status_code, 201)
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.assertEqual(self.checkout('x' * 256).status_code, 400)
+
+    def test_cancel_is_replayed(self):
+        order_id = self.checkout('checkout').data['order_id']
+        first = self.client.patch(f'/api/orders/{order_id}/', HTTP_IDEMPOTENCY_KEY='cancel')
+        retry = self.client.patch(f'/api/orders/{order_id}/', HTTP_IDEMPOTENCY_KEY='cancel')
+        self.assertEqual((first.status_code, retry.status_code), (200, 200))
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        # Without the key the second cancel is refused
+        self.assertEqual(self.client.patch(f'/api/orders/{order_id}/').status_code, 400)
+
+    def test_expired_keys_run_again_and_are_purged(self):
+        self.checkout('attempt-1')
+        IdempotencyKey.objects.update(expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        response = self.checkout('attempt-1')
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn('Idempotent-Replayed', response)
+        self.assertGreater(IdempotencyKey.objects.get().expires_at, timezone.now())
+
+        IdempotencyKey.objects.update(expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        out = StringIO()
+        call_command('purge_idempotency_keys', stdout=out)
+        self.assertIn('Purged 1 expired idempotency keys', out.getvalue())
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+
+class ConcurrentIdempotencyKeyTests(TransactionTestCase):
+    threads = 6
+
+    def test_concurrent_duplicates_check_out_once(self):
+        make_catalog(1)
+        product = Product.objects.get()
+        customer = make_user('alice')
+        order = Order.objects.create(customer=customer)
+        OrderItem.objects.create(order=order, product=product, quantity=1)
+
+        results = []
+        start = threading.Barrier(self.threads)
+
+        def checkout():
+            client = APIClient()
+            client.force_authenticate(customer)
+            start.wait()
+            try:
+                for _ in range(50):
+                    try:
+                        response = client.post('/api/checkout/', CHECKOUT_ADDRESS, format='json',
+                                               HTTP_IDEMPOTENCY_KEY='same')
+                    except OperationalError:
+                        # SQLite allows a single writer, try again
+                        continue
+                    results.append((response.status_code, response.data['order_id']))
+                    return
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=checkout) for _ in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(results, [(201, order.id)] * self.threads)
+        self.assertEqual(ShippingAddress.objects.count(), 1)
+        product.refresh_from_db()
+        self.assertEqual(product.stock, 4)
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', LOW_STOCK_THRESHOLD=3,
+                   LOW_STOCK_ALERT_EMAILS=None, JOB_MAX_ATTEMPTS=3, JOB_RETRY_DELAY=30)
+class JobQueueTests(TestCase):
+    def setUp(self):
+        make_catalog(2)
+        self.first, self.second = Product.objects.order_by('id')
+        self.customer = make_user('alice')
+        make_user('boss', role='admin')
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer)
+
+    def checkout(self, quantity=1):
+        self.client.post('/api/cart/', {'product_id': self.first.id, 'quantity': quantity})
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/checkout/', CHECKOUT_ADDRESS)
+        self.assertEqual(response.status_code, 201)
+        return response.data['order_id']
+
+    def test_status_changes_email_the_customer_from_the_worker(self):
+        order_id = self.checkout()
+        # Queued on commit, nothing is sent during the request
+        self.assertEqual(list(Job.objects.values_list('name', 'payload')),
+                         [('order_email', {'order_id': order_id, 'event': 'placed'})])
+        self.assertEqual(mail.outbox, [])
+
+        out = StringIO()
+        call_command('run_jobs', '--once', stdout=out)
+        self.assertIn('Ran 1 jobs, 0 failed', out.getvalue())
+        self.assertEqual(mail.outbox[0].to, ['alice@example.com'])
+        self.assertEqual(mail.outbox[0].subject, f'We received your order #{order_id}')
+        self.assertIn('1 x Product 0', mail.outbox[0].body)
+        self.assertFalse(Job.objects.exists())
+
+        self.client.force_authenticate(CustomUser.objects.get(username='boss'))
+        for value in ('processing', 'shipped', 'delivered'):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.patch(f'/api/admin/orders/{order_id}/', {'status': value})
+        jobs.run_pending()
+        self.assertEqual([message.subject for message in mail.outbox[1:]], [
+            f'Your order #{order_id} has shipped', f'Your order #{order_id} was delivered'])
+
+    def test_rolled_back_changes_queue_nothing(self):
+        self.client.post('/api/cart/', {'product_id': self.first.id, 'quantity': 9})
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/checkout/', CHECKOUT_ADDRESS)
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(Job.objects.exists())
+
+    def test_low_stock_alert_once_the_threshold_is_crossed(self):
+        self.checkout(quantity=1)
+        self.assertEqual(Job.objects.filter(name='low_stock_alert').count(), 0)
+        self.checkout(quantity=2)
+        self.checkout(quantity=1)
+        alerts = Job.objects.filter(name='low_stock_alert')
+        self.assertEqual([job.payload for job in alerts], [{'product_ids': [self.first.id]}])
+
+        jobs.run_pending()
+        alert = [message for message in mail.outbox if message.subject.startswith('Low stock')]
+        self.assertEqual(len(alert), 1)
+        self.assertEqual(alert[0].to, ['boss@example.com'])
+        self.assertIn('Product 0: 1 left', alert[0].body)
+
+    def test_failures_are_retried_with_backoff_then_given_up(self):
+        self.checkout()
+        with mock.patch('shop.notifications.send_mail', side_effect=ConnectionRefusedError('SMTP is down')), \
+                self.assertLogs('shop.jobs', 'ERROR'):
+            self.assertEqual(jobs.run_pending(), (0, 1))
+            job = Job.objects.get()
+            self.assertEqual((job.status, job.attempts), ('queued', 1))
+            self.assertIn('SMTP is down', job.last_error)
+            delay = (job.run_at - timezone.now()).total_seconds()
+            self.assertTrue(10 < delay <= 30, delay)
+            # Not due yet
+            self.assertEqual(jobs.run_pending(), (0, 0))
+
+            for _ in range(2):
+                Job.objects.update(run_at=timezone.now())
+                self.assertEqual(jobs.run_pending(), (0, 1))
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), ('failed', 3))
+            self.assertTrue(1800 <= jobs.backoff(20) <= 3600)
+
+        Job.objects.update(run_at=timezone.now())
+        self.assertEqual(jobs.run_pending(), (0, 0))
+        self.assertEqual(mail.outbox, [])
+
+    def test_abandoned_jobs_are_requeued(self):
+        self.checkout()
+        job = jobs.claim('dead-worker')
+        self.assertEqual(job.status, 'running')
+        self.assertIsNone(jobs.claim('other'))
+        self.assertEqual(jobs.requeue_stale(timeout=3600), 0)
+        Job.objects.update(locked_at=timezone.now() - datetime.timedelta(hours=2))
+        self.assertEqual(jobs.requeue_stale(timeout=3600), 1)
+        self.assertEqual(jobs.run_pending(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+
+    @skipUnless(connection.features.has_select_for_update_skip_locked, "needs SELECT ... FOR UPDATE SKIP LOCKED")
+    def test_dequeue_skips_locked_rows(self):
+        self.checkout()
+        with CaptureQueriesContext(connection) as queries:
+            jobs.claim('worker')
+        self.assertTrue(any('SKIP LOCKED' in query['sql'] for query in queries))
+
+
+class PaymentTests(TestCase):
+    def setUp(self):
+        SimulatorGateway.reset()
+        self.gateway = SimulatorGateway()
+        make_catalog(1)
+        self.customer = make_user('alice')
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer)
+        self.order_id = self.checkout()
+
+    def checkout(self, payment_method='ONLINE'):
+        self.client.post('/api/cart/', {'product_id': Product.objects.get().id, 'quantity': 1})
+        response = self.client.post('/api/checkout/', {**CHECKOUT_ADDRESS, 'payment_method': payment_method})
+        return response.data['order_id']
+
+    def pay(self, order_id=None):
+        return self.client.post(f'/api/orders/{order_id or self.order_id}/pay/')
+
+    def webhook(self, body, headers):
+        return APIClient().post('/api/payments/webhook/', body, content_type='application/json',
+                                HTTP_PAYMENT_SIGNATURE=headers['Payment-Signature'])
+
+    def payment_statuses(self):
+        return sales_summary()['orders_by_payment_status']
+
+    def test_webhook_settles_the_order_once(self):
+        response = self.pay()
+        self.assertEqual(response.status_code, 200)
+        transaction_id, redirect_url = response.data['transaction_id'], response.data['redirect_url']
+        self.assertTrue(redirect_url)
+        # Asking again while it is pending does not open a second charge, and still says where to pay
+        retry = self.pay().data
+        self.assertEqual((retry['transaction_id'], retry['redirect_url']), (transaction_id, redirect_url))
+
+        body, headers = self.gateway.complete(transaction_id)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.webhook(body, headers)
+        self.assertEqual((response.status_code, response.data['result']), (200, 'updated'))
+        # The conditional UPDATE, the order, and the two rollup rows
+        statements = [query['sql'] for query in queries if 'SAVEPOINT' not in query['sql']]
+        self.assertLessEqual(len(statements), 5)
+
+        order = Order.objects.get(pk=self.order_id)
+        self.assertEqual((order.payment_status, order.transaction_id), ('success', transaction_id))
+        self.assertEqual(self.payment_statuses(), {'success': 1, 'in_progress': 0, 'failed': 0})
+
+        # Gateways deliver callbacks more than once
+        self.assertEqual(self.webhook(body, headers).data['result'], 'duplicate')
+        self.assertEqual(self.pay().status_code, 409)
+
+    def test_failed_payment_can_be_retried(self):
+        first = self.pay().data['transaction_id']
+        self.webhook(*self.gateway.complete(first, 'failed'))
+        self.assertEqual(Order.objects.get(pk=self.order_id).payment_status, 'failed')
+        self.assertEqual(self.payment_statuses()['failed'], 1)
+
+        second = self.pay().data['transaction_id']
+        self.assertNotEqual(first, second)
+        self.assertEqual(self.payment_statuses(), {'success': 0, 'in_progress': 1, 'failed': 0})
+        # The old charge no longer belongs to the order
+        self.assertEqual(self.webhook(*self.gateway.complete(first)).status_code, 404)
+        self.webhook(*self.gateway.complete(second))
+        self.assertEqual(Order.objects.get(pk=self.order_id).payment_status, 'success')
+
+    def test_rejected_callbacks(self):
+        transaction_id = self.pay().data['transaction_id']
+        body, headers = self.gateway.complete(transaction_id)
+
+        tampered = body.replace(b'"succeeded"', b'"failed"')
+        self.assertEqual(self.webhook(tampered, headers).status_code, 403)
+        stale = {'Payment-Signature': sign(body, timestamp=int(timezone.now().timestamp()) - 3600)}
+        self.assertEqual(self.webhook(body, stale).status_code, 403)
+        self.assertEqual(APIClient().post('/api/payments/webhook/', body, content_type='application/json').status_code, 403)
+
+        cheap = json.dumps({'transaction_id': transaction_id, 'status': 'succeeded', 'amount': '0.01'}).encode()
+        self.assertEqual(self.webhook(cheap, {'Payment-Signature': sign(cheap)}).status_code, 400)
+        unpriced = json.dumps({'transaction_id': transaction_id, 'status': 'succeeded'}).encode()
+        self.assertEqual(self.webhook(unpriced, {'Payment-Signature': sign(unpriced)}).status_code, 400)
+        unknown = json.dumps({'transaction_id': 'sim_nope', 'status': 'succeeded'}).encode()
+        self.assertEqual(self.webhook(unknown, {'Payment-Signature': sign(unknown)}).status_code, 404)
+        self.assertEqual(Order.objects.get(pk=self.order_id).payment_status, 'in_progress')
+
+    def test_gateways_must_implement_the_interface(self):
+        class Incomplete(PaymentGateway):
+            def create_charge(self, order):
+                return None
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+    def test_only_online_orders_are_paid(self):
+        self.assertEqual(self.pay(self.checkout('COD')).status_code, 400)
+        self.client.force_authenticate(make_user('bob'))
+        self.assertEqual(self.pay().status_code, 404)
+
+    def test_transaction_ids_are_unique(self):
+        transaction_id = self.pay().data['transaction_id']
+        other = Order.objects.create(customer=self.customer, is_checked_out=True)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Order.objects.filter(pk=other.pk).update(transaction_id=transaction_id)
+
+    def test_reconcile_settles_lost_callbacks_in_batches(self):
+        settled = self.pay().data['transaction_id']
+        pending = self.pay(self.checkout()).data['transaction_id']
+        failed = self.pay(self.checkout()).data['transaction_id']
+        # The gateway settled these, but the callbacks never arrived
+        self.gateway.complete(settled)
+        self.gateway.complete(failed, 'failed')
+
+        out = StringIO()
+        call_command('reconcile_payments', stdout=out)
+        self.assertIn('Settled 0 payments', out.getvalue())
+
+        Order.objects.update(updated_at=timezone.now() - datetime.timedelta(hours=1))
+        call_command('reconcile_payments', '--batch-size', '1', stdout=out)
+        self.assertIn('Settled 2 payments, 1 still pending', out.getvalue())
+        self.assertEqual(dict(Order.objects.values_list('transaction_id', 'payment_status')),
+                         {settled: 'success', pending: 'in_progress', failed: 'failed'})
+        self.assertEqual(self.payment_statuses(), {'success': 1, 'in_progress': 1, 'failed': 1})
@@ -0,0 +1,187 @@
+"""
+Chunked, resumable uploads of product images.
+
+A client opens a session with the file's name, size and SHA-256. It then
+PUTs the bytes in ranged chunks (Content-Range: bytes start-end/size) that
+are streamed straight into a temp file under UPLOAD_TEMP_DIR, and finally
+asks for the session to be finalized. Finalizing checks the size and the
+checksum, makes sure the file is an image, and saves it to Product.image.
+From there the usual image pipeline takes over (shop/images.py).
+
+Memory stays bounded: a chunk is copied to disk in UPLOAD_READ_SIZE pieces,
+and the checksum is computed by reading the file back the same way.
+Chunks are at most UPLOAD_CHUNK_SIZE bytes, so a request never ties up a
+worker for long.
+
+Resuming: MediaUpload.received is the length of the prefix received so far,
+and a chunk must start there. A chunk cut off mid-way still advances it by
+what arrived, so after an interrupted transfer the client reads the offset
+back (GET) and carries on from it. The offset moves with a conditional
+UPDATE, so two requests racing on the same session can't both claim a
+range.
+"""
+import datetime
+import hashlib
+import os
+import re
+import tempfile
+
+from django.conf import settings
+from django.core.files import File
+from django.db.models.functions import Now
+from django.utils import timezone
+from PIL import Image, UnidentifiedImageError
+
+from .models import MediaUpload
+
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+
+class UploadError(Exception):
+    """A request the upload can't accept, carries the HTTP status to answer with"""
+
+    def __init__(self, message, status=400, offset=None):
+        self.status = status
+        self.offset = offset
+        super().__init__(message)
+
+
+def chunk_size():
+    return getattr(settings, 'UPLOAD_CHUNK_SIZE', 5 * 1024 * 1024)
+
+
+def max_size():
+    return getattr(settings, 'UPLOAD_MAX_SIZE', 50 * 1024 * 1024)
+
+
+def read_size():
+    return getattr(settings, 'UPLOAD_READ_SIZE', 64 * 1024)
+
+
+def temp_dir():
+    directory = getattr(settings, 'UPLOAD_TEMP_DIR', None) or os.path.join(tempfile.gettempdir(), 'shop-uploads')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def temp_path(upload):
+    return os.path.join(temp_dir(), f'{upload.pk}.part')
+
+
+def start_upload(product, user, filename, size, sha256):
+    """Open a session with an empty temp file"""
+    if size < 1 or size > max_size():
+        raise UploadError(f'size must be between 1 and {max_size()} bytes')
+    if not re.fullmatch(r'[0-9a-fA-F]{64}', sha256 or ''):
+        raise UploadError('sha256 must be the hex SHA-256 of the file')
+    upload = MediaUpload.objects.create(
+        product=product, created_by=user, filename=os.path.basename(filename)[:255] or 'upload',
+        size=size, sha256=sha256.lower())
+    open(temp_path(upload), 'wb').close()
+    return upload
+
+
+def parse_content_range(header, upload):
+    """(start, end) of a chunk from its Content-Range header, end inclusive"""
+    match = CONTENT_RANGE.match(header or '')
+    if not match:
+        raise UploadError('Content-Range must be "bytes <start>-<end>/<size>"')
+    start, end, total = (int(value) for value in match.groups())
+    if total != upload.size or start > end or end >= upload.size:
+        raise UploadError(f'Content-Range does not fit a {upload.size} byte upload')
+    if end - start + 1 > chunk_size():
+        raise UploadError(f'Chunks may be at most {chunk_size()} bytes', status=413)
+    return start, end
+
+
+def write_chunk(upload, start, end, stream):
+    """
+    Copy the chunk from the request stream to the temp file and return the
+    new offset. Whatever arrives is kept, so a cut off chunk still counts.
+    """
+    if upload.status != 'open':
+        raise UploadError('The upload is already complete', status=409, offset=upload.received)
+    if start != upload.received:
+        if end < upload.received:
+            # A retry of a chunk we already have
+            return upload.received
+        raise UploadError(f'Expected a chunk starting at byte {upload.received}', status=409, offset=upload.received)
+
+    remaining = end - start + 1
+    written = 0
+    with open(temp_path(upload), 'r+b') as handle:
+        handle.seek(start)
+        while remaining:
+            data = stream.read(min(read_size(), remaining))
+            if not data:
+                break
+            handle.write(data)
+            written += len(data)
+            remaining -= len(data)
+
+    # Only the request that started at the current offset may move it
+    moved = MediaUpload.objects.filter(pk=upload.pk, received=start, status='open').update(
+        received=start + written, updated_at=Now())
+    upload.refresh_from_db(fields=['received', 'status'])
+    if not moved:
+        raise UploadError('Another request wrote this range first', status=409, offset=upload.received)
+    if remaining:
+        raise UploadError('The chunk ended early, resume from the returned offset', offset=upload.received)
+    return upload.received
+
+
+def checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(read_size()), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def discard(upload):
+    try:
+        os.remove(temp_path(upload))
+    except FileNotFoundError:
+        pass
+
+
+def finalize(upload):
+    """Verify the assembled file and save it as the product's image"""
+    if upload.status == 'complete':
+        return upload.product
+    if upload.received != upload.size:
+        raise UploadError(f'Only {upload.received} of {upload.size} bytes were received', status=409, offset=upload.received)
+
+    path = temp_path(upload)
+    if checksum(path) != upload.sha256:
+        # The bytes on disk are not the file, start over
+        upload.received = 0
+        upload.save(update_fields=['received', 'updated_at'])
+        open(path, 'wb').close()
+        raise UploadError('Checksum mismatch, the upload was reset', status=422, offset=0)
+    try:
+        with Image.open(path) as image:
+            image.verify()
+    except (UnidentifiedImageError, OSError, SyntaxError):
+        raise UploadError('The file is not an image', status=422)
+
+    product = upload.product
+    with open(path, 'rb') as handle:
+        # Streams into storage, the post_save receivers render the variants
+        product.image.save(upload.filename, File(handle), save=True)
+    upload.status = 'complete'
+    upload.save(update_fields=['status', 'updated_at'])
+    discard(upload)
+    return product
+
+
+def purge_expired(ttl=None):
+    """Drop open sessions idle for longer than UPLOAD_SESSION_TTL seconds, returns how many"""
+    ttl = ttl if ttl is not None else getattr(settings, 'UPLOAD_SESSION_TTL', 24 * 3600)
+    expired = MediaUpload.objects.filter(status='open', updated_at__lt=timezone.now() - datetime.timedelta(seconds=ttl))
+    count = 0
+    for upload in expired.iterator():
+        discard(upload)
+        upload.delete()
+        count += 1
+    return count
@@ -1,33 +1,52 @@
+from django.conf import settings
 from django.urls import path
-from .views import RegisterView,LoginView,UserListView,UserDetailUpdateDeleteView,CategoryCreateOrListView,CategoryUpdateOrDeleteView,ProductListCreateAPIView,ProductDetailOrDeleteView,CartAPI,CheckoutAPIView,OrderListAPIView,OrderDetailUpdateDeleteView,AdminOrderListAPIView,AdminOrderUpdateView
+from .async_views import AsyncCartView,AsyncCategoryListView,AsyncLoginView,AsyncOrderListView,AsyncProductDetailView,AsyncProductListView
+from .views import RegisterView,LoginView,UserListView,UserDetailUpdateDeleteView,CategoryCreateOrListView,CategoryUpdateOrDeleteView,ProductListCreateAPIView,ProductBulkAPIView,ProductSearchAPIView,ProductDetailOrDeleteView,CartAPI,CheckoutAPIView,OrderListAPIView,OrderDetailUpdateDeleteView,AdminOrderListAPIView,AdminOrderUpdateView,CacheStatsAPIView,MetricsAPIView,SalesAnalyticsAPIView,OrderPaymentAPIView,PaymentWebhookAPIView,MediaUploadCreateAPIView,MediaUploadDetailAPIView,MediaUploadFinalizeAPIView
+
+
+
+def select(name, sync_view, async_view):
+    """Route to the async implementation when `name` is listed in settings.ASYNC_VIEWS"""
+    view = async_view if name in getattr(settings, 'ASYNC_VIEWS', ()) else sync_view
+    return view.as_view()
 
 
 urlpatterns = [
     path('register/', RegisterView.as_view(), name='register'),
-    path('login/', LoginView.as_view(), name='login'),
+    path('login/', select('login', LoginView, AsyncLoginView), name='login'),
     path('users/',UserListView.as_view(),name='user_list'),
     path('user/<int:pk>/',UserDetailUpdateDeleteView.as_view(),name="user_detail"),
 
     #Category URL
-    path('categories/',CategoryCreateOrListView.as_view(),name='categories'),
+    path('categories/',select('categories',CategoryCreateOrListView,AsyncCategoryListView),name='categories'),
     path('category/<int:pk>/',CategoryUpdateOrDeleteView.as_view(),name='category_detail'),
 
     #Product URL
-    path('products/',ProductListCreateAPIView.as_view(),name='products'),
-    path('products/<int:pk>/', ProductDetailOrDeleteView.as_view(), name='product-detail'),
+    path('products/',select('products',ProductListCreateAPIView,AsyncProductListView),name='products'),
+    path('products/search/',ProductSearchAPIView.as_view(),name='product-search'),
+    path('admin/products/bulk/',ProductBulkAPIView.as_view(),name='product-bulk'),
+    path('admin/uploads/',MediaUploadCreateAPIView.as_view(),name='uploads'),
+    path('admin/uploads/<uuid:pk>/',MediaUploadDetailAPIView.as_view(),name='upload-detail'),
+    path('admin/uploads/<uuid:pk>/finalize/',MediaUploadFinalizeAPIView.as_view(),name='upload-finalize'),
+    path('products/<int:pk>/', select('product-detail',ProductDetailOrDeleteView,AsyncProductDetailView), name='product-detail'),
 
     #Cart URL
-    path('cart/',CartAPI.as_view(),name='cart-api'),
+    path('cart/',select('cart-api',CartAPI,AsyncCartView),name='cart-api'),
     path("checkout/", CheckoutAPIView.as_view(), name="checkout"),
 
     #Order for user
-    path('orders/',OrderListAPIView.as_view(),name='orders'),
+    path('orders/',select('orders',OrderListAPIView,AsyncOrderListView),name='orders'),
     path('orders/<int:pk>/',OrderDetailUpdateDeleteView.as_view()),
+    path('orders/<int:pk>/pay/',OrderPaymentAPIView.as_view(),name='order-pay'),
+    path('payments/webhook/',PaymentWebhookAPIView.as_view(),name='payment-webhook'),
    
 
     #admin users
     path('admin/orders/',AdminOrderListAPIView.as_view()),
     path('admin/orders/<int:pk>/',AdminOrderUpdateView.as_view()),  
+    path('admin/analytics/sales/',SalesAnalyticsAPIView.as_view(),name='sales-analytics'),
+    path('admin/cache/stats/',CacheStatsAPIView.as_view(),name='cache-stats'),
+    path('admin/metrics/',MetricsAPIView.as_view(),name='metrics'),
 
    
   
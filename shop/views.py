@@ -2,10 +2,28 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework import status,permissions
 from rest_framework.permissions import IsAuthenticated,IsAdminUser
+from rest_framework.throttling import BaseThrottle
 from .permissions import IsAdmin,IsCustomer,IsStaff,IsAdminOrSelf,IsAdminOrReadOnly
-from .serializers import RegisterSerializer,LoginSerializer,UserSerializer,CategorySerializer,ProductSerializer,OrderItemSerializer,OrderSerializer,ShippingAddressSerializer,AdminOrderSerializer
-from .models import CustomUser,Category,Product,Order,OrderItem,ShippingAddress
+from .serializers import RegisterSerializer,LoginSerializer,UserSerializer,CategorySerializer,ProductSerializer,OrderItemSerializer,OrderSerializer,ShippingAddressSerializer,AdminOrderSerializer,CartOperationSerializer
+from .models import CustomUser,Category,Product,Order,OrderItem,ShippingAddress,MediaUpload
+from .pagination import KeysetPagination,OrderKeysetPagination
+from .loaders import order_queryset
+from .inventory import InsufficientStock,reserve_stock,release_stock
+from .cache import CATALOG,PRODUCT_LISTS,cached,cache_stats
+from . import analytics,bulk,conditional,login,metrics,payments,uploads
+from .projection import AdminOrderProjection,InvalidProjection,OrderProjection,ProductProjection
+from .idempotency import idempotent
+from .search import search_products
+from .carts import CartBusy,get_cart_store
+from .filters import InvalidFilter,filter_orders,filter_products,parse_order_filters,parse_product_filters,product_facets
 from django.shortcuts import get_object_or_404
+from django.db import transaction
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from django.http import HttpResponse,StreamingHttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from itertools import islice
+import json
 
 
 class RegisterView(APIView):
@@ -20,12 +38,31 @@ class RegisterView(APIView):
     
 class LoginView(APIView):
     def post(self, request):
+        username=str(request.data.get('username',''))
+        try:
+            # Rate limits are checked before anything gets hashed
+            login.check_rate(self.throttle_ident(request),username)
+        except login.LoginThrottled as exc:
+            return Response({"error":"Too many login attempts, try again later"},status=status.HTTP_429_TOO_MANY_REQUESTS,headers={'Retry-After':str(exc.retry_after)})
+
         serializer = LoginSerializer(data=request.data)
-        
-        if serializer.is_valid():
+        try:
+            valid=serializer.is_valid()
+        except login.LoginBusy:
+            return Response({"error":"Login is busy, try again shortly"},status=status.HTTP_503_SERVICE_UNAVAILABLE,headers={'Retry-After':'1'})
+
+        if valid:
+            login.record_success(username)
             return Response(serializer.validated_data, status=status.HTTP_200_OK)
-        
+
+        if 'non_field_errors' in serializer.errors:
+            login.record_failure(username)
         return Response(serializer.errors, status=status.HTTP_401_UNAUTHORIZED)
+
+    @staticmethod
+    def throttle_ident(request):
+        # Client IP as DRF throttles see it (honours NUM_PROXIES for X-Forwarded-For)
+        return BaseThrottle().get_ident(request)
     
 class UserListView(APIView):
     permission_classes=[IsAuthenticated]
@@ -76,15 +113,18 @@ class UserDetailUpdateDeleteView(APIView):
 class CategoryCreateOrListView(APIView):
     permission_classes=[IsAuthenticated]
 
+    @method_decorator(condition(etag_func=conditional.category_list_etag,last_modified_func=conditional.category_list_last_modified))
     def get(self, request):
-      categories = Category.objects.all()
-      total = categories.count()
+      return Response(cached(CATALOG,'categories',self.build_payload))
+
+    def build_payload(self):
+      categories = list(Category.objects.all())
       serializer = CategorySerializer(categories, many=True)
-      return Response({
+      return {
           "message": "Here is the List of Categories",
           'categories': serializer.data,
-          'total': total            
-      })
+          'total': len(categories)
+      }
     
 
     def post(self, request):
@@ -123,16 +163,55 @@ class CategoryUpdateOrDeleteView(APIView):
 class ProductListCreateAPIView(APIView):
    
     country="Bangladesh"
+    pagination_class=KeysetPagination
+    export_chunk_size=2000
+
+    @method_decorator(condition(etag_func=conditional.product_list_etag,last_modified_func=conditional.product_list_last_modified))
     def get(self,request):
-        products=Product.objects.all()
-        if products:
-           serializer=ProductSerializer(products,many=True)
-           return Response({
-               "message":f"Total {products.count()} products availbale now:",
-               "product_list":serializer.data
-           },status=status.HTTP_200_OK)
+        try:
+            filters=parse_product_filters(request.query_params)
+        except InvalidFilter as exc:
+            return Response({'error':str(exc)},status=status.HTTP_400_BAD_REQUEST)
+        products=filter_products(Product.objects.select_related('category'),**filters)
+
+        if request.query_params.get('export')=='ndjson':
+            response=StreamingHttpResponse(self.stream_ndjson(products),content_type='application/x-ndjson')
+            response['Content-Disposition']='attachment; filename="products.ndjson"'
+            return response
+
+        try:
+            projection=ProductProjection.from_params(request.query_params)
+        except InvalidProjection as exc:
+            return Response({'error':str(exc)},status=status.HTTP_400_BAD_REQUEST)
+
+        payload=cached(PRODUCT_LISTS,f'products:{request.build_absolute_uri()}',lambda:self.build_page(request,products,projection,filters))
+        return Response(payload,status=status.HTTP_200_OK)
+
+    def build_page(self,request,products,projection,filters=None):
+        filters=filters or {}
+        filtered=any(value is not None for value in filters.values())
+        paginator=self.pagination_class()
+        page=paginator.paginate_queryset(projection.values(products),request,view=self)
+        if page or paginator.has_cursor or filtered:
+           data=paginator.get_paginated_data(projection.render(page))
+           return {
+               "message":f"{len(page)} products on this page",
+               "product_list":data.pop('results'),
+               **data,
+               "facets":product_facets(Product.objects.all(),**filters)
+           }
         else:
-            return Response({"message":"There is no prodcts please Add some"})
+            return {"message":"There is no prodcts please Add some"}
+
+    def stream_ndjson(self,queryset):
+        """Yield the whole catalog one JSON line per product in constant memory"""
+        rows=queryset.order_by('id').iterator(chunk_size=self.export_chunk_size)
+        while True:
+            chunk=list(islice(rows,self.export_chunk_size))
+            if not chunk:
+                break
+            lines=[json.dumps(item,cls=DjangoJSONEncoder) for item in ProductSerializer(chunk,many=True).data]
+            yield "\n".join(lines)+"\n"
         
     def post(self, request):
       if request.user.role=='admin':
@@ -146,14 +225,72 @@ class ProductListCreateAPIView(APIView):
           return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
 
+class ProductBulkAPIView(APIView):
+    """Admin catalog import (POST a csv/ndjson file) and export (GET)"""
+    permission_classes=[IsAdmin]
+    content_types={'csv':'text/csv','ndjson':'application/x-ndjson'}
+
+    def get(self,request):
+        file_format=request.query_params.get('file_format','csv')
+        if file_format not in bulk.FORMATS:
+            return Response({'error':'file_format must be csv or ndjson'},status=status.HTTP_400_BAD_REQUEST)
+        response=StreamingHttpResponse(bulk.export_products(file_format),content_type=self.content_types[file_format])
+        response['Content-Disposition']=f'attachment; filename="products.{file_format}"'
+        return response
+
+    def post(self,request):
+        upload=request.FILES.get('file')
+        if upload is None:
+            return Response({'error':'Upload the catalog as file'},status=status.HTTP_400_BAD_REQUEST)
+
+        file_format=request.data.get('file_format') or bulk.guess_format(upload.name)
+        if file_format not in bulk.FORMATS:
+            return Response({'error':'file_format must be csv or ndjson'},status=status.HTTP_400_BAD_REQUEST)
+        try:
+            batch_size=max(1,int(request.data.get('batch_size',1000)))
+        except ValueError:
+            return Response({'error':'batch_size must be a number'},status=status.HTTP_400_BAD_REQUEST)
+
+        report=bulk.import_products(bulk.text_stream(upload.file),file_format,batch_size=batch_size)
+        return Response({
+            'message':f"Imported {report.imported} of {report.rows} rows",
+            **report.as_dict()
+        },status=status.HTTP_200_OK)
+
+
+class ProductSearchAPIView(APIView):
+    max_limit=100
+
+    def get(self,request):
+        query=request.query_params.get('q','').strip()
+        if not query:
+            return Response({'error':'Search query q is required'},status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            filters=parse_product_filters(request.query_params)
+            limit=request.query_params.get('limit')
+            limit=max(1,min(int(limit) if limit else 20,self.max_limit))
+        except InvalidFilter as exc:
+            return Response({'error':str(exc)},status=status.HTTP_400_BAD_REQUEST)
+        except ValueError:
+            return Response({'error':'limit must be a number'},status=status.HTTP_400_BAD_REQUEST)
+
+        products=search_products(query,category_id=filters['category_id'],min_price=filters['min_price'],max_price=filters['max_price'],limit=limit)
+        serializer=ProductSerializer(products,many=True)
+        return Response({
+            'message':f"{len(products)} products found for '{query}'",
+            'product_list':serializer.data
+        },status=status.HTTP_200_OK)
+
+
 class ProductDetailOrDeleteView(APIView):
     def get_object(self, pk):
         return get_object_or_404(Product, pk=pk)
 
+    @method_decorator(condition(etag_func=conditional.product_detail_etag,last_modified_func=conditional.product_detail_last_modified))
     def get(self, request, pk):
-        product = self.get_object(pk)
-        serializer = ProductSerializer(product)
-        return Response(serializer.data)
+        data = cached(CATALOG, f'product:{pk}', lambda: ProductSerializer(self.get_object(pk)).data)
+        return Response(data)
     
     def put(self,request,pk):
         product=self.get_object(pk)
@@ -187,26 +324,55 @@ class ProductDetailOrDeleteView(APIView):
 #Cart APIView
 
 class CartAPI(APIView):
+    """
+    The user's cart. PUT and DELETE name the line either by item_id, the
+    line's `id` in the cart payload (an OrderItem id with the database
+    store, the product id with the cache store), or by product_id, which
+    means the same with every CART_STORE.
+    """
 
     permission_classes=[IsAuthenticated]
 
     def get_cart(self,user):
-        cart,created=Order.objects.get_or_create(customer=user,is_checked_out=False)
-        return cart
+        """The user's cart from the configured CART_STORE"""
+        return get_cart_store().get_cart(user)
+
+    def line_id(self,request,cart):
+        """The line named by item_id, or by product_id"""
+        item_id=request.data.get("item_id")
+        if not item_id and request.data.get("product_id"):
+            item_id=cart.line_id(request.data.get("product_id"))
+        return item_id
+
+    def handle_exception(self,exc):
+        if isinstance(exc,CartBusy):
+            return Response({'error':str(exc)},status=status.HTTP_409_CONFLICT)
+        return super().handle_exception(exc)
     
+    @method_decorator(condition(etag_func=conditional.cart_etag,last_modified_func=conditional.cart_last_modified))
     def get(self,request):
         cart=self.get_cart(request.user)
-        serializer=OrderSerializer(cart)
-        return Response(serializer.data,status=status.HTTP_200_OK)
+        return Response(cart.data(),status=status.HTTP_200_OK)
     
+    # A retried add with the same Idempotency-Key must not add the quantity twice
+    @idempotent
     def post(self,request):
         """Add product to cart"""
 
+        if isinstance(request.data,list) or 'operations' in request.data:
+            return self.batch(request)
+
         product_id=request.data.get("product_id")
         quantity=request.data.get("quantity",1)
 
         if not product_id:
             return Response({"error": "Product ID is required"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            quantity=int(quantity)
+        except (TypeError,ValueError):
+            quantity=0
+        if quantity<1:
+            return Response({'error':'Quantity must be a whole number, 1 or more'},status=status.HTTP_400_BAD_REQUEST)
         
         try:
             product=Product.objects.get(id=product_id)
@@ -215,59 +381,64 @@ class CartAPI(APIView):
             return Response({"error": "Product not found"}, status=status.HTTP_404_NOT_FOUND)
         
         cart=self.get_cart(request.user)
+        cart.add(product,quantity)
 
-        item,created=OrderItem.objects.get_or_create(order=cart,product=product)
-
-        if not created:
-            item.quantity+=int(quantity)
-        else:
-            item.quantity=quantity
-        item.save()
+        return Response(cart.data(),status=status.HTTP_201_CREATED)
+    
+    def batch(self,request):
+        """Apply a list of {op, product_id, quantity} operations, op being add, set or remove"""
+        operations=request.data if isinstance(request.data,list) else request.data.get('operations')
+        serializer=CartOperationSerializer(data=operations,many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors,status=status.HTTP_400_BAD_REQUEST)
+        if not serializer.validated_data:
+            return Response({'error':'No operations given'},status=status.HTTP_400_BAD_REQUEST)
+
+        product_ids={operation['product_id'] for operation in serializer.validated_data}
+        products=Product.objects.in_bulk(product_ids)
+        missing=sorted(product_ids-set(products))
+        if missing:
+            return Response({'error':'Product not found','product_ids':missing},status=status.HTTP_404_NOT_FOUND)
 
-        serializer=OrderSerializer(cart)
+        cart=self.get_cart(request.user)
+        cart.apply(serializer.validated_data,products)
+        return Response(cart.data(),status=status.HTTP_200_OK)
 
-        return Response(serializer.data,status=status.HTTP_201_CREATED)
-    
     def put(self,request):
         """Update quantity of a product in cart"""
 
-        item_id=request.data.get("item_id")
         quantity=request.data.get("quantity")
 
-        if not item_id or quantity is None:
+        if not (request.data.get("item_id") or request.data.get("product_id")) or quantity is None:
             return Response({'error':'ID and Quantity Required'},status=status.HTTP_400_BAD_REQUEST)
-        
         try:
-            item=OrderItem.objects.get(id=item_id,order__customer=request.user,order__is_checked_out=False)
+            quantity=int(quantity)
+        except (TypeError,ValueError):
+            quantity=-1
+        if quantity<0:
+            return Response({'error':'Quantity must be a whole number, 0 or more'},status=status.HTTP_400_BAD_REQUEST)
         
-        except Product.DoesNotExist:
+        cart=self.get_cart(request.user)
+        item_id=self.line_id(request,cart)
+        if not item_id or not cart.set_quantity(item_id,quantity):
             return Response({'error':'Product not found in cart'},status=status.HTTP_400_BAD_REQUEST)
-        
-        item.quantity=int(quantity)
-        item.save()
 
-        cart=self.get_cart(request.user)
-        serializer=OrderSerializer(cart)
-        return Response(serializer.data,status=status.HTTP_200_OK)
+        return Response(cart.data(),status=status.HTTP_200_OK)
 
 
     
     def delete(self,request):
         """Remove Product from cart"""
 
-        item_id=request.data.get("item_id")
-
-        if not item_id:
+        if not (request.data.get("item_id") or request.data.get("product_id")):
             return Response({'error':'Item ID is required'},status=status.HTTP_400_BAD_REQUEST)
-        try:
-          item=OrderItem.objects.get(id=item_id,order__customer=request.user,order__is_checked_out=False)
-          item.delete()
-        except OrderItem.DoesNotExist:
+
+        cart=self.get_cart(request.user)
+        item_id=self.line_id(request,cart)
+        if not item_id or not cart.remove(item_id):
             return Response({'error':'Order Item Does not Found '},status=status.HTTP_400_BAD_REQUEST)
         
-        cart=self.get_cart(request.user)
-        serializer=OrderSerializer(cart)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return Response(cart.data(), status=status.HTTP_200_OK)
         
 
 
@@ -275,40 +446,55 @@ class CartAPI(APIView):
 class CheckoutAPIView(APIView):
     permission_classes = [IsAuthenticated]
 
+    # A retry with the same Idempotency-Key gets the first response back instead of a second checkout
+    @idempotent
     def post(self, request):
-        try:
-            # Get the active order for this user
-            order = Order.objects.get(customer=request.user, is_checked_out=False)
-        except Order.DoesNotExist:
-            return Response({'error': 'Order Does not Exist'}, status=status.HTTP_400_BAD_REQUEST)
-        
-        
-        payment_method=request.data.get('payment_method')
-        
         serializer = ShippingAddressSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-        if serializer.is_valid():
-            # Save shipping address and link it with user + order
-            shipping = serializer.save(user=request.user, order=order)
-
-         
-            order.is_checked_out = True
-
-            order.payment_method=payment_method
-            order.save()
+        # Write-behind cart stores hold lines the database has not seen yet
+        cart=get_cart_store().get_cart(request.user)
+        cart.persist()
 
+        try:
+            with transaction.atomic():
+                try:
+                    # Get the active order for this user, locked against a double submit
+                    order = Order.objects.select_for_update().get(customer=request.user, is_checked_out=False)
+                except Order.DoesNotExist:
+                    return Response({'error': 'Order Does not Exist'}, status=status.HTTP_400_BAD_REQUEST)
+
+                # All or nothing, raises InsufficientStock and rolls back on a shortage
+                reserve_stock(order)
+
+                # Save shipping address and link it with user + order
+                shipping = serializer.save(user=request.user, order=order)
+
+                # Prices are fixed from here on, later product edits don't touch this order
+                order.snapshot_prices()
+                order.is_checked_out = True
+
+                order.payment_method=request.data.get('payment_method',order.payment_method)
+                order.save()
+        except InsufficientStock as exc:
             return Response({
-                "message": "Checkout successfully",
-                "order_id": order.id,
-                "order_username": request.user.username,
-                "total_price": order.get_cart_total,
-                'payment_method':order.payment_method,
-                
-                "shipping_address": ShippingAddressSerializer(shipping).data
+                'error': 'Not enough stock for some items in your cart',
+                'shortages': exc.shortages
+            }, status=status.HTTP_409_CONFLICT)
 
-            }, status=status.HTTP_201_CREATED)
+        cart.clear()
 
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            "message": "Checkout successfully",
+            "order_id": order.id,
+            "order_username": request.user.username,
+            "total_price": order.total_price,
+            'payment_method':order.payment_method,
+            
+            "shipping_address": ShippingAddressSerializer(shipping).data
+
+        }, status=status.HTTP_201_CREATED)
     
 
 
@@ -317,32 +503,83 @@ class OrderListAPIView(APIView):
     permission_classes=[IsAuthenticated]
 
     def get(self,request):
+        try:
+            projection=OrderProjection.from_params(request.query_params,checked_out=True)
+        except InvalidProjection as exc:
+            return Response({'error':str(exc)},status=status.HTTP_400_BAD_REQUEST)
+        # Built from values() rows, same payload as OrderSerializer without an instance per row
         orders=Order.objects.filter(customer=request.user,is_checked_out=True).order_by('-created_at')
-        serializer=OrderSerializer(orders,many=True)
-        return Response(serializer.data)
+        return Response(projection.project(orders))
     
 
 class OrderDetailUpdateDeleteView(APIView):
     permission_classes=[IsAuthenticated]
 
     def get(self, request, pk):
-        order = Order.objects.get(pk=pk,customer=request.user)
+        order = get_object_or_404(order_queryset(),pk=pk,customer=request.user)
         serializer = OrderSerializer(order)  # Make sure to pass the context as well
         return Response(serializer.data)
     
-    def patch(seld,request,pk):
+    @idempotent
+    def patch(self,request,pk):
+        with transaction.atomic():
+            try:
+                order = Order.objects.select_for_update().get(pk=pk, customer=request.user, is_checked_out=True)
+            except Order.DoesNotExist:
+                return Response({'error': 'Order not found'}, status=status.HTTP_404_NOT_FOUND)
+            
+            if order.status in ["pending","processing"]:
+                order.status="cancelled"
+                order.save()
+                release_stock(order)
+                return Response({'message': 'Order cancelled successfully'}, status=status.HTTP_200_OK)
+        return Response({'error': 'Order cannot be cancelled once shipped/delivered'}, status=status.HTTP_400_BAD_REQUEST)
+
+
+
+class OrderPaymentAPIView(APIView):
+    """Start the online payment of a checked-out order, the gateway reports the outcome to the webhook"""
+    permission_classes=[IsAuthenticated]
+
+    @idempotent
+    def post(self,request,pk):
+        order=get_object_or_404(Order.objects.only('id','customer_id','total_price','payment_method','payment_status','transaction_id','payment_url'),
+                                pk=pk,customer=request.user,is_checked_out=True)
+        if order.payment_method!='ONLINE':
+            return Response({'error': 'Only online orders are paid through the gateway'}, status=status.HTTP_400_BAD_REQUEST)
         try:
-            order = Order.objects.get(pk=pk, customer=request.user, is_checked_out=True)
-        except Order.DoesNotExist:
-            return Response({'error': 'Order not found'}, status=status.HTTP_404_NOT_FOUND)
-        
-        if order.status in ["pending","processing"]:
-            order.status="cancelled"
-            order.save()
-            return Response({'message': 'Order cancelled successfully'}, status=status.HTTP_200_OK)
-        else:
-            return Response({'error': 'Order cannot be cancelled once shipped/delivered'}, status=status.HTTP_400_BAD_REQUEST)
+            charge=payments.start_payment(order)
+        except payments.PaymentError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_409_CONFLICT)
+        return Response({
+            'order_id': order.id,
+            'transaction_id': charge.transaction_id,
+            'payment_status': order.payment_status,
+            'redirect_url': charge.redirect_url,
+        }, status=status.HTTP_200_OK)
+
+
+class PaymentWebhookAPIView(APIView):
+    """Payment callbacks from the gateway, authenticated by their signature"""
+    authentication_classes=[]
+    permission_classes=[permissions.AllowAny]
 
+    def post(self,request):
+        try:
+            # The raw body, the signature covers its exact bytes
+            event=payments.get_gateway().parse_webhook(request.body,request.headers)
+        except payments.InvalidSignature as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_403_FORBIDDEN)
+        except payments.PaymentError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        result=payments.settle(event['transaction_id'],event['status'],event['amount'])
+        if result=='unknown':
+            # Possibly ahead of the commit that stored the transaction id, the gateway retries
+            return Response({'error': 'Unknown transaction'}, status=status.HTTP_404_NOT_FOUND)
+        if result=='mismatch':
+            return Response({'error': 'The amount does not match the order'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'result': result}, status=status.HTTP_200_OK)
     
    
 
@@ -355,15 +592,126 @@ class OrderDetailUpdateDeleteView(APIView):
 class AdminOrderListAPIView(APIView):
     permission_classes = [IsAdmin]
 
+    pagination_class = OrderKeysetPagination
+
     def get(self, request):
-        orders=Order.objects.all().order_by('-created_at')
+        try:
+            filters=parse_order_filters(request.query_params)
+        except InvalidFilter as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            projection=AdminOrderProjection.from_params(request.query_params,checked_out=filters['is_checked_out'])
+        except InvalidProjection as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        orders=filter_orders(Order.objects.all(),**filters)
         total_order=orders.count()
-        #orders = Order.objects.filter(is_checked_out=True ).order_by('-created_at')
-        serializer = AdminOrderSerializer(orders, many=True)
+        paginator=self.pagination_class()
+        page=paginator.paginate_queryset(projection.values(orders),request,view=self)
+        data=paginator.get_paginated_data(projection.render(page))
         return Response({
          'total_orders':total_order,
-         'orders': serializer.data
+         'orders': data.pop('results'),
+         **data,
         })
+
+
+def upload_state(upload):
+    return {
+        'id': upload.id,
+        'product_id': upload.product_id,
+        'filename': upload.filename,
+        'size': upload.size,
+        'offset': upload.received,
+        'status': upload.status,
+        'chunk_size': uploads.chunk_size(),
+    }
+
+
+def upload_error(exc):
+    data={'error': str(exc)}
+    if exc.offset is not None:
+        data['offset']=exc.offset
+    return Response(data,status=exc.status)
+
+
+class MediaUploadCreateAPIView(APIView):
+    """Open a chunked upload of a product image: product_id, filename, size and sha256"""
+    permission_classes = [IsAdmin]
+
+    def post(self, request):
+        try:
+            product=Product.objects.get(pk=int(request.data.get('product_id')))
+        except (TypeError, ValueError, Product.DoesNotExist):
+            return Response({'error': 'Product not found'}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            size=int(request.data.get('size'))
+        except (TypeError, ValueError):
+            return Response({'error': 'size must be a number of bytes'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            upload=uploads.start_upload(product,request.user,str(request.data.get('filename','')),size,str(request.data.get('sha256','')))
+        except uploads.UploadError as exc:
+            return upload_error(exc)
+        return Response(upload_state(upload), status=status.HTTP_201_CREATED)
+
+
+class MediaUploadDetailAPIView(APIView):
+    """GET the offset to resume from, PUT a chunk with a Content-Range header, DELETE to abort"""
+    permission_classes = [IsAdmin]
+
+    def get(self, request, pk):
+        return Response(upload_state(get_object_or_404(MediaUpload, pk=pk)))
+
+    def put(self, request, pk):
+        upload=get_object_or_404(MediaUpload, pk=pk)
+        try:
+            start,end=uploads.parse_content_range(request.headers.get('Content-Range'),upload)
+            # The raw body, read from the stream in small pieces instead of request.data
+            uploads.write_chunk(upload,start,end,request.stream)
+        except uploads.UploadError as exc:
+            return upload_error(exc)
+        return Response(upload_state(upload))
+
+    def delete(self, request, pk):
+        upload=get_object_or_404(MediaUpload, pk=pk)
+        uploads.discard(upload)
+        upload.delete()
+        return Response({'message': 'Upload aborted'}, status=status.HTTP_200_OK)
+
+
+class MediaUploadFinalizeAPIView(APIView):
+    """Check the size and checksum of a fully received upload and attach it to Product.image"""
+    permission_classes = [IsAdmin]
+
+    def post(self, request, pk):
+        with transaction.atomic():
+            # Locked, so a repeated finalize waits and then sees the upload complete
+            upload=get_object_or_404(MediaUpload.objects.select_for_update(), pk=pk)
+            try:
+                product=uploads.finalize(upload)
+            except uploads.UploadError as exc:
+                return upload_error(exc)
+        return Response({
+            'message': 'Upload attached to the product',
+            'upload': upload_state(upload),
+            'product': ProductSerializer(product,context={'request': request}).data,
+        }, status=status.HTTP_200_OK)
+
+
+class CacheStatsAPIView(APIView):
+    permission_classes = [IsAdmin]
+
+    def get(self, request):
+        return Response(cache_stats())
+
+
+class MetricsAPIView(APIView):
+    """Per-endpoint latency, query and serialization histograms in the Prometheus text format"""
+    permission_classes = [IsAdmin]
+
+    def get(self, request):
+        return HttpResponse(metrics.export_prometheus(),content_type='text/plain; version=0.0.4; charset=utf-8')
     
     
     
@@ -372,16 +720,12 @@ class AdminOrderUpdateView(APIView):
     permission_classes = [IsAdmin]
 
     def get(self,request,pk):
-        order=Order.objects.get(pk=pk)
+        order=get_object_or_404(order_queryset(),pk=pk)
         serializer=AdminOrderSerializer(order)
         return Response(serializer.data)
 
+    @idempotent
     def patch(self, request, pk):
-        try:
-            order = Order.objects.get(is_checked_out=True, pk=pk)
-        except Order.DoesNotExist:
-            return Response({'error': 'Order not found'}, status=status.HTTP_404_NOT_FOUND)
-
         status_value = request.data.get('status')
         payment_status = request.data.get('payment_status')
 
@@ -393,19 +737,37 @@ class AdminOrderUpdateView(APIView):
         if payment_status and payment_status not in dict(Order.PAYMENT_STATUS):
             return Response({'error': 'Invalid payment status'}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Update order
-        if status_value:
-            order.status = status_value
-        if payment_status:
-            order.payment_status = payment_status
-
-        # Mark as completed if delivered & paid
-        if order.status == 'delivered' and order.payment_status == 'success':
-            order.completed = True
-        else:
-            order.completed=False
-
-        order.save()
+        try:
+            with transaction.atomic():
+                try:
+                    order = Order.objects.select_for_update().get(is_checked_out=True, pk=pk)
+                except Order.DoesNotExist:
+                    return Response({'error': 'Order not found'}, status=status.HTTP_404_NOT_FOUND)
+
+                # A cancelled order holds no stock: give it back on the way in, take it again on the way out
+                if status_value == 'cancelled' and order.status != 'cancelled':
+                    release_stock(order)
+                elif status_value and status_value != 'cancelled' and order.status == 'cancelled':
+                    reserve_stock(order)
+
+                # Update order
+                if status_value:
+                    order.status = status_value
+                if payment_status:
+                    order.payment_status = payment_status
+
+                # Mark as completed if delivered & paid
+                if order.status == 'delivered' and order.payment_status == 'success':
+                    order.completed = True
+                else:
+                    order.completed=False
+
+                order.save()
+        except InsufficientStock as exc:
+            return Response({
+                'error': 'Not enough stock to reopen this order',
+                'shortages': exc.shortages
+            }, status=status.HTTP_409_CONFLICT)
 
         serializer = AdminOrderSerializer(order)
         return Response({
@@ -420,10 +782,26 @@ class AdminOrderUpdateView(APIView):
             return Response({'error': 'Order not found'}, status=status.HTTP_404_NOT_FOUND)
 
         if request.user.role == 'admin':
-            order.delete()
+            with transaction.atomic():
+                if order.status in ['pending','processing']:
+                    # Its units are still reserved, nothing left the warehouse
+                    release_stock(order)
+                order.delete()
             return Response({'message': 'Order deleted successfully'}, status=status.HTTP_200_OK)
 
         return Response({'error': 'You have no permission'}, status=status.HTTP_403_FORBIDDEN)
+
+
+class SalesAnalyticsAPIView(APIView):
+    """Revenue, order counts and best sellers over an optional date range, read from the daily rollups"""
+    permission_classes = [IsAdmin]
+
+    def get(self, request):
+        try:
+            params=analytics.parse_sales_params(request.query_params)
+        except analytics.InvalidRange as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(analytics.sales_summary(**params))
     
 
 #Payment API